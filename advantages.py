@@ -0,0 +1,47 @@
+import torch
+
+
+def get_is_terminal(completions, pad_token_id):
+    # 1 on the eos token and the padding after it of every completion, or on the last token of rows that did not
+    # finish. Only the completion columns: the prompts of a batch with several prompts are left padded
+    is_terminal = torch.zeros_like(completions, device='cpu')
+    is_terminal[completions.cpu() == pad_token_id] = 1
+    eos_token = is_terminal.shape[1]-is_terminal.count_nonzero(dim=1)-1
+    is_terminal[torch.arange(len(is_terminal)), eos_token] = 1
+    return is_terminal
+
+def get_eos_index(is_terminal):
+    # Position of the eos token of every row, where its reward is, the last position for rows that did not finish
+    return (is_terminal == 0).sum(dim=1).clamp(max=is_terminal.shape[1]-1)
+
+def group_normalize(values, group_index=None, scale=True):
+    # values minus the mean of their group, divided by the std of the group when scale. group_index is the group
+    # (prompt) of every row, None for a single group
+    if group_index is None:
+        group_index = torch.zeros(len(values), dtype=torch.long, device=values.device)
+    group_index = group_index.to(values.device)
+    counts = torch.bincount(group_index).to(values.dtype)
+    group_mean = torch.zeros_like(counts).index_add_(0, group_index, values) / counts.clamp(min=1)
+    normalized = values - group_mean[group_index]
+    if scale:
+        group_var = torch.zeros_like(counts).index_add_(0, group_index, normalized**2) / (counts - 1).clamp(min=1)
+        normalized = normalized / (group_var.sqrt()[group_index] + 1e-8)
+    return normalized
+
+def compute_advantages(rewards, is_terminal, dr_grpo=False, group_index=None, sparse=False):
+    """
+    GRPO advantages of the rows of a batch: the reward at the eos of every row minus the mean reward of its group
+    (the samples of its prompt, group_index, a single group when None), divided by the std of the group except for
+    Dr. GRPO. Every prompt of the batch is normalized at once.
+
+    Returns [rows, tokens] advantages, the advantage of every row on its tokens up to the eos and 0 after it. With
+    sparse only the advantage of every row is returned ([rows]), for the loss to broadcast it over the tokens of
+    the row.
+    """
+    eos_index = get_eos_index(is_terminal).to(rewards.device)
+    rewards_of_outputs = rewards[torch.arange(len(rewards), device=rewards.device), eos_index]
+    advantages = group_normalize(rewards_of_outputs, group_index, scale=not dr_grpo)
+    if sparse:
+        return advantages
+    length_mask = torch.arange(rewards.shape[1], device=rewards.device) <= eos_index[:, None]
+    return advantages[:, None] * length_mask
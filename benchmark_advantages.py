@@ -0,0 +1,70 @@
+import time
+
+import torch
+
+from advantages import compute_advantages
+
+# compute_advantages on random rollouts of sims_per_prompt samples per prompt, against the per-row loop it
+# replaces, for GRPO and Dr. GRPO: the dense advantages must be the same, and the sparse ones broadcast over the
+# tokens up to the eos must give the advantages the loss sees.
+batch_sizes = [8, 512, 4096]
+sims_per_prompt = 8
+max_tokens = 320
+repeats = 20
+seed = 0
+
+
+def loop_compute_advantages(rewards, is_terminal, dr_grpo=False, group_index=None):
+    # The previous implementation
+    num_rollout_steps = torch.max((is_terminal==0).sum(1))
+    num_rollout_steps = torch.min(num_rollout_steps, torch.tensor(rewards.shape[1])-1)
+    advantages = torch.zeros((len(rewards), torch.tensor(rewards.shape[1])))
+
+    eos_index = (is_terminal == 0).sum(dim=1)
+    eos_index = torch.min(num_rollout_steps, eos_index)
+    rewards_of_outputs = rewards[torch.arange(len(rewards)), eos_index]
+    if group_index is None:
+        group_index = torch.zeros(len(rewards), dtype=torch.long)
+    counts = torch.bincount(group_index).to(rewards_of_outputs.dtype)
+    group_mean = torch.zeros_like(counts).index_add_(0, group_index, rewards_of_outputs) / counts.clamp(min=1)
+    norm_rewards = (rewards_of_outputs - group_mean[group_index])
+    if not dr_grpo:
+        group_var = torch.zeros_like(counts).index_add_(0, group_index, norm_rewards**2) / (counts - 1).clamp(min=1)
+        norm_rewards /= (group_var.sqrt()[group_index] + 1e-8)
+
+    for i in range(len(rewards)):
+        advantages[i,:eos_index[i]+1] = norm_rewards[i]
+    return advantages
+
+def make_rollout(rows, generator):
+    # is_terminal is 1 from the eos on, some rows never finish. The reward is at the eos
+    lengths = torch.randint(1, max_tokens + 32, (rows,), generator=generator)
+    is_terminal = (torch.arange(max_tokens) >= lengths[:, None]).long()
+    rewards = torch.zeros(rows, max_tokens)
+    rewards[torch.arange(rows), lengths.clamp(max=max_tokens-1)] = torch.rand(rows, generator=generator)
+    group_index = torch.arange(rows) // sims_per_prompt
+    return rewards, is_terminal, group_index
+
+def timed(fn, *args, **kwargs):
+    fn(*args, **kwargs) # Warm up
+    start = time.perf_counter()
+    for _ in range(repeats):
+        result = fn(*args, **kwargs)
+    return result, (time.perf_counter() - start) / repeats
+
+
+if __name__ == '__main__':
+    generator = torch.Generator().manual_seed(seed)
+    print(f'{sims_per_prompt} samples per prompt, {max_tokens} tokens, cpu, mean of {repeats} runs')
+    for rows in batch_sizes:
+        rewards, is_terminal, group_index = make_rollout(rows, generator)
+        # The mask update_policy multiplies the advantages by (minibatch_is_not_terminal)
+        is_not_terminal = torch.cat((torch.ones(rows, 1), 1 - is_terminal), dim=1)[:, :max_tokens]
+        for dr_grpo in [False, True]:
+            loop, loop_time = timed(loop_compute_advantages, rewards, is_terminal, dr_grpo=dr_grpo, group_index=group_index)
+            dense, dense_time = timed(compute_advantages, rewards, is_terminal, dr_grpo=dr_grpo, group_index=group_index)
+            sparse, sparse_time = timed(compute_advantages, rewards, is_terminal, dr_grpo=dr_grpo, group_index=group_index, sparse=True)
+            assert torch.allclose(dense, loop, atol=1e-6), 'Vectorized advantages differ from the loop'
+            assert torch.allclose(sparse[:, None] * is_not_terminal, loop * is_not_terminal, atol=1e-6), 'Sparse advantages differ from the loop'
+            variant = 'Dr. GRPO' if dr_grpo else 'GRPO'
+            print(f'N={rows} {variant}: loop {loop_time*1000:.2f} ms, vectorized {dense_time*1000:.2f} ms ({loop_time/dense_time:.1f}x), sparse {sparse_time*1000:.2f} ms; {dense.numel()*dense.element_size()/1024:.0f} KiB dense, {sparse.numel()*sparse.element_size()/1024:.2f} KiB sparse')
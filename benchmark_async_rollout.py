@@ -0,0 +1,98 @@
+import asyncio
+import logging
+import time
+
+import benchmark_rollout_scheduler as scheduler_benchmark
+from benchmark_rollout_scheduler import FakeEngine, FakeTokenizer
+from tool_execution import ToolExecutor, TOOL_TIMEOUT_RESULT
+from tool_rollout import generate_with_tools, generate_with_tools_async, rollout_ids_async, run_tool_call_async
+
+# Compares the round based tool loop with the streaming one on scripted engines. A round costs as much as its
+# longest sequence (the batch decodes in parallel), and the tool blocks for tool_seconds on every call
+samples_num = 256
+actions_num = 4
+seconds_per_token = 2e-4
+tool_seconds = 0.02
+tool_threads = 16
+tool_timeout = 0.2
+prompt_words = ['el', 'la', 'casa', 'grande', 'río']
+
+def slow_echo(api_args):
+    time.sleep(tool_seconds)
+    return f' <result> {api_args[::-1]} </result>'
+
+TOOLS = [
+    {
+        'name': 'echo',
+        'api': slow_echo,
+        'start_token': scheduler_benchmark.TOOLS[0]['start_token'],
+        'end_token': scheduler_benchmark.TOOLS[0]['end_token'],
+    },
+]
+
+
+class FakeBatchEngine(FakeEngine):
+    # vLLM.LLM: the whole batch returns when its longest sequence is done
+    def generate(self, prompt_token_ids, sampling_params=None, lora_request=None, use_tqdm=None):
+        outputs = [self.complete(token_ids) for token_ids in prompt_token_ids]
+        time.sleep(max(len(output.outputs[0].token_ids) for output in outputs) * seconds_per_token)
+        return outputs
+
+class FakeAsyncEngine(FakeEngine):
+    # AsyncLLMEngine: every request returns as soon as its own tokens are decoded
+    async def generate(self, prompt_token_ids, sampling_params, request_id, lora_request=None):
+        output = self.complete(prompt_token_ids)
+        await asyncio.sleep(len(output.outputs[0].token_ids) * seconds_per_token)
+        return output
+
+
+def make_inputs(tokenizer):
+    return [tokenizer.encode(f'Traduce la frase {i}: ' + ' '.join(prompt_words[(i * 7 + k) % len(prompt_words)] for k in range(6))) for i in range(samples_num)]
+
+
+if __name__ == '__main__':
+    # Truncated answers are expected here
+    logging.getLogger('tool_rollout').setLevel(logging.ERROR)
+    tokenizer = FakeTokenizer()
+    stop_tokens = [tool['end_token'] for tool in TOOLS] + [tokenizer.eos_token]
+
+    start = time.perf_counter()
+    buffer, stats = generate_with_tools(FakeBatchEngine(), tokenizer, make_inputs(tokenizer), None, TOOLS, stop_tokens, actions_num=actions_num)
+    rounds_time = time.perf_counter() - start
+
+    tool_executor = ToolExecutor(max_workers=tool_threads, timeout=tool_timeout)
+    start = time.perf_counter()
+    async_buffer, async_stats = asyncio.run(generate_with_tools_async(FakeAsyncEngine(), tokenizer, make_inputs(tokenizer), None, TOOLS, stop_tokens,
+        actions_num=actions_num, tool_executor=tool_executor))
+    streaming_time = time.perf_counter() - start
+    assert tool_executor.pop_stats()['timeouts'] == 0
+
+    generation_ids, prompt_length, generation_mask, _ = rollout_ids_async(FakeAsyncEngine(), tokenizer, make_inputs(tokenizer), None, TOOLS, stop_tokens, actions_num=actions_num, tool_executor=tool_executor)
+
+    assert async_buffer.responses() == buffer.responses(), 'Responses differ from the round based loop'
+    assert async_buffer.sequences() == buffer.sequences(), 'Token ids differ from the round based loop'
+    assert async_buffer.masks() == buffer.masks(), 'Masks differ from the round based loop'
+    assert async_stats == stats
+    # The eos appended to unfinished answers was not sampled, it is masked out of the loss
+    appended_eos = sum(ids[-1] == tokenizer.eos_token_id and mask[-1] == 0 for ids, mask in zip(buffer.sequences(), buffer.masks()))
+    assert appended_eos == stats['unfinished_answers'] > 0
+    expected_ids, expected_mask = buffer.tensors()
+    assert generation_ids.equal(expected_ids) and generation_mask.equal(expected_mask)
+    assert prompt_length == max(len(input_ids) for input_ids in make_inputs(tokenizer))
+
+    print(f'Samples: {samples_num}, tool calls/sample: {sum(stats["tool_calls"])/samples_num:.2f}, generated tokens: {stats["generated_tokens"]}')
+    # A call that hangs is answered with the timeout result once the executor timeout passes, without stalling the
+    # other sequences
+    hanging_tool = dict(TOOLS[0], api=lambda api_args: time.sleep(10 * tool_timeout) if api_args == 'hang' else slow_echo(api_args))
+    async def hanging_calls():
+        return await asyncio.gather(*[run_tool_call_async(hanging_tool, api_args, tool_executor=tool_executor) for api_args in ['fast', 'hang', 'fast']])
+    start = time.perf_counter()
+    hanging_results = asyncio.run(hanging_calls())
+    hanging_time = time.perf_counter() - start
+    assert hanging_results == [slow_echo('fast'), TOOL_TIMEOUT_RESULT, slow_echo('fast')]
+    assert hanging_time < tool_timeout + 0.1, f'Calls with a hanging one took {hanging_time:.2f} s'
+    assert tool_executor.pop_stats()['timeouts'] == 1
+
+    print(f'Round based: {rounds_time:.2f} s')
+    print(f'Streaming:   {streaming_time:.2f} s ({rounds_time/streaming_time:.2f}x)')
+    print(f'Streaming calls with a hanging one: {hanging_time*1000:.1f} ms (timeout {tool_timeout*1000:.0f} ms)')
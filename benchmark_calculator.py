@@ -0,0 +1,91 @@
+import random
+import time
+
+from calculator_tool import calculate, calculator_tool, evaluate_expression
+
+# Compares the AST calculator with the eval based one it replaced, and checks runaway expressions are rejected
+# in bounded time. Uncached, the AST evaluator is slower than eval (about 18 us against 15 us per call here):
+# parsing alone costs about 12 us in both, and the checked tree walk adds to it. Only the cached calls (about
+# 3 us) are faster than eval
+expressions_num = 2000
+distinct_expressions = 200 # Rollouts of the same prompt repeat most of their calculations
+max_runaway_seconds = 0.05
+seed = 0
+
+RUNAWAY_EXPRESSIONS = [
+    '9**9**9',
+    '2**10**10',
+    '10**999 * 10**999 * 10**999 * 10**999 * 10**999',
+    '(2**4000) ** 2',
+    '"a" * 10**9',
+    '[1] * 10**9',
+    'sum([9**999] * 1000)',
+    '(' * 400 + '1' + ')' * 400,
+    '1' + '+1' * 2000,
+    '__import__("os").system("true")',
+    '(lambda: 1)()',
+    '[x for x in range(10**9)]',
+    'max(range(10**9))',
+]
+
+
+def eval_calculator(code_str):
+    # calculator_tool as it was in grpo_trainer_with_tools.py
+    safe_builtins = {
+        'abs': abs,
+        'min': min,
+        'max': max,
+        'sum': sum
+    }
+    try:
+        return ' <execution_result> ' + str(eval(code_str, {"__builtins__": safe_builtins}, {})) + ' </execution_result>'
+    except Exception as e:
+        return f" <execution_result> Error: {e} </execution_result>"
+
+def make_expression(rng):
+    a, b, c = rng.randint(1, 1000), rng.randint(1, 1000), rng.randint(1, 12)
+    return rng.choice([
+        f'{a} + {b}',
+        f'{a} * {b} - {c}',
+        f'({a} + {b}) / {c}',
+        f'{a} // {c} + {b} % {c}',
+        f'{a / 7:.3f} * {c}',
+        f'{c} ** {c % 5}',
+        f'abs({b} - {a})',
+        f'max({a}, {b}, {c})',
+        f'sum([{a}, {b}, {c}])',
+        f'-{a} + {b} * ({c} - 2)',
+    ])
+
+def time_calls(fn, expressions):
+    start = time.perf_counter()
+    results = [fn(expression) for expression in expressions]
+    return results, time.perf_counter() - start
+
+def uncached_calculator(code_str):
+    return ' <execution_result> ' + str(evaluate_expression(code_str)) + ' </execution_result>'
+
+
+if __name__ == '__main__':
+    rng = random.Random(seed)
+    distinct = [make_expression(rng) for _ in range(distinct_expressions)]
+    expressions = [rng.choice(distinct) for _ in range(expressions_num)]
+
+    eval_results, eval_time = time_calls(eval_calculator, expressions)
+    uncached_results, uncached_time = time_calls(uncached_calculator, expressions)
+    calculate.cache_clear()
+    cached_results, cached_time = time_calls(calculator_tool, expressions)
+    assert uncached_results == eval_results and cached_results == eval_results, 'Results differ from eval'
+
+    print(f'Expressions: {expressions_num} ({distinct_expressions} distinct)')
+    print(f'eval:          {eval_time/expressions_num*1e6:7.1f} us/call')
+    print(f'AST, uncached: {uncached_time/expressions_num*1e6:7.1f} us/call ({uncached_time/eval_time:.2f}x the time of eval)')
+    print(f'AST, cached:   {cached_time/expressions_num*1e6:7.1f} us/call ({eval_time/cached_time:.1f}x eval)')
+
+    for expression in RUNAWAY_EXPRESSIONS:
+        start = time.perf_counter()
+        result = calculator_tool(expression)
+        seconds = time.perf_counter() - start
+        assert result.startswith(' <execution_result> Error:'), f'{expression[:40]} was not rejected: {result[:80]}'
+        assert seconds < max_runaway_seconds, f'{expression[:40]} took {seconds:.3f} s'
+        print(f'Rejected in {seconds*1000:6.2f} ms: {expression[:40]:40} {result[:90]}')
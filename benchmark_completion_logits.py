@@ -0,0 +1,87 @@
+import multiprocessing
+import queue as queue_module
+import resource
+import time
+
+import torch
+
+from token_logprobs import completion_logits, token_log_probs
+
+# Peak memory and time of the forward passes of update_policy (policy with grad and ref without, log-probs and
+# backward) on a small random Qwen2 with Qwen's vocabulary on CPU, with a long prompt as the tool prompts:
+# the LM head applied to every position and sliced, as the trainers did, against completion_logits
+vocab_size = 151936
+batch_size = 2 # minibatch_size
+prompt_tokens = 320
+completion_tokens = 64
+logprob_chunk_size = 64
+temperature = 0.9
+seed = 0
+
+
+def load_model():
+    from transformers import Qwen2Config, Qwen2ForCausalLM
+    torch.manual_seed(seed)
+    config = Qwen2Config(vocab_size=vocab_size, hidden_size=64, intermediate_size=128, num_hidden_layers=2, num_attention_heads=4, num_key_value_heads=2, tie_word_embeddings=True)
+    return Qwen2ForCausalLM(config)
+
+def full_logits(model, input_ids, completion_length):
+    # As update_policy computed them before completion_logits
+    prompt_length = input_ids.shape[1] - completion_length
+    return model(input_ids).logits[:,prompt_length-1:-1]
+
+def run(path, queue):
+    model = load_model()
+    generator = torch.Generator().manual_seed(seed)
+    complete_prompts = torch.randint(0, vocab_size, (batch_size, prompt_tokens + completion_tokens), generator=generator)
+    completion_ids = complete_prompts[:, prompt_tokens:]
+    advantages = torch.randn(batch_size, 1, generator=generator)
+    logits_fn = full_logits if path == 'full' else completion_logits
+    model(complete_prompts[:1, :8]) # Warm up
+    base_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    start = time.perf_counter()
+    logits = logits_fn(model, complete_prompts, completion_tokens)
+    logits /= temperature
+    with torch.no_grad():
+        ref_logits = logits_fn(model, complete_prompts, completion_tokens)
+        ref_logits /= temperature
+        log_ref_probs = token_log_probs(ref_logits, completion_ids, chunk_size=logprob_chunk_size)
+    del ref_logits
+    log_probs = token_log_probs(logits, completion_ids, chunk_size=logprob_chunk_size)
+    loss = -((log_probs - log_probs.detach()).exp() * advantages).sum()
+    loss.backward()
+    step_time = time.perf_counter() - start
+    peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 - base_memory
+
+    gradient = model.model.embed_tokens.weight.grad
+    # As numpy arrays, torch would share the tensors through the memory of the exiting process
+    queue.put((step_time, peak_memory, log_probs.detach().numpy(), log_ref_probs.numpy(), gradient.numpy()))
+
+
+if __name__ == '__main__':
+    context = multiprocessing.get_context('spawn')
+    results = {}
+    for path in ('full', 'completion'):
+        queue = context.Queue()
+        process = context.Process(target=run, args=(path, queue))
+        process.start()
+        while path not in results:
+            try:
+                step_time, peak_memory, *arrays = queue.get(timeout=1)
+                results[path] = (step_time, peak_memory, *map(torch.from_numpy, arrays))
+            except queue_module.Empty:
+                if not process.is_alive():
+                    raise RuntimeError(f'The {path} run exited with code {process.exitcode}, out of memory?')
+        process.join()
+
+    _, _, log_probs, log_ref_probs, gradient = results['full']
+    assert torch.allclose(results['completion'][2], log_probs, atol=1e-5), 'Log-probs differ'
+    assert torch.allclose(results['completion'][3], log_ref_probs, atol=1e-5), 'Ref log-probs differ'
+    assert torch.allclose(results['completion'][4], gradient, rtol=1e-3, atol=1e-7), 'Gradients differ'
+
+    print(f'{batch_size} x ({prompt_tokens} prompt + {completion_tokens} completion) tokens, vocab {vocab_size}, cpu')
+    for path, (step_time, peak_memory, *_) in results.items():
+        print(f'{path:10} LM head {step_time*1000:8.1f} ms, peak memory +{peak_memory/2**20:7.1f} MiB')
+    full, completion = results['full'], results['completion']
+    print(f'completion_logits: {full[1]/completion[1]:.1f}x less peak memory, {full[0]/completion[0]:.1f}x faster')
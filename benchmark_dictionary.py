@@ -0,0 +1,100 @@
+import random
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from tool_execution import ToolResultCache, run_tool_calls
+
+from dictionary_tool import SpanishWayuuDictionary, get_dictionary, spa_to_wayu_dictionary, spa_to_wayu_dictionary_batch, spa_to_wayu_dictionary_scan
+
+spanish_val_file = 'datasets/dev.es'
+queries_num = 500
+round_size = 64 # Tool calls per generation round (evaluation batch size)
+threads = 8 # Lookups at once in the concurrency check, as ToolExecutor runs them
+seed = 0
+
+
+def load_queries(path, queries_num, seed):
+    # Words are taken the same way create_sft_dataset.py picks them, punctuation included
+    with open(path, 'r', encoding='utf-8') as f:
+        words = [word for line in f for word in line.split()]
+    random.Random(seed).shuffle(words)
+    return words[:queries_num]
+
+def time_lookups(lookup_fn, queries):
+    start = time.perf_counter()
+    results = [lookup_fn(query) for query in queries]
+    return results, time.perf_counter() - start
+
+def time_batched_lookups(queries, round_size):
+    start = time.perf_counter()
+    results = []
+    for round_start in range(0, len(queries), round_size):
+        results += spa_to_wayu_dictionary_batch(queries[round_start:round_start+round_size])
+    return results, time.perf_counter() - start
+
+def check_concurrent_lookups(queries):
+    # A fresh dictionary used from several threads at once, the first lookups build the trie and decode the Spanish
+    # text (queries without words) while the others wait for them
+    dictionary = SpanishWayuuDictionary()
+    queries = queries + ['¿', '...', '-'] * threads
+    lookups = [(dictionary.fuzzy_lookup if i % 2 else dictionary.lookup, query) for i, query in enumerate(queries)]
+    with ThreadPoolExecutor(threads) as executor:
+        results = list(executor.map(lambda lookup: lookup[0](lookup[1]), lookups))
+    reference = get_dictionary()
+    expected = [(reference.fuzzy_lookup if i % 2 else reference.lookup)(query) for i, query in enumerate(queries)]
+    assert results == expected, 'Concurrent lookups differ from the sequential ones'
+
+def check_cached_casing():
+    # Results repeat the casing of the call, so a cache hit must not answer a call with another casing
+    tool = {'name': 'spa_to_wayu', 'api': spa_to_wayu_dictionary, 'batch_api': spa_to_wayu_dictionary_batch}
+    calls = ['Xyzzy, casa', 'xyzzy, casa', 'XYZZY, CASA']
+    cache = ToolResultCache()
+    for _ in range(2):
+        assert run_tool_calls([(tool, call) for call in calls], cache=cache) == [spa_to_wayu_dictionary(call) for call in calls]
+
+
+if __name__ == '__main__':
+    queries = load_queries(spanish_val_file, queries_num, seed)
+
+    start = time.perf_counter()
+    get_dictionary()
+    load_time = time.perf_counter() - start
+
+    scan_results, scan_time = time_lookups(spa_to_wayu_dictionary_scan, queries)
+    index_results, index_time = time_lookups(spa_to_wayu_dictionary, queries)
+
+    batch_results, batch_time = time_batched_lookups(queries, round_size)
+    # First fuzzy lookup also builds the trie
+    start = time.perf_counter()
+    get_dictionary().build_trie()
+    trie_time = time.perf_counter() - start
+    fuzzy_results, fuzzy_time = time_lookups(partial(spa_to_wayu_dictionary, mode='fuzzy'), queries)
+    check_concurrent_lookups(queries)
+    check_cached_casing()
+    # Fallback: the exact matches, and the fuzzy ones for the words without exact matches
+    dictionary = get_dictionary()
+    for query in queries:
+        exact = dictionary.lookup(query)
+        assert dictionary.fallback_lookup(query) == (exact or dictionary.fuzzy_lookup(query))
+    fallback_results, fallback_time = time_lookups(partial(spa_to_wayu_dictionary, mode='fallback'), queries)
+
+    # Calls with commas are split into several words by the tool, they never matched anything in the csv scan
+    mismatches = [query for query, scan, index in zip(queries, scan_results, index_results) if scan != index and ',' not in query]
+    assert not mismatches, f'Index lookups differ from the csv scan for: {mismatches[:10]}'
+    mismatches = [query for query, scan, batch in zip(queries, scan_results, batch_results) if scan != batch and ',' not in query]
+    assert not mismatches, f'Batched lookups differ from the csv scan for: {mismatches[:10]}'
+
+    print(f'Queries: {len(queries)}')
+    print(f'Index load time: {load_time*1000:.1f} ms (once per process)')
+    print(f'Csv scan:     {scan_time/len(queries)*1e6:10.1f} us/lookup')
+    print(f'Inverted idx: {index_time/len(queries)*1e6:10.1f} us/lookup')
+    print(f'Batched ({round_size}/round): {batch_time/len(queries)*1e6:6.1f} us/lookup')
+    print(f'Speedup: index {scan_time/index_time:.1f}x, batched {scan_time/batch_time:.1f}x')
+
+    no_matches = ' <matches> No matches found </matches>'
+    print(f'Trie build time: {trie_time*1000:.1f} ms (once per process)')
+    print(f'Fuzzy lookup: {fuzzy_time/len(queries)*1e6:10.1f} us/lookup ({fuzzy_time/index_time:.1f}x the exact lookup)')
+    print(f'Fallback lookup: {fallback_time/len(queries)*1e6:7.1f} us/lookup ({fallback_time/index_time:.1f}x the exact lookup)')
+    print(f'Queries with matches: exact {sum(result != no_matches for result in index_results)}, fuzzy {sum(result != no_matches for result in fuzzy_results)}, fallback {sum(result != no_matches for result in fallback_results)}')
@@ -0,0 +1,115 @@
+import time
+
+import numpy as np
+import torch
+
+from gradient_accumulation import GradientAccumulator
+from token_logprobs import completion_logits, token_log_probs
+
+# The minibatch loop of update_policy on a small random Qwen2 on CPU, with more samples per prompt than a
+# minibatch: the gradients accumulated with GradientAccumulator over every minibatch must be the gradient of the
+# whole batch, and every generated sample is used once per epoch instead of only the first minibatch.
+sims_per_prompt = 12
+prompts_per_step = 2
+minibatch_size = 8
+update_epochs = 2
+accum_grad_steps = 4 # Rollouts per optimizer step in the accumulation run, with update_epochs=1
+prompt_tokens = 16
+completion_tokens = 24
+vocab_size = 1000
+seed = 0
+
+
+def load_model():
+    from transformers import Qwen2Config, Qwen2ForCausalLM
+    torch.manual_seed(seed)
+    config = Qwen2Config(vocab_size=vocab_size, hidden_size=64, intermediate_size=128, num_hidden_layers=2, num_attention_heads=4, num_key_value_heads=2, tie_word_embeddings=True)
+    return Qwen2ForCausalLM(config)
+
+def minibatch_loss(model, complete_prompts, advantages, old_log_probs, rows):
+    # Clipped policy loss of update_policy, mean over the rows of the minibatch
+    logits = completion_logits(model, complete_prompts[rows], completion_tokens)
+    log_probs = token_log_probs(logits, complete_prompts[rows, prompt_tokens:])
+    ratio = (log_probs - old_log_probs[rows]).exp()
+    loss = torch.min(ratio * advantages[rows], ratio.clamp(0.8, 1.2) * advantages[rows])
+    return -(loss.sum(dim=1) / completion_tokens).mean()
+
+def rollout_rows(rollout):
+    # Rows of a stand-in rollout: the same batch, each rollout with its own order and a different half of the rows
+    # repeated, so the rollout gradients differ
+    rows = sims_per_prompt * prompts_per_step
+    order = np.random.default_rng(seed + 100 + rollout).permutation(rows)
+    return np.concatenate((order[:rows//2], order[:rows//2]))
+
+def gradients(model):
+    return torch.cat([parameter.grad.reshape(-1) for parameter in model.parameters() if parameter.grad is not None])
+
+
+if __name__ == '__main__':
+    model = load_model()
+    rows = sims_per_prompt * prompts_per_step
+    generator = torch.Generator().manual_seed(seed)
+    complete_prompts = torch.randint(0, vocab_size, (rows, prompt_tokens + completion_tokens), generator=generator)
+    advantages = torch.randn(rows, 1, generator=generator).expand(rows, completion_tokens)
+    with torch.no_grad():
+        old_log_probs = token_log_probs(completion_logits(model, complete_prompts, completion_tokens), complete_prompts[:, prompt_tokens:])
+
+    # The whole batch in one backward
+    model.zero_grad()
+    minibatch_loss(model, complete_prompts, advantages, old_log_probs, slice(None)).backward()
+    full_gradient = gradients(model).clone()
+
+    # The minibatch loop, one epoch, with the optimizer step left out
+    model.zero_grad()
+    accumulator = GradientAccumulator(model, optimizer=None)
+    batch_indices = np.random.default_rng(seed).permutation(rows)
+    start_time = time.perf_counter()
+    for start in range(0, rows, minibatch_size):
+        minibatch_indices = batch_indices[start:start+minibatch_size]
+        accumulator.backward(minibatch_loss(model, complete_prompts, advantages, old_log_probs, minibatch_indices) * len(minibatch_indices) / rows)
+    epoch_time = time.perf_counter() - start_time
+    accumulated_gradient = gradients(model)
+    error = ((accumulated_gradient - full_gradient).norm() / full_gradient.norm()).item()
+    assert error < 1e-5, f'Accumulated gradients differ from the batch gradient by {error:.1e}'
+
+    # update_epochs steps of the optimizer, one per epoch
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-3)
+    accumulator = GradientAccumulator(model, optimizer)
+    before = [parameter.detach().clone() for parameter in model.parameters()]
+    samples_used = 0
+    optimizer_steps = 0
+    for epoch in range(update_epochs):
+        batch_indices = np.random.default_rng(seed + epoch).permutation(rows)
+        for start in range(0, rows, minibatch_size):
+            minibatch_indices = batch_indices[start:start+minibatch_size]
+            accumulator.backward(minibatch_loss(model, complete_prompts, advantages, old_log_probs, minibatch_indices) * len(minibatch_indices) / rows)
+            samples_used += len(minibatch_indices)
+        optimizer_steps += accumulator.step()
+    assert optimizer_steps == update_epochs and any(not torch.equal(a, b) for a, b in zip(before, model.parameters()))
+
+    # Accumulation across rollouts: accum_grad_steps rollouts of one epoch, the optimizer step left out, give the
+    # mean of their batch gradients and a single weight update
+    model.zero_grad()
+    rollout_gradients = []
+    for rollout in range(accum_grad_steps):
+        minibatch_loss(model, complete_prompts, advantages, old_log_probs, rollout_rows(rollout)).backward()
+        rollout_gradients.append(gradients(model).clone())
+        model.zero_grad()
+    mean_gradient = torch.stack(rollout_gradients).mean(dim=0)
+    accumulator = GradientAccumulator(model, optimizer, accum_grad_steps=accum_grad_steps, max_grad_norm=float('inf'))
+    rollout_steps = []
+    for rollout in range(accum_grad_steps):
+        rows_of_rollout = rollout_rows(rollout)
+        for start in range(0, rows, minibatch_size):
+            minibatch_indices = rows_of_rollout[start:start+minibatch_size]
+            accumulator.backward(minibatch_loss(model, complete_prompts, advantages, old_log_probs, minibatch_indices) * len(minibatch_indices) / rows)
+        if rollout == accum_grad_steps - 1:
+            rollout_error = ((gradients(model) - mean_gradient).norm() / mean_gradient.norm()).item()
+            assert rollout_error < 1e-5, f'Gradients accumulated across rollouts differ from their mean by {rollout_error:.1e}'
+        rollout_steps.append(accumulator.step())
+    assert rollout_steps == [False] * (accum_grad_steps - 1) + [True]
+
+    print(f'{prompts_per_step} prompts x {sims_per_prompt} samples, minibatch_size {minibatch_size}, update_epochs {update_epochs}, cpu')
+    print(f'Accumulated vs batch gradient: relative difference {error:.1e}, {epoch_time*1000:.1f} ms per epoch')
+    print(f'Samples used per generated sample: returning after the first minibatch {minibatch_size/rows:.2f}, every minibatch and epoch {samples_used/rows:.2f} ({optimizer_steps} optimizer steps)')
+    print(f'Accumulated over {accum_grad_steps} rollouts vs their mean gradient: relative difference {rollout_error:.1e}, optimizer steps {rollout_steps}')
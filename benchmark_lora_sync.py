@@ -0,0 +1,277 @@
+import time
+
+from collections import defaultdict
+from types import SimpleNamespace
+
+import torch
+
+from lora_sync import LoRASync
+
+# LoRASync against update_vllm_instance (as it is in the trainers) on stand-ins for a PEFT Qwen2.5-7B style model
+# and the vLLM adapter manager: same weights in vLLM after every sync, adapter activations and latency
+layers_num = 4
+hidden_size = 3584
+intermediate_size = 18944
+kv_size = 512
+rank = 64
+syncs = 5
+accum_grad_steps = 8 # rl steps per optimizer step in the gradient accumulation run
+accumulation_steps = 16
+sample_elements = 16 # Elements per tensor compared by verify(sample_elements=...)
+seed = 0
+
+# Input and output sizes of the projections
+PROJECTIONS = {
+    'self_attn.q_proj': (hidden_size, hidden_size),
+    'self_attn.k_proj': (hidden_size, kv_size),
+    'self_attn.v_proj': (hidden_size, kv_size),
+    'self_attn.o_proj': (hidden_size, hidden_size),
+    'mlp.gate_proj': (hidden_size, intermediate_size),
+    'mlp.up_proj': (hidden_size, intermediate_size),
+    'mlp.down_proj': (intermediate_size, hidden_size),
+}
+VLLM_LAYERS = {
+    'self_attn.qkv_proj': ['self_attn.q_proj', 'self_attn.k_proj', 'self_attn.v_proj'],
+    'self_attn.o_proj': ['self_attn.o_proj'],
+    'mlp.gate_up_proj': ['mlp.gate_proj', 'mlp.up_proj'],
+    'mlp.down_proj': ['mlp.down_proj'],
+}
+
+
+class FakePeftModel:
+    # model.base_model.model with the LoRA parameters of a PEFT model
+    def __init__(self):
+        self.parameters = {}
+        for layer in range(layers_num):
+            for projection, (in_features, out_features) in PROJECTIONS.items():
+                name = f'model.layers.{layer}.{projection}'
+                self.parameters[f'{name}.lora_A.default.weight'] = torch.nn.Parameter(torch.randn(rank, in_features) / rank)
+                self.parameters[f'{name}.lora_B.default.weight'] = torch.nn.Parameter(torch.randn(out_features, rank) / rank)
+        self.base_model = SimpleNamespace(model=self)
+
+    def named_parameters(self):
+        return iter(self.parameters.items())
+
+    def state_dict(self):
+        return {name: parameter.detach() for name, parameter in self.parameters.items()}
+
+    def step(self, fraction=1.0, through_data=False):
+        # Stand-in for optimizer.step(), updates the parameters (the first fraction of them) in place. through_data
+        # updates them through .data, which keeps the version counter and the pointer, as DeepSpeed copying its fp32
+        # partitions back does
+        with torch.no_grad():
+            for parameter in list(self.parameters.values())[:int(fraction * len(self.parameters))]:
+                (parameter.data if through_data else parameter).add_(torch.randn_like(parameter), alpha=1e-3)
+
+class FakeAdapterManager:
+    def __init__(self, adapter_id):
+        loras = {}
+        for layer in range(layers_num):
+            for vllm_layer, projections in VLLM_LAYERS.items():
+                lora_a = [torch.zeros(PROJECTIONS[projection][0], rank, dtype=torch.bfloat16) for projection in projections]
+                lora_b = [torch.zeros(rank, PROJECTIONS[projection][1], dtype=torch.bfloat16) for projection in projections]
+                if len(projections) == 1:
+                    lora_a, lora_b = lora_a[0], lora_b[0]
+                loras[f'model.layers.{layer}.{vllm_layer}'] = SimpleNamespace(lora_a=lora_a, lora_b=lora_b)
+        self.adapters = {adapter_id: SimpleNamespace(loras=loras)}
+        self._active_adapters = {adapter_id: True}
+        self.activations = 0
+
+    def list_adapters(self):
+        return self.adapters
+
+    def deactivate_adapter(self, adapter_id):
+        self._active_adapters.pop(adapter_id, None)
+
+    def activate_adapter(self, adapter_id):
+        # vLLM copies every LoRA weight of the adapter into the stacked weights of its layers (set_lora)
+        weights = vllm_weights(self)
+        if not hasattr(self, 'stacked_weights'):
+            self.stacked_weights = [torch.empty(weight.shape, dtype=weight.dtype) for weight in weights]
+        for stacked_weight, weight in zip(self.stacked_weights, weights):
+            stacked_weight.copy_(weight)
+        self._active_adapters[adapter_id] = True
+        self.activations += 1
+
+def fake_vllm_instance(adapter_id=1):
+    adapter_manager = FakeAdapterManager(adapter_id)
+    lora_manager = SimpleNamespace(_adapter_manager=adapter_manager)
+    return SimpleNamespace(llm_engine=SimpleNamespace(model_executor=SimpleNamespace(driver_worker=SimpleNamespace(model_runner=SimpleNamespace(lora_manager=lora_manager))))), adapter_manager
+
+
+def update_vllm_instance(vllm_instance, model, just_validate=False)->bool:
+    # As it is in grpo_trainer_with_tools.py and grpo_trainer.py
+    adapter_id = 1
+
+    fused_layers_mapping = {
+        'gate_up_proj': ['gate_proj', 'up_proj'],
+        'qkv_proj': ['q_proj', 'k_proj', 'v_proj'],
+    }
+    fused_layers_mapping = defaultdict(lambda: [None], fused_layers_mapping)
+
+    lora_layers = vllm_instance.llm_engine.model_executor.driver_worker.model_runner.lora_manager._adapter_manager.list_adapters()[adapter_id].loras
+    policy_model_state_dict = model.base_model.model.state_dict()
+    adapater_name = 'default'
+    for lora_layer_name in lora_layers:
+        layer_type = lora_layer_name.split('.')[-1]
+        usfused_layers_names = fused_layers_mapping[layer_type]
+
+        for i, unfused_layer_name in enumerate(usfused_layers_names):
+            lora_a_name = lora_layer_name + f'.lora_A.{adapater_name}.weight'
+            lora_b_name = lora_layer_name + f'.lora_B.{adapater_name}.weight'
+
+            # Fix name deviation
+            if unfused_layer_name is not None:
+                lora_a_name = lora_a_name.replace(layer_type, unfused_layer_name)
+                lora_b_name = lora_b_name.replace(layer_type, unfused_layer_name)
+
+            if lora_a_name not in policy_model_state_dict or lora_b_name not in policy_model_state_dict:
+                continue
+            vllm_layer = lora_layers[lora_layer_name]
+
+            hf_layer_lora_a = policy_model_state_dict[lora_a_name]
+            hf_layer_lora_b = policy_model_state_dict[lora_b_name]
+
+            vllm_device = 'cpu'
+            if just_validate:
+                if isinstance(vllm_layer.lora_a, list):
+                    lora_a_is_equal = torch.equal(hf_layer_lora_a.T.to(torch.bfloat16).to(vllm_device), vllm_layer.lora_a[i])
+                    lora_b_is_equal = torch.equal(hf_layer_lora_b.T.to(torch.bfloat16).to(vllm_device), vllm_layer.lora_b[i])
+                else:
+                    lora_a_is_equal = torch.equal(hf_layer_lora_a.T.to(torch.bfloat16).to(vllm_device), vllm_layer.lora_a)
+                    lora_b_is_equal = torch.equal(hf_layer_lora_b.T.to(torch.bfloat16).to(vllm_device), vllm_layer.lora_b)
+
+                assert lora_a_is_equal, f"LoRA A weights do not match for {lora_layer_name} {unfused_layer_name}"
+                assert lora_b_is_equal, f"LoRA B weights do not match for {lora_layer_name} {unfused_layer_name}"
+            else:
+                if isinstance(vllm_layer.lora_a, list):
+                    vllm_layer.lora_a[i] = hf_layer_lora_a.T.to(torch.bfloat16).to(vllm_device)
+                    vllm_layer.lora_b[i] = hf_layer_lora_b.T.to(torch.bfloat16).to(vllm_device)
+                else:
+                    vllm_layer.lora_a = hf_layer_lora_a.T.to(torch.bfloat16).to(vllm_device)
+                    vllm_layer.lora_b = hf_layer_lora_b.T.to(torch.bfloat16).to(vllm_device)
+
+                # Activate the new weights
+                vllm_instance.llm_engine.model_executor.driver_worker.model_runner.lora_manager._adapter_manager.deactivate_adapter(adapter_id)
+                assert adapter_id not in vllm_instance.llm_engine.model_executor.driver_worker.model_runner.lora_manager._adapter_manager._active_adapters, f"Adapter {adapter_id} was not deactivated!"
+                # Update the LoRA weights again for the forward pass
+                vllm_instance.llm_engine.model_executor.driver_worker.model_runner.lora_manager._adapter_manager.activate_adapter(adapter_id)
+
+    return True
+
+def vllm_weights(adapter_manager):
+    weights = []
+    for vllm_layer in adapter_manager.list_adapters()[1].loras.values():
+        for attribute in ('lora_a', 'lora_b'):
+            value = getattr(vllm_layer, attribute)
+            weights.extend(value if isinstance(value, list) else [value])
+    return weights
+
+
+if __name__ == '__main__':
+    torch.manual_seed(seed)
+    model = FakePeftModel()
+    legacy_instance, legacy_manager = fake_vllm_instance()
+    sync_instance, sync_manager = fake_vllm_instance()
+    lora_sync = LoRASync(sync_instance, model)
+
+    legacy_times, sync_times = [], []
+    for _ in range(syncs):
+        model.step()
+        start = time.perf_counter()
+        update_vllm_instance(legacy_instance, model)
+        legacy_times.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        lora_sync.sync()
+        sync_times.append(time.perf_counter() - start)
+
+        assert all(torch.equal(legacy, synced) for legacy, synced in zip(vllm_weights(legacy_manager), vllm_weights(sync_manager))), 'Weights differ from update_vllm_instance'
+        assert update_vllm_instance(sync_instance, model, just_validate=True)
+    stats = lora_sync.pop_stats()
+    assert stats['syncs'] == syncs and sync_manager.activations == syncs
+
+    megabytes = sum(weight.nbytes for weight in vllm_weights(sync_manager)) / 2**20
+    # The first sync builds the map
+    print(f'{layers_num} layers, rank {rank}, {len(lora_sync.slots)} LoRA tensors, {megabytes:.1f} MiB in bf16, weights identical after {syncs} syncs')
+    print(f'update_vllm_instance: {1000*sum(legacy_times[1:])/(syncs-1):7.1f} ms/sync, {legacy_manager.activations//syncs} adapter activations/sync')
+    print(f'LoRASync:             {1000*sum(sync_times[1:])/(syncs-1):7.1f} ms/sync, {sync_manager.activations//syncs} adapter activations/sync (first sync with the map {1000*sync_times[0]:.1f} ms)')
+
+    # Gradient accumulation: the optimizer steps every accum_grad_steps rl steps, once updating half the tensors
+    legacy_time = sync_time = 0.0
+    optimizer_steps = 0
+    for rl_step in range(accumulation_steps):
+        if (rl_step + 1) % accum_grad_steps == 0:
+            model.step(fraction=0.5 if optimizer_steps == 0 else 1.0)
+            optimizer_steps += 1
+        start = time.perf_counter()
+        update_vllm_instance(legacy_instance, model)
+        legacy_time += time.perf_counter() - start
+        start = time.perf_counter()
+        lora_sync.sync()
+        sync_time += time.perf_counter() - start
+        assert all(torch.equal(legacy, synced) for legacy, synced in zip(vllm_weights(legacy_manager), vllm_weights(sync_manager))), 'Weights differ from update_vllm_instance'
+    stats = lora_sync.pop_stats()
+    assert stats['syncs'] == optimizer_steps and stats['skipped_syncs'] == accumulation_steps - optimizer_steps
+    print(f'{accumulation_steps} rl steps, optimizer step every {accum_grad_steps} (the first on half the tensors):')
+    print(f'update_vllm_instance: {1000*legacy_time/accumulation_steps:7.1f} ms/step, {megabytes*accumulation_steps:7.1f} MiB copied')
+    print(f'LoRASync:             {1000*sync_time/accumulation_steps:7.1f} ms/step, {stats["copied_bytes"]/2**20:7.1f} MiB copied, {stats["skipped_syncs"]} syncs skipped')
+
+    # Updates that keep the version counter and the pointer are synced too
+    model.step(through_data=True)
+    lora_sync.sync()
+    assert update_vllm_instance(sync_instance, model, just_validate=True), 'Updates through .data were not synced'
+    assert lora_sync.pop_stats()['copied_bytes'] == megabytes * 2**20
+
+    # Verification after a sync: checksums, sampled elements, and the full comparisons
+    model.step()
+    start = time.perf_counter()
+    lora_sync.sync()
+    full_sync_time = time.perf_counter() - start
+    verify_times = {}
+    for name, verify in [
+        ('checksums', lambda: lora_sync.verify()),
+        (f'checksums + {sample_elements} sampled elements', lambda: lora_sync.verify(sample_elements=sample_elements)),
+        ('full (verify(full=True))', lambda: lora_sync.verify(full=True)),
+        ('update_vllm_instance(just_validate=True)', lambda: update_vllm_instance(sync_instance, model, just_validate=True)),
+    ]:
+        start = time.perf_counter()
+        assert verify()
+        verify_times[name] = time.perf_counter() - start
+    # Corrupted weights in vLLM and parameters changed after the sync are caught
+    name, parameter, buffer, *_ = lora_sync.slots[len(lora_sync.slots) // 2]
+    original = buffer[0, 0].clone()
+    buffer[0, 0] += 1
+    try:
+        lora_sync.verify()
+        raise RuntimeError('Corrupted weights were not detected')
+    except AssertionError as error:
+        detected_corruption = str(error)
+    buffer[0, 0] = original
+    model.step(fraction=0.1)
+    try:
+        lora_sync.verify()
+        raise RuntimeError('Unsynced parameters were not detected')
+    except AssertionError as error:
+        detected_unsynced = str(error)
+    lora_sync.sync()
+    # A copy that was skipped or failed, the buffer keeps the previous weights
+    name, parameter, buffer, *_ = lora_sync.slots[0]
+    previous = buffer.clone()
+    model.step()
+    lora_sync.sync()
+    buffer.copy_(previous)
+    try:
+        lora_sync.verify()
+        raise RuntimeError('A skipped copy was not detected')
+    except AssertionError as error:
+        detected_skipped = str(error)
+    # The periodic check of the trainer repairs it with a full resync
+    lora_sync.pop_stats()
+    assert not lora_sync.verify_or_resync(sample_elements=sample_elements)
+    assert lora_sync.pop_stats()['copied_bytes'] == megabytes * 2**20
+    assert lora_sync.verify_or_resync(sample_elements=sample_elements) and lora_sync.verify(full=True)
+
+    print(f'Verification after a full sync ({1000*full_sync_time:.1f} ms):')
+    for name, verify_time in verify_times.items():
+        print(f'  {name:45s} {1000*verify_time:7.1f} ms ({verify_time/full_sync_time:.0%} of a sync)')
+    print(f'Detected: "{detected_corruption}", "{detected_unsynced}", "{detected_skipped}"')
@@ -0,0 +1,116 @@
+import time
+
+import numpy as np
+import torch
+
+from packed_sequences import pack_rows, packed_logits
+from token_logprobs import completion_logits, token_log_probs
+
+# The policy forward of update_policy on a small random Qwen2 on CPU, on minibatches of left padded prompts with
+# completions of different lengths: packed into one row without padding the log-probs and gradients of the
+# generated tokens must match the padded forward, which also spends compute on the padding. The padding share is
+# estimated on datasets/dev.es prompts with datasets/dev.guc answers as completions.
+minibatch_size = 8
+vocab_size = 1000
+pad_token_id = vocab_size - 1
+eos_token_id = vocab_size - 2
+prompt_overhead_tokens = 100 # Instructions of translate_prompt_template_tool and the chat template
+chars_per_token = 3.0 # When the tokenizer is not available locally
+base_model_name = 'Qwen/Qwen2.5-3B-Instruct'
+spanish_file = 'datasets/dev.es'
+wayuu_file = 'datasets/dev.guc'
+minibatches = 200
+atol = 1e-4
+seed = 0
+
+
+def load_model(attn_implementation):
+    from transformers import Qwen2Config, Qwen2ForCausalLM
+    torch.manual_seed(seed)
+    config = Qwen2Config(vocab_size=vocab_size, hidden_size=64, intermediate_size=128, num_hidden_layers=2, num_attention_heads=4, num_key_value_heads=2, tie_word_embeddings=True)
+    config._attn_implementation = attn_implementation
+    return Qwen2ForCausalLM(config)
+
+def dataset_lengths():
+    # Prompt and completion tokens of every dev sentence, from the tokenizer when it is cached
+    with open(spanish_file) as f:
+        spanish = [line.strip() for line in f]
+    with open(wayuu_file) as f:
+        wayuu = [f'<answer> {line.strip()} </answer>' for line in f]
+    try:
+        from transformers import AutoTokenizer
+        tokenizer = AutoTokenizer.from_pretrained(base_model_name, local_files_only=True)
+        count = lambda texts: np.array([len(ids) for ids in tokenizer(texts)['input_ids']])
+        source = f'{base_model_name} tokenizer'
+    except Exception:
+        count = lambda texts: np.array([int(np.ceil(len(text) / chars_per_token)) for text in texts])
+        source = f'estimated at {chars_per_token} chars per token, tokenizer not available'
+    return count(spanish) + prompt_overhead_tokens, count(wayuu) + 1, source
+
+def make_minibatch(prompt_lengths, completion_lengths, generator):
+    # Rows as update_policy gets them: left padded prompts followed by completions ending in eos and padded
+    prompt_length, max_tokens = int(prompt_lengths.max()), int(completion_lengths.max())
+    complete_prompts = torch.full((len(prompt_lengths), prompt_length + max_tokens), pad_token_id)
+    completion_mask = torch.zeros(len(prompt_lengths), max_tokens)
+    for i, (prompt_tokens, completion_tokens) in enumerate(zip(prompt_lengths.tolist(), completion_lengths.tolist())):
+        complete_prompts[i, prompt_length-prompt_tokens:prompt_length] = torch.randint(0, vocab_size - 2, (prompt_tokens,), generator=generator)
+        complete_prompts[i, prompt_length:prompt_length+completion_tokens-1] = torch.randint(0, vocab_size - 2, (completion_tokens - 1,), generator=generator)
+        complete_prompts[i, prompt_length+completion_tokens-1] = eos_token_id
+        completion_mask[i, :completion_tokens] = 1
+    return complete_prompts, prompt_length, completion_mask
+
+def padded_log_probs(model, complete_prompts, prompt_length, completion_mask):
+    # The forward of update_policy over the padded minibatch
+    max_tokens = completion_mask.shape[1]
+    attention_mask = ((complete_prompts != pad_token_id).cumsum(dim=1) > 0).long()
+    position_ids = (attention_mask.cumsum(dim=1) - 1).clamp(min=0)
+    logits = completion_logits(model, complete_prompts, max_tokens, attention_mask=attention_mask, position_ids=position_ids)
+    return token_log_probs(logits, complete_prompts[:, prompt_length:]) * completion_mask
+
+def packed_log_probs(model, complete_prompts, prompt_length, completion_mask):
+    packed = pack_rows(complete_prompts, prompt_length, completion_mask, pad_token_id)
+    flat = token_log_probs(packed_logits(model, packed), packed.completion_ids)[0]
+    return torch.zeros(completion_mask.shape).masked_scatter(completion_mask.bool(), flat)
+
+def gradients(model):
+    return torch.cat([parameter.grad.reshape(-1) for parameter in model.parameters() if parameter.grad is not None])
+
+def forward_backward(model, log_probs_fn, *minibatch):
+    model.zero_grad()
+    start = time.perf_counter()
+    log_probs = log_probs_fn(model, *minibatch)
+    log_probs.sum().backward()
+    return log_probs.detach(), gradients(model).clone(), time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    prompt_lengths, completion_lengths, source = dataset_lengths()
+    rng = np.random.default_rng(seed)
+    generator = torch.Generator().manual_seed(seed)
+
+    # Share of the padded minibatch that is padding, rows drawn from different prompts as with prompts_per_step > 1
+    padded_tokens = real_tokens = 0
+    for _ in range(minibatches):
+        rows = rng.choice(len(prompt_lengths), minibatch_size)
+        padded_tokens += minibatch_size * (prompt_lengths[rows].max() + completion_lengths[rows].max())
+        real_tokens += (prompt_lengths[rows] + completion_lengths[rows]).sum()
+    padding = 1 - real_tokens / padded_tokens
+
+    # Equivalence and time on one minibatch with lengths of the dataset, scaled down for the CPU
+    rows = rng.choice(len(prompt_lengths), minibatch_size)
+    minibatch = make_minibatch(torch.tensor(prompt_lengths[rows]) // 2, torch.tensor(completion_lengths[rows]), generator)
+    for attn_implementation in ['eager', 'sdpa']:
+        model = load_model(attn_implementation)
+        padded, padded_gradient, padded_time = forward_backward(model, padded_log_probs, *minibatch)
+        packed, packed_gradient, packed_time = forward_backward(model, packed_log_probs, *minibatch)
+        error = (packed - padded).abs().max().item()
+        gradient_error = ((packed_gradient - padded_gradient).norm() / padded_gradient.norm()).item()
+        assert error < atol, f'{attn_implementation}: packed log-probs differ from the padded ones by {error:.1e}'
+        assert gradient_error < atol, f'{attn_implementation}: packed gradients differ from the padded ones by {gradient_error:.1e}'
+        print(f'{attn_implementation}: max log-prob difference {error:.1e}, relative gradient difference {gradient_error:.1e}, forward+backward padded {padded_time*1000:.1f} ms, packed {packed_time*1000:.1f} ms')
+
+    complete_prompts, prompt_length, completion_mask = minibatch
+    packed_tokens = pack_rows(complete_prompts, prompt_length, completion_mask, pad_token_id).input_ids.shape[1]
+    print(f'Benchmark minibatch of {minibatch_size} rows: {complete_prompts.numel()} padded tokens, {packed_tokens} packed')
+    print(f'Lengths of {spanish_file}/{wayuu_file} ({source}): prompts {prompt_lengths.mean():.0f} tokens on average, completions {completion_lengths.mean():.0f}')
+    print(f'Padding removed by packing, {minibatches} minibatches of {minibatch_size} rows: {padding:.1%} of the tokens')
@@ -0,0 +1,68 @@
+import math
+import time
+
+import numpy as np
+import torch
+
+from token_logprobs import batched_log_probs, completion_logits, token_log_probs
+
+# Ref forward passes of one update on a small random Qwen2 on CPU: once per minibatch and epoch, as update_policy
+# did, against once per rollout with batched_log_probs. The cached log-probs must match the per-minibatch ones.
+rows = 32 # sims_per_prompt x prompts_per_step
+minibatch_size = 8
+update_epochs = 2
+prompt_tokens = 96
+completion_tokens = 64
+temperature = 0.9
+logprob_chunk_size = 64
+seed = 0
+
+
+def load_model():
+    from transformers import Qwen2Config, Qwen2ForCausalLM
+    torch.manual_seed(seed)
+    config = Qwen2Config(vocab_size=32000, hidden_size=128, intermediate_size=256, num_hidden_layers=2, num_attention_heads=4, num_key_value_heads=2, tie_word_embeddings=True)
+    return Qwen2ForCausalLM(config).eval()
+
+def ref_logits_fn(ref_model, complete_prompts):
+    def logits_fn(rows):
+        ref_logits = completion_logits(ref_model, complete_prompts[rows], completion_tokens)
+        ref_logits /= temperature
+        return ref_logits
+    return logits_fn
+
+
+if __name__ == '__main__':
+    ref_model = load_model()
+    generator = torch.Generator().manual_seed(seed)
+    complete_prompts = torch.randint(0, 32000, (rows, prompt_tokens + completion_tokens), generator=generator)
+    generations = complete_prompts[:, prompt_tokens:]
+    logits_fn = ref_logits_fn(ref_model, complete_prompts)
+    np.random.seed(seed)
+
+    # One ref pass per minibatch of every epoch
+    start = time.perf_counter()
+    per_minibatch = torch.empty(rows, completion_tokens)
+    per_minibatch_passes = 0
+    for epoch in range(update_epochs):
+        batch_indices = np.arange(rows)
+        np.random.shuffle(batch_indices)
+        for minibatch_start in range(0, rows, minibatch_size):
+            minibatch_indices = batch_indices[minibatch_start:minibatch_start+minibatch_size]
+            with torch.no_grad():
+                per_minibatch[minibatch_indices] = token_log_probs(logits_fn(minibatch_indices), generations[minibatch_indices], chunk_size=logprob_chunk_size)
+            per_minibatch_passes += 1
+    per_minibatch_time = time.perf_counter() - start
+
+    # Once per rollout
+    start = time.perf_counter()
+    cached = batched_log_probs(logits_fn, generations, batch_size=minibatch_size, chunk_size=logprob_chunk_size)
+    cached_passes = math.ceil(rows / minibatch_size)
+    cached_time = time.perf_counter() - start
+
+    assert torch.allclose(cached, per_minibatch, atol=1e-5), 'Cached ref log-probs differ from the per-minibatch ones'
+    print(f'{rows} x ({prompt_tokens} prompt + {completion_tokens} completion) tokens, minibatch_size {minibatch_size}, update_epochs {update_epochs}, cpu')
+    print(f'Per minibatch and epoch: {per_minibatch_passes:3} ref forward passes, {per_minibatch_time*1000:7.1f} ms')
+    print(f'Once per rollout:        {cached_passes:3} ref forward passes, {cached_time*1000:7.1f} ms')
+    print(f'Saved per step: {per_minibatch_passes - cached_passes} passes, {(per_minibatch_time - cached_time)*1000:.1f} ms, max difference {(cached - per_minibatch).abs().max().item():.1e}')
+    print(f'log_kl=False with no_kl or dr_grpo: 0 ref forward passes, {per_minibatch_passes} saved')
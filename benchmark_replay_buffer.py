@@ -0,0 +1,75 @@
+import time
+
+import numpy as np
+import torch
+
+from replay_buffer import ReplayBuffer
+
+# Rollouts of random lengths stored for several steps, checked row by row after spilling and sampling, and the
+# memory per 1k rollouts against keeping the trainer's tensors (int32 ids and terminals, uint8 mask, float32 the rest)
+steps = 12
+rows = 64 # sims_per_prompt x prompts_per_step
+max_steps = 8
+in_memory_steps = 2
+batch_size = 256
+pad_token_id = 0
+seed = 0
+
+
+def make_step(rng):
+    prompt_length = int(rng.integers(80, 160))
+    completion_length = int(rng.integers(64, 320))
+    complete_prompts = torch.from_numpy(rng.integers(1, 150000, (rows, prompt_length + completion_length), dtype=np.int32))
+    lengths = torch.from_numpy(rng.integers(1, completion_length, rows))
+    is_terminal = (torch.arange(completion_length)[None, :] >= lengths[:, None]).int()
+    complete_prompts[:, prompt_length:][is_terminal.bool()] = pad_token_id
+    advantages = torch.randn(rows, 1) * (1 - is_terminal)
+    rewards = torch.zeros(rows, completion_length)
+    rewards[torch.arange(rows), lengths.clamp(max=completion_length-1)] = torch.rand(rows)
+    mask = torch.from_numpy(rng.integers(0, 2, (rows, completion_length), dtype=np.uint8))
+    old_log_probs = -torch.rand(rows, completion_length)
+    return complete_prompts, prompt_length, is_terminal, advantages, rewards, mask, old_log_probs
+
+def tensors_bytes(step):
+    return sum(value.numel() * value.element_size() for value in step if torch.is_tensor(value))
+
+
+if __name__ == '__main__':
+    rng = np.random.default_rng(seed)
+    buffer = ReplayBuffer(pad_token_id, max_steps=max_steps, in_memory_steps=in_memory_steps)
+    added = []
+    for _ in range(steps):
+        step = make_step(rng)
+        buffer.add(step[0], step[1], step[2], step[3], rewards=step[4], mask=step[5], old_log_probs=step[6])
+        added.append(step)
+    kept = added[-max_steps:]
+    stats = buffer.stats()
+    assert stats['steps'] == max_steps and len(buffer) == max_steps * rows
+
+    start = time.perf_counter()
+    batch = buffer.sample(batch_size, rng=rng)
+    sample_time = time.perf_counter() - start
+    prompt_length = batch['prompt_length']
+    for k in range(batch_size):
+        # Every sampled row, without its padding, is the stored row
+        step_id = int(batch['step_ids'][k])
+        complete_prompts, step_prompt_length, is_terminal, advantages, rewards, mask, old_log_probs = added[step_id]
+        completion_length = advantages.shape[1]
+        matches = [
+            (complete_prompts == batch['complete_prompts'][k, prompt_length-step_prompt_length:prompt_length+completion_length]).all(dim=1),
+            (is_terminal == batch['is_terminal'][k, :completion_length]).all(dim=1),
+            (mask == batch['mask'][k, :completion_length]).all(dim=1),
+            (advantages == batch['advantages'][k, :completion_length]).all(dim=1),
+            (old_log_probs == batch['old_log_probs'][k, :completion_length]).all(dim=1),
+        ]
+        assert (torch.stack(matches).all(dim=0)).any(), f'Row {k} of step {step_id} differs from the stored rollout'
+        assert (batch['is_terminal'][k, completion_length:] == 1).all() and (batch['advantages'][k, completion_length:] == 0).all()
+    assert (batch['generations'] == batch['complete_prompts'][:, prompt_length:]).all()
+    assert len(set(batch['step_ids'].tolist())) > 1, 'Sampled rows come from a single step'
+
+    tensors_per_1k = sum(tensors_bytes(step) for step in kept) * 1000 // len(buffer)
+    print(f'{max_steps} steps x {rows} rollouts kept, {in_memory_steps} in memory')
+    print(f'Trainer tensors: {tensors_per_1k/2**20:7.1f} MiB per 1k rollouts')
+    print(f'Replay buffer:   {stats["bytes_per_1k_rollouts"]/2**20:7.1f} MiB per 1k rollouts ({tensors_per_1k/stats["bytes_per_1k_rollouts"]:.1f}x less), {stats["in_memory_bytes"]/2**20:.1f} MiB in memory, {stats["spilled_bytes"]/2**20:.1f} MiB spilled')
+    print(f'Sampling {batch_size} rollouts from {len(set(batch["step_ids"].tolist()))} steps: {sample_time*1e3:.1f} ms')
+    buffer.close()
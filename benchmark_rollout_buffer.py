@@ -0,0 +1,84 @@
+import random
+import time
+
+import torch
+
+from advantages import get_eos_index, get_is_terminal
+from rollout_buffer import RolloutBuffer
+
+# Appends the segments of a tool loop rollout with lists, as the loop did before, and with RolloutBuffer
+sequences_num = 64
+rounds_num = 4
+prompt_tokens = 150
+segment_tokens = 200 # Tokens generated per round
+tool_result_tokens = 60
+pad_token_id = 0
+repeats = 20
+seed = 0
+
+
+def make_segments(rng):
+    # Per round and sequence the generated tokens and the tool result tokens, with their text
+    return [[
+        ([rng.randrange(1, 150000) for _ in range(rng.randint(segment_tokens // 2, segment_tokens))],
+         [rng.randrange(1, 150000) for _ in range(tool_result_tokens)])
+        for _ in range(sequences_num)] for _ in range(rounds_num)]
+
+def run_lists(prompts, segments):
+    inputs = [list(prompt) for prompt in prompts]
+    mask = [[1] * len(prompt) for prompt in prompts]
+    responses = [""] * len(prompts)
+    for round_segments in segments:
+        for j, (token_ids, result_ids) in enumerate(round_segments):
+            responses[j] += 'generated text' + ' <matches> result </matches>'
+            inputs[j] += list(token_ids) + result_ids
+            mask[j] += [1] * len(token_ids) + [0] * len(result_ids)
+    max_length = max([len(ids) for ids in inputs])
+    generation_ids = [ids + [pad_token_id]*(max_length-len(ids)) for ids in inputs]
+    mask = [m + [0]*(max_length-len(m)) for m in mask]
+    return torch.tensor(generation_ids), torch.tensor(mask)
+
+def run_buffer(prompts, segments):
+    buffer = RolloutBuffer(prompts, pad_token_id, max_new_tokens=segment_tokens)
+    for round_segments in segments:
+        # The engine takes the prompts of every round as lists
+        prompt_token_ids = [buffer.token_ids(j) for j in range(len(buffer))]
+        for j, (token_ids, result_ids) in enumerate(round_segments):
+            buffer.append(j, token_ids, text='generated text')
+            buffer.append(j, result_ids, mask_value=0, text=' <matches> result </matches>')
+    return buffer.tensors()
+
+def check_is_terminal(rng):
+    # Prompts of different lengths, left padded by the buffer, and completions ending in an eos: the eos must be found
+    # in the completion columns, the left padding of the shorter prompts is not part of it
+    eos_token_id = 1
+    prompts = [[rng.randrange(2, 150000) for _ in range(rng.randint(5, prompt_tokens))] for _ in range(sequences_num)]
+    buffer = RolloutBuffer(prompts, pad_token_id, max_new_tokens=segment_tokens)
+    for j in range(len(buffer)):
+        buffer.append(j, [rng.randrange(2, 150000) for _ in range(rng.randint(0, segment_tokens - 1))] + [eos_token_id])
+    ids, _ = buffer.tensors()
+    completions = ids[:, buffer.prompt_length:]
+    eos_index = get_eos_index(get_is_terminal(completions, pad_token_id))
+    assert torch.equal(eos_index, torch.from_numpy(buffer.lengths - buffer.prompt_length - 1))
+    assert (completions[torch.arange(len(completions)), eos_index] == eos_token_id).all()
+
+def time_runs(run_fn, prompts, segments):
+    start = time.perf_counter()
+    for _ in range(repeats):
+        result = run_fn(prompts, segments)
+    return result, (time.perf_counter() - start) / repeats
+
+
+if __name__ == '__main__':
+    rng = random.Random(seed)
+    prompts = [[rng.randrange(1, 150000) for _ in range(prompt_tokens)] for _ in range(sequences_num)]
+    segments = make_segments(rng)
+    check_is_terminal(rng)
+
+    (list_ids, list_mask), list_time = time_runs(run_lists, prompts, segments)
+    (buffer_ids, buffer_mask), buffer_time = time_runs(run_buffer, prompts, segments)
+    assert torch.equal(list_ids, buffer_ids.long()) and torch.equal(list_mask, buffer_mask.long())
+
+    print(f'{sequences_num} sequences x {rounds_num} rounds, {list_ids.shape[1]} tokens after padding')
+    print(f'Lists:         {list_time*1000:7.2f} ms/batch, {list_ids.element_size()*list_ids.nelement() + list_mask.element_size()*list_mask.nelement():9d} bytes of tensors')
+    print(f'RolloutBuffer: {buffer_time*1000:7.2f} ms/batch, {buffer_ids.element_size()*buffer_ids.nelement() + buffer_mask.element_size()*buffer_mask.nelement():9d} bytes of tensors ({list_time/buffer_time:.1f}x)')
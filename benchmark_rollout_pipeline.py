@@ -0,0 +1,75 @@
+import threading
+import time
+
+from collections import Counter
+
+from rollout_pipeline import RolloutProducer
+
+# Serial loop (rollout, update, sync) against the pipelined one, with sleeps standing in for the inference engine
+# and the trainer
+steps = 20
+rollout_seconds = 0.05
+update_seconds = 0.04
+sync_seconds = 0.005
+max_pending = 1
+
+
+class FakeEngine:
+    # Fails if a weight sync runs while a rollout is being generated
+    def __init__(self):
+        self.busy = threading.Lock()
+        self.version = 0
+
+    def rollout(self):
+        assert self.busy.acquire(blocking=False), 'Rollout overlapped a weight sync'
+        try:
+            time.sleep(rollout_seconds)
+            return self.version
+        finally:
+            self.busy.release()
+
+    def sync(self):
+        assert self.busy.acquire(blocking=False), 'Weight sync overlapped a rollout'
+        try:
+            time.sleep(sync_seconds)
+            self.version += 1
+        finally:
+            self.busy.release()
+
+def update(rollout):
+    time.sleep(update_seconds)
+
+def run_serial():
+    engine = FakeEngine()
+    start = time.perf_counter()
+    for _ in range(steps):
+        rollout = engine.rollout()
+        update(rollout)
+        engine.sync()
+    return time.perf_counter() - start
+
+def run_pipelined():
+    engine = FakeEngine()
+    staleness = Counter()
+    start = time.perf_counter()
+    producer = RolloutProducer(engine.rollout, max_pending=max_pending).start()
+    try:
+        for _ in range(steps):
+            engine_version, version = producer.get()
+            assert engine_version == version, 'Version of the rollout does not match the engine weights'
+            staleness[producer.staleness(version)] += 1
+            update(engine_version)
+            producer.sync(engine.sync)
+    finally:
+        producer.close()
+    return time.perf_counter() - start, staleness
+
+
+if __name__ == '__main__':
+    serial_time = run_serial()
+    pipelined_time, staleness = run_pipelined()
+    assert max(staleness) <= max_pending + 1, f'Rollouts too stale: {staleness}'
+    print(f'{steps} steps, rollout {rollout_seconds*1e3:.0f} ms, update {update_seconds*1e3:.0f} ms, sync {sync_seconds*1e3:.0f} ms')
+    print(f'Serial:    {serial_time:.2f} s')
+    print(f'Pipelined: {pipelined_time:.2f} s ({serial_time/pipelined_time:.2f}x)')
+    print(f'Staleness (policy updates: steps): {dict(sorted(staleness.items()))}')
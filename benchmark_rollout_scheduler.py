@@ -0,0 +1,162 @@
+import logging
+import random
+import time
+import zlib
+
+from types import SimpleNamespace
+
+from tool_execution import run_tool_calls, encode_tool_result
+from tool_rollout import generate_with_tools
+
+# Checks the per-sequence continuation loop of tool_rollout.py against the previous loop, which sent every
+# sequence to the engine on every round, using a fake engine whose outputs only depend on the input ids
+samples_num = 512
+actions_num = 4
+tool_call_prob = 0.5
+truncation_prob = 0.05
+# Simulated engine cost per generated token, the fake engine itself is almost free
+seconds_per_token = 2e-6
+group_size = 8 # Samples per prompt (sims_per_prompt in the trainer)
+seed = 0
+
+TOOLS = [
+    {
+        'name': 'echo',
+        'api': lambda api_args: f' <result> {api_args[::-1]} </result>',
+        'start_token': '<echo>',
+        'end_token': '</echo>',
+    },
+]
+
+
+class FakeTokenizer:
+    eos_token = '</s>'
+    eos_token_id = 0
+    pad_token_id = 0
+
+    def encode(self, text, return_tensors=None):
+        return [ord(char) for char in text]
+
+class FakeSamplingParams:
+    def __init__(self, n=1):
+        self.n = n
+
+    def clone(self):
+        return FakeSamplingParams(self.n)
+
+class FakeEngine:
+    def __init__(self):
+        self.generated_tokens = 0
+        self.prefill_tokens = 0
+
+    def complete(self, prompt_token_ids, sample_index=0):
+        rng = random.Random(zlib.crc32(bytes(token_id % 256 for token_id in prompt_token_ids)) + sample_index)
+        words = ' '.join(rng.choice(['casa', 'perro', 'agua', 'sol', 'camino']) for _ in range(rng.randint(1, 8)))
+        draw = rng.random()
+        if draw < tool_call_prob:
+            text, finish_reason, stop_reason = f'Buscar {TOOLS[0]["start_token"]} {words} ', 'stop', TOOLS[0]['end_token']
+        elif draw < tool_call_prob + truncation_prob:
+            text, finish_reason, stop_reason = f'Respuesta larga {words}', 'length', None
+        else:
+            text, finish_reason, stop_reason = f'Respuesta: {words}', 'stop', None
+        token_ids = [ord(char) for char in text]
+        self.generated_tokens += len(token_ids)
+        return SimpleNamespace(outputs=[SimpleNamespace(text=text, token_ids=token_ids, finish_reason=finish_reason, stop_reason=stop_reason)])
+
+    def generate(self, prompt_token_ids, sampling_params=None, lora_request=None, use_tqdm=None):
+        # Like vLLM, the n samples of a prompt share its prefill
+        n = sampling_params.n if sampling_params is not None else 1
+        self.prefill_tokens += sum(len(token_ids) for token_ids in prompt_token_ids)
+        outputs = [self.complete(token_ids) for token_ids in prompt_token_ids]
+        if n > 1:
+            outputs = [SimpleNamespace(outputs=[self.complete(token_ids, k).outputs[0] for k in range(n)]) for token_ids in prompt_token_ids]
+        time.sleep(sum(len(output.outputs[0].token_ids) for output in outputs) * seconds_per_token)
+        return outputs
+
+
+def legacy_generate_with_tools(model, tokenizer, inputs, sampling_params, tools, stop_tokens, actions_num=1, lora_request=None, use_tqdm=None, tool_cache=None):
+    # Loop as it was in grpo_trainer_with_tools.py before the per-sequence scheduler
+    dones = [False] * len(inputs)
+    mask = [[1] * len(input_ids) for input_ids in inputs]
+    responses = [""] * len(inputs)
+    for action_step in range(actions_num + 1 if len(tools) > 0 else 1):
+        outputs = model.generate(prompt_token_ids=inputs, sampling_params=sampling_params, lora_request=lora_request, use_tqdm=use_tqdm)
+
+        tool_calls = []
+        for j, output in enumerate(outputs):
+            if dones[j]:
+                continue
+            for tool in tools:
+                if output.outputs[0].stop_reason == tool['end_token'] and tool['start_token'] in output.outputs[0].text:
+                    api_args = output.outputs[0].text.split(tool['start_token'])[1].strip()
+                    tool_calls.append((j, tool, api_args))
+                    break
+        api_results = run_tool_calls([(tool, api_args) for _, tool, api_args in tool_calls], cache=tool_cache)
+
+        for (j, tool, api_args), api_result in zip(tool_calls, api_results):
+            output = outputs[j]
+            responses[j] += output.outputs[0].text + f"{tool['end_token']}" + api_result
+            api_result_tokens = encode_tool_result(tokenizer, tool, api_args, api_result, cache=tool_cache)
+            inputs[j] += list(output.outputs[0].token_ids) + api_result_tokens
+            mask[j] += [1] * len(output.outputs[0].token_ids) + [0] * len(api_result_tokens)
+
+        for j, output in enumerate(outputs):
+            if dones[j]:
+                continue
+            if output.outputs[0].finish_reason == "stop" and output.outputs[0].stop_reason is None:
+                responses[j] += output.outputs[0].text
+                inputs[j] += list(output.outputs[0].token_ids)
+                dones[j] = True
+                mask[j] += [1] * len(output.outputs[0].token_ids)
+            elif output.outputs[0].stop_reason not in stop_tokens:
+                responses[j] += tokenizer.eos_token
+                inputs[j] += [tokenizer.eos_token_id]
+                mask[j] += [1]
+                dones[j] = True
+    return responses, inputs, mask
+
+def run(generate_fn, prompts):
+    engine = FakeEngine()
+    tokenizer = FakeTokenizer()
+    stop_tokens = [tool['end_token'] for tool in TOOLS] + [tokenizer.eos_token]
+    inputs = [tokenizer.encode(prompt) for prompt in prompts]
+    start = time.perf_counter()
+    result = generate_fn(engine, tokenizer, inputs, None, TOOLS, stop_tokens, actions_num=actions_num)
+    return result, engine.generated_tokens, time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    # Truncated answers are expected here
+    logging.getLogger('tool_rollout').setLevel(logging.ERROR)
+    rng = random.Random(seed)
+    prompts = [f'Traduce la frase {i}: ' + ' '.join(rng.choice(['el', 'la', 'casa', 'grande', 'río']) for _ in range(6)) for i in range(samples_num)]
+
+    (legacy_responses, legacy_inputs, legacy_mask), legacy_tokens, legacy_time = run(legacy_generate_with_tools, prompts)
+    (buffer, stats), tokens, scheduler_time = run(generate_with_tools, prompts)
+    responses, inputs, mask = buffer.responses(), buffer.sequences(), buffer.masks()
+
+    assert responses == legacy_responses, 'Responses differ from the previous loop'
+    assert inputs == legacy_inputs, 'Token ids differ from the previous loop'
+    # The eos appended to unfinished answers is masked out of the loss now, it was not sampled
+    legacy_mask = [row_mask[:-1] + [0] if response.endswith(FakeTokenizer.eos_token) else row_mask for response, row_mask in zip(legacy_responses, legacy_mask)]
+    assert mask == legacy_mask, 'Masks differ from the previous loop'
+    assert stats['generated_tokens'] == tokens
+
+    print(f'Samples: {samples_num}, generation rounds: {stats["generation_rounds"]}, tool calls/sample: {sum(stats["tool_calls"])/samples_num:.2f}, unfinished: {stats["unfinished_answers"]}')
+    print(f'Previous loop: {legacy_tokens:8d} generated tokens, {legacy_time:.2f} s')
+    print(f'Per-sequence:  {tokens:8d} generated tokens, {scheduler_time:.2f} s')
+    print(f'Generated tokens saved: {1 - tokens/legacy_tokens:.1%}, speedup {legacy_time/scheduler_time:.2f}x')
+
+    # Samples of the same prompt: duplicated prompts against SamplingParams n
+    tokenizer = FakeTokenizer()
+    stop_tokens = [tool['end_token'] for tool in TOOLS] + [tokenizer.eos_token]
+    group_prompts = [tokenizer.encode(prompt) for prompt in prompts[:samples_num // group_size]]
+    engine = FakeEngine()
+    duplicated_buffer, _ = generate_with_tools(engine, tokenizer, [list(prompt) for prompt in group_prompts for _ in range(group_size)], FakeSamplingParams(), TOOLS, stop_tokens, actions_num=actions_num)
+    duplicated_prefill = engine.prefill_tokens
+    engine = FakeEngine()
+    shared_buffer, shared_stats = generate_with_tools(engine, tokenizer, group_prompts, FakeSamplingParams(), TOOLS, stop_tokens, actions_num=actions_num, num_samples=group_size)
+    assert len(shared_buffer) == len(duplicated_buffer) == len(group_prompts) * group_size
+    assert all(shared_buffer.token_ids(j)[:len(group_prompts[j // group_size])] == group_prompts[j // group_size] for j in range(len(shared_buffer)))
+    assert len(set(tuple(shared_buffer.token_ids(j)) for j in range(group_size))) > 1, 'Samples of a prompt are identical'
+    print(f'{len(group_prompts)} prompts x {group_size} samples, prompt tokens prefilled: duplicated {duplicated_prefill}, n={group_size} {engine.prefill_tokens}')
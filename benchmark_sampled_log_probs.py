@@ -0,0 +1,78 @@
+import time
+
+import torch
+
+from hf_generation import generate_samples
+from token_logprobs import completion_logits, token_log_probs
+
+# Log-probs of the sampled tokens captured by generate_samples(return_logprobs=True) on a small random Qwen2 on CPU,
+# checked against the ones update_policy recomputes with a forward pass (old_model), for left padded prompts with
+# several samples each and rows that finish early. Also the cost of capturing them against the forward pass they save.
+vocab_size = 1000
+prompts = 4
+num_samples = 4
+max_new_tokens = 32
+temperature = 0.9
+eos_token_id = list(range(20)) # Frequent enough for some rows to finish
+pad_token_id = vocab_size - 1
+atol = 1e-4
+seed = 0
+
+
+def load_model():
+    from transformers import Qwen2Config, Qwen2ForCausalLM
+    torch.manual_seed(seed)
+    config = Qwen2Config(vocab_size=vocab_size, hidden_size=64, intermediate_size=128, num_hidden_layers=2, num_attention_heads=4, num_key_value_heads=2, tie_word_embeddings=True)
+    return Qwen2ForCausalLM(config).eval()
+
+def left_padded_prompts(generator):
+    lengths = torch.randint(8, 24, (prompts,), generator=generator)
+    input_ids = torch.full((prompts, int(lengths.max())), pad_token_id)
+    attention_mask = torch.zeros_like(input_ids)
+    for i, length in enumerate(lengths.tolist()):
+        input_ids[i, -length:] = torch.randint(20, vocab_size - 1, (length,), generator=generator)
+        attention_mask[i, -length:] = 1
+    return input_ids, attention_mask
+
+
+if __name__ == '__main__':
+    model = load_model()
+    generator = torch.Generator().manual_seed(seed)
+    input_ids, attention_mask = left_padded_prompts(generator)
+    sampling_args = dict(do_sample=True, temperature=temperature, top_k=0, top_p=1.0, max_new_tokens=max_new_tokens, eos_token_id=eos_token_id, pad_token_id=pad_token_id)
+
+    with torch.no_grad():
+        torch.manual_seed(seed)
+        start = time.perf_counter()
+        sequences, log_probs = generate_samples(model, input_ids, attention_mask, num_samples=num_samples, return_logprobs=True, **sampling_args)
+        capture_time = time.perf_counter() - start
+        torch.manual_seed(seed)
+        start = time.perf_counter()
+        plain_sequences = generate_samples(model, input_ids, attention_mask, num_samples=num_samples, **sampling_args)
+        generate_time = time.perf_counter() - start
+        assert torch.equal(sequences, plain_sequences), 'return_logprobs changed the samples'
+
+        # The old_model pass of update_policy
+        start = time.perf_counter()
+        steps = log_probs.shape[1]
+        full_attention_mask = torch.cat((attention_mask.repeat_interleave(num_samples, dim=0), torch.ones(len(sequences), steps, dtype=attention_mask.dtype)), dim=1)
+        position_ids = full_attention_mask.cumsum(-1) - 1
+        position_ids.masked_fill_(full_attention_mask == 0, 1)
+        logits = completion_logits(model, sequences, steps, attention_mask=full_attention_mask, position_ids=position_ids)
+        logits /= temperature
+        recomputed = token_log_probs(logits, sequences[:, -steps:])
+        forward_time = time.perf_counter() - start
+
+    # Positions up to the eos of every row, the rest is padding with log-prob 0
+    tokens = sequences[:, -steps:]
+    is_eos = torch.isin(tokens, torch.tensor(eos_token_id))
+    generated = (is_eos.cumsum(dim=1) - is_eos.int()) == 0
+    finished_rows = int(is_eos.any(dim=1).sum())
+    assert 0 < finished_rows < len(sequences), 'Every row should not finish at the same time'
+    error = (log_probs - recomputed).abs()[generated].max().item()
+    assert error < atol, f'Captured log-probs differ from the recomputed ones by {error:.1e}'
+    assert (log_probs[~generated] == 0).all()
+
+    print(f'{prompts} prompts x {num_samples} samples, {max_new_tokens} new tokens, {finished_rows} rows finished early, cpu')
+    print(f'Max difference with the recomputed log-probs: {error:.1e} over {int(generated.sum())} tokens (atol {atol})')
+    print(f'Generation {generate_time*1000:.1f} ms, with log-probs {capture_time*1000:.1f} ms, old_model forward saved {forward_time*1000:.1f} ms')
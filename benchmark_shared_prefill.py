@@ -0,0 +1,80 @@
+import multiprocessing
+import resource
+import time
+
+import torch
+
+from hf_generation import generate_samples
+
+# Prefill time and peak memory of sampling a group of completions from one prompt on the HF path: the prompt
+# repeated num_samples times (as make_rollouts did) against one prefill shared through hf_generation
+model_name = None # A causal LM from the hub, None builds a small random Qwen2 so the benchmark runs offline
+prompt_tokens = 512
+num_samples = 16 # sims_per_prompt
+max_new_tokens = 16
+repeats = 3
+seed = 0
+
+
+def load_model():
+    from transformers import AutoModelForCausalLM, Qwen2Config, Qwen2ForCausalLM
+    torch.manual_seed(seed)
+    if model_name is not None:
+        return AutoModelForCausalLM.from_pretrained(model_name, torch_dtype='auto', device_map='auto').eval()
+    config = Qwen2Config(vocab_size=32000, hidden_size=512, intermediate_size=1408, num_hidden_layers=8, num_attention_heads=8, num_key_value_heads=2)
+    model = Qwen2ForCausalLM(config).eval()
+    return model.to('cuda') if torch.cuda.is_available() else model
+
+def peak_memory_bytes():
+    if torch.cuda.is_available():
+        return torch.cuda.max_memory_allocated()
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def run(path, queue):
+    # Each path runs in its own process so the peak memory of one does not hide the other
+    model = load_model()
+    input_ids = torch.randint(3, model.config.vocab_size, (1, prompt_tokens), generator=torch.Generator().manual_seed(seed)).to(model.device)
+    attention_mask = torch.ones_like(input_ids)
+    generate_kwargs = dict(do_sample=False, max_new_tokens=max_new_tokens, min_new_tokens=max_new_tokens, pad_token_id=0)
+    # Warm up with a short prompt
+    model.generate(input_ids=input_ids[:, :8], attention_mask=attention_mask[:, :8], max_new_tokens=2, pad_token_id=0)
+    if torch.cuda.is_available():
+        torch.cuda.reset_peak_memory_stats()
+    base_memory = peak_memory_bytes()
+
+    # Generation first, so the peak memory is the one of generate
+    with torch.no_grad():
+        start = time.perf_counter()
+        if path == 'repeated':
+            generations = model.generate(input_ids=input_ids.repeat(num_samples, 1), attention_mask=attention_mask.repeat(num_samples, 1), **generate_kwargs)
+        else:
+            generations = generate_samples(model, input_ids, attention_mask, num_samples=num_samples, **generate_kwargs)
+        generate_time = time.perf_counter() - start
+        peak_memory = peak_memory_bytes() - base_memory
+
+        prefill_times = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            if path == 'repeated':
+                model.get_decoder()(input_ids=input_ids.repeat(num_samples, 1), use_cache=True)
+            else:
+                model.get_decoder()(input_ids=input_ids, use_cache=True)
+            prefill_times.append(time.perf_counter() - start)
+    queue.put((min(prefill_times), generate_time, peak_memory, generations.cpu()))
+
+
+if __name__ == '__main__':
+    context = multiprocessing.get_context('spawn')
+    results = {}
+    for path in ('repeated', 'shared'):
+        queue = context.Queue()
+        process = context.Process(target=run, args=(path, queue))
+        process.start()
+        results[path] = queue.get()
+        process.join()
+
+    assert torch.equal(results['repeated'][3], results['shared'][3]), 'Greedy generations differ'
+    print(f'Prompt of {prompt_tokens} tokens, {num_samples} samples, {max_new_tokens} new tokens, {"cuda" if torch.cuda.is_available() else "cpu"}')
+    for path, (prefill_time, generate_time, peak_memory, _) in results.items():
+        print(f'{path:9} prefill {prefill_time*1000:8.1f} ms, generate {generate_time*1000:8.1f} ms, peak memory +{peak_memory/2**20:7.1f} MiB')
+    print(f'Prefill speedup {results["repeated"][0]/results["shared"][0]:.1f}x, generate speedup {results["repeated"][1]/results["shared"][1]:.1f}x')
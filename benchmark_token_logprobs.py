@@ -0,0 +1,84 @@
+import multiprocessing
+import queue as queue_module
+import resource
+import time
+
+import torch
+
+from token_logprobs import token_log_probs
+
+# Peak memory and time of the token log-probs of update_policy (policy with grad and ref without) on random logits
+# with Qwen's vocabulary on CPU, on top of the logits themselves: softmax, index and log as the trainers did, against
+# token_log_probs without and with chunks. Values are compared with log_softmax in float64.
+vocab_size = 151936
+batch_size = 4 # minibatch_size
+completion_tokens = 128
+chunk_size = 32
+temperature = 0.9
+seed = 0
+
+
+def softmax_log_probs(logits, completion_ids):
+    # As update_policy computed them before token_log_probs
+    actual_minibatch_size, max_tokens = completion_ids.shape
+    completion_ids = completion_ids.reshape(-1)
+    probs = torch.nn.functional.softmax(logits.reshape(actual_minibatch_size*max_tokens,-1), dim=1)
+    probs_tokens = probs[torch.arange(len(completion_ids)), completion_ids].reshape(actual_minibatch_size, max_tokens)
+    return torch.log(probs_tokens)
+
+def run(path, queue):
+    generator = torch.Generator().manual_seed(seed)
+    shape = (batch_size, completion_tokens, vocab_size)
+    completion_ids = torch.randint(0, vocab_size, shape[:2], generator=generator)
+    advantages = torch.randn(batch_size, 1, generator=generator)
+    if path == 'softmax':
+        log_probs_fn = softmax_log_probs
+    else:
+        log_probs_fn = lambda logits, ids: token_log_probs(logits, ids, chunk_size=chunk_size if path == 'chunked' else None)
+    # Logits of the completion as update_policy slices them, the policy ones requiring grad
+    logits = (3 * torch.randn(shape, generator=generator)).requires_grad_()
+    ref_logits = 3 * torch.randn(shape, generator=generator)
+    log_probs_fn(ref_logits[:1, :8], completion_ids[:1, :8]) # Warm up
+    base_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    start = time.perf_counter()
+    with torch.no_grad():
+        log_ref_probs = log_probs_fn(ref_logits / temperature, completion_ids)
+    log_probs = log_probs_fn(logits / temperature, completion_ids)
+    loss = -((log_probs - log_probs.detach()).exp() * advantages).sum()
+    loss.backward()
+    step_time = time.perf_counter() - start
+    peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 - base_memory
+
+    with torch.no_grad():
+        reference = torch.log_softmax(logits.double() / temperature, dim=-1).gather(-1, completion_ids.unsqueeze(-1)).squeeze(-1)
+        ref_reference = torch.log_softmax(ref_logits.double() / temperature, dim=-1).gather(-1, completion_ids.unsqueeze(-1)).squeeze(-1)
+    # As numpy arrays, torch would share the tensors through the memory of the exiting process
+    queue.put((step_time, peak_memory, log_probs.detach().numpy(), log_ref_probs.numpy(), reference.numpy(), ref_reference.numpy(), logits.grad.numpy()))
+
+if __name__ == '__main__':
+    context = multiprocessing.get_context('spawn')
+    results = {}
+    for path in ('softmax', 'log_softmax', 'chunked'):
+        queue = context.Queue()
+        process = context.Process(target=run, args=(path, queue))
+        process.start()
+        while path not in results:
+            try:
+                step_time, peak_memory, *arrays = queue.get(timeout=1)
+                results[path] = (step_time, peak_memory, *map(torch.from_numpy, arrays))
+            except queue_module.Empty:
+                if not process.is_alive():
+                    raise RuntimeError(f'The {path} run exited with code {process.exitcode}, out of memory?')
+        process.join()
+
+    for path, (_, _, log_probs, log_ref_probs, reference, ref_reference, gradient) in results.items():
+        assert torch.allclose(log_probs.double(), reference, atol=1e-4), f'{path} log-probs differ from log_softmax'
+        assert torch.allclose(log_ref_probs.double(), ref_reference, atol=1e-4), f'{path} ref log-probs differ from log_softmax'
+        assert torch.allclose(gradient, results['softmax'][6], rtol=1e-3, atol=1e-7), f'{path} gradients differ'
+
+    print(f'{batch_size} x {completion_tokens} completion tokens, vocab {vocab_size}, chunks of {chunk_size}, cpu')
+    for path, (step_time, peak_memory, log_probs, _, reference, *_) in results.items():
+        error = (log_probs.double() - reference).abs().max().item()
+        print(f'{path:11} {step_time*1000:8.1f} ms, peak memory +{peak_memory/2**20:7.1f} MiB, max error {error:.1e}')
+    print(f'Peak memory reduction: log_softmax {results["softmax"][1]/results["log_softmax"][1]:.1f}x, chunked {results["softmax"][1]/results["chunked"][1]:.1f}x')
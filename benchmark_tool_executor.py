@@ -0,0 +1,69 @@
+import random
+import time
+
+from tool_execution import ToolExecutor, ToolResultCache, run_tool_calls, TOOL_TIMEOUT_RESULT
+
+# Runs rounds of slow tool calls serially and on the thread pool, and checks results come back in row order
+rounds_num = 5
+calls_per_round = 64 # Sequences that stop on a tool call in the same round
+min_latency = 0.005
+max_latency = 0.05
+tool_threads = 16
+tool_timeout = 0.2
+seed = 0
+
+def make_slow_tool(name):
+    def api(api_args):
+        latency, value = api_args.split()
+        time.sleep(float(latency))
+        return f' <result> {value} </result>'
+    return {'name': name, 'api': api, 'start_token': f'<{name}>', 'end_token': f'</{name}>'}
+
+TOOLS = [make_slow_tool('slow_a'), make_slow_tool('slow_b')]
+
+
+def make_rounds(rng):
+    return [
+        [(rng.choice(TOOLS), f'{rng.uniform(min_latency, max_latency):.4f} {round_index}-{call_index}') for call_index in range(calls_per_round)]
+        for round_index in range(rounds_num)
+    ]
+
+
+if __name__ == '__main__':
+    rounds = make_rounds(random.Random(seed))
+
+    start = time.perf_counter()
+    serial_results = [run_tool_calls(tool_calls) for tool_calls in rounds]
+    serial_time = time.perf_counter() - start
+
+    executor = ToolExecutor(max_workers=tool_threads, timeout=tool_timeout)
+    start = time.perf_counter()
+    pool_results = [run_tool_calls(tool_calls, executor=executor) for tool_calls in rounds]
+    pool_time = time.perf_counter() - start
+    stats = executor.pop_stats()
+    assert pool_results == serial_results, 'Pool results are not in row order'
+
+    # A call that hangs is answered with the timeout result once the round deadline passes
+    hanging_round = [(TOOLS[0], '0.01 fast'), (TOOLS[1], '5 hanging'), (TOOLS[0], '0.01 fast')]
+    start = time.perf_counter()
+    hanging_results = run_tool_calls(hanging_round, executor=executor)
+    hanging_time = time.perf_counter() - start
+    assert hanging_results == [' <result> fast </result>', TOOL_TIMEOUT_RESULT, ' <result> fast </result>']
+    assert hanging_time < tool_timeout + 0.1, f'Round with a hanging call took {hanging_time:.2f} s'
+    assert executor.pop_stats()['timeouts'] == 1
+
+    # Rounds where no sample calls a tool, or where every call is in the cache, run nothing
+    cache = ToolResultCache()
+    cached_round = hanging_round[:1]
+    run_tool_calls(cached_round, cache=cache, executor=executor)
+    executor.pop_stats()
+    assert run_tool_calls([], executor=executor) == []
+    assert run_tool_calls(cached_round, cache=cache, executor=executor) == [' <result> fast </result>']
+    assert executor.run([]) == [] and executor.pop_stats()['rounds'] == 0
+
+    print(f'Rounds: {rounds_num} x {calls_per_round} calls, {tool_threads} threads')
+    print(f'Serial:      {serial_time/rounds_num*1000:7.1f} ms/round')
+    print(f'Thread pool: {pool_time/rounds_num*1000:7.1f} ms/round ({serial_time/pool_time:.1f}x)')
+    print(f'Pool stats: {stats}')
+    print(f'Round with a hanging call: {hanging_time*1000:.1f} ms (timeout {tool_timeout*1000:.0f} ms)')
+    executor.pool.shutdown(wait=False, cancel_futures=True)
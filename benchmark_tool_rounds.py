@@ -0,0 +1,91 @@
+import random
+import time
+
+from dictionary_tool import format_matches, get_dictionary, spa_to_wayu_dictionary
+
+spanish_val_file = 'datasets/dev.es'
+samples_num = 1000
+actions_num = 4 # Same as action_calls in the trainer and actions_num in evaluation
+# Latency of one model.generate round over the batch. Assumed here, set it to the one measured on the target
+# hardware: the wall-clock per sample of the whole tool loop is projected with it
+generation_round_seconds = 1.0
+seed = 0
+no_matches = format_matches([])
+
+
+def load_samples(path, samples_num, seed):
+    with open(path, 'r', encoding='utf-8') as f:
+        lines = [line.strip() for line in f if line.strip()]
+    random.Random(seed).shuffle(lines)
+    return lines[:samples_num]
+
+def pick_words(spa, rng):
+    # Same word selection as create_sft_dataset.py
+    num_searches = rng.randint(0, 4)
+    spa_words = spa.split()
+    rng.shuffle(spa_words)
+    return spa_words[:num_searches] if len(spa_words) >= num_searches else []
+
+def old_spa_to_wayu_dictionary(spanish_word, max_matches=5):
+    # The tool before phrase and comma separated calls: the call is looked up as a single word
+    return format_matches(get_dictionary().lookup(spanish_word, max_matches))
+
+def run_per_word(tool_fn, words):
+    # One tool call, and so one generation round, per word plus the round that writes the answer
+    calls = words[:actions_num]
+    for word in calls:
+        tool_fn(word)
+    return len(calls) + 1
+
+def run_batched(tool_fn, words):
+    # A single call with every word plus the round that writes the answer
+    if len(words) == 0:
+        return 1
+    tool_fn(', '.join(word.strip(',') for word in words))
+    return 2
+
+def check_outputs(samples, samples_words, rng):
+    """
+    The new tool returns the old output for every call, except comma separated calls and phrases without matches,
+    which the old tool always answered with no matches because the Spanish side of the csv has no commas. Returns
+    the number of calls checked and of those that changed.
+    """
+    calls = [word for words in samples_words for word in words]
+    for spa in samples:
+        spa_words = spa.split()
+        start = rng.randrange(len(spa_words))
+        calls += [' '.join(spa_words[start:start+rng.randint(2, 4)]), spa]
+    calls += [', '.join(word.strip(',') for word in words) for words in samples_words if len(words) > 1]
+    changed = 0
+    for call in calls:
+        old, new = old_spa_to_wayu_dictionary(call), spa_to_wayu_dictionary(call)
+        if old == new:
+            continue
+        assert ',' in call or (old == no_matches and len(call.split()) > 1), f'Output changed for {call!r}: {old!r} -> {new!r}'
+        assert old == no_matches, f'Old output of {call!r} had matches: {old!r}'
+        changed += 1
+    return len(calls), changed
+
+
+if __name__ == '__main__':
+    samples = load_samples(spanish_val_file, samples_num, seed)
+    rng = random.Random(seed)
+    samples_words = [pick_words(spa, rng) for spa in samples]
+    # Warm up the dictionary so its load time is not counted
+    spa_to_wayu_dictionary('casa')
+
+    checked, changed = check_outputs(samples, samples_words, random.Random(seed))
+    print(f'{checked} calls checked against the old tool, {changed} changed (comma separated calls and phrases without matches, all no matches before)')
+
+    wall_clock = {}
+    for name, run_fn, tool_fn in (
+        ('Old tool, per word calls', run_per_word, old_spa_to_wayu_dictionary),
+        ('New tool, per word calls', run_per_word, spa_to_wayu_dictionary),
+        ('New tool, batched calls', run_batched, spa_to_wayu_dictionary),
+    ):
+        start = time.perf_counter()
+        rounds = sum(run_fn(tool_fn, words) for words in samples_words)
+        tool_time = time.perf_counter() - start
+        wall_clock[name] = (rounds*generation_round_seconds + tool_time) / len(samples)
+        print(f'{name}: {rounds/len(samples):.2f} generation rounds/sample, {tool_time/len(samples)*1000:.3f} ms of tool time/sample, {wall_clock[name]:.3f} s/sample projected')
+    print(f'Projected wall-clock with {generation_round_seconds} s per generation round (assumed): old {wall_clock["Old tool, per word calls"]:.3f} s/sample, batched {wall_clock["New tool, batched calls"]:.3f} s/sample ({wall_clock["Old tool, per word calls"]/wall_clock["New tool, batched calls"]:.2f}x)')
@@ -0,0 +1,110 @@
+import ast
+import operator
+from functools import lru_cache
+from logging import getLogger
+
+logger = getLogger(__name__)
+
+# Limits that keep every expression cheap: an evaluation can never build a number larger than MAX_INT_BITS
+MAX_EXPRESSION_LENGTH = 1000
+MAX_INT_BITS = 4096
+MAX_EXPONENT = 1000
+CACHE_SIZE = 4096
+
+BINARY_OPERATORS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.FloorDiv: operator.floordiv,
+    ast.Mod: operator.mod,
+    ast.Pow: operator.pow,
+}
+UNARY_OPERATORS = {
+    ast.UAdd: operator.pos,
+    ast.USub: operator.neg,
+}
+# Same builtins the eval based calculator allowed
+SAFE_FUNCTIONS = {
+    'abs': abs,
+    'min': min,
+    'max': max,
+    'sum': sum,
+}
+
+
+class CalculatorError(ValueError):
+    pass
+
+def check_number(value):
+    value_type = type(value)
+    if value_type is not int and value_type is not float:
+        raise CalculatorError(f'unsupported value of type {type(value).__name__}')
+    if value_type is int and value.bit_length() > MAX_INT_BITS:
+        raise CalculatorError(f'number larger than {MAX_INT_BITS} bits')
+    return value
+
+def check_operands(op, left, right):
+    # Rejects the operations whose result would be too large before computing them
+    if op is ast.Pow:
+        if abs(right) > MAX_EXPONENT and abs(left) not in (0, 1):
+            raise CalculatorError(f'exponent larger than {MAX_EXPONENT}')
+        if isinstance(left, int) and isinstance(right, int) and right > 0 and (left.bit_length() - 1) * right >= MAX_INT_BITS:
+            raise CalculatorError(f'number larger than {MAX_INT_BITS} bits')
+    elif op is ast.Mult and isinstance(left, int) and isinstance(right, int):
+        if left.bit_length() + right.bit_length() > MAX_INT_BITS + 1:
+            raise CalculatorError(f'number larger than {MAX_INT_BITS} bits')
+
+def evaluate_node(node, names):
+    node_type = type(node)
+    if node_type is ast.Constant:
+        return check_number(node.value)
+    if node_type is ast.BinOp and type(node.op) in BINARY_OPERATORS:
+        left = check_number(evaluate_node(node.left, names))
+        right = check_number(evaluate_node(node.right, names))
+        if type(node.op) in (ast.Pow, ast.Mult):
+            check_operands(type(node.op), left, right)
+        return check_number(BINARY_OPERATORS[type(node.op)](left, right))
+    if isinstance(node, ast.UnaryOp) and type(node.op) in UNARY_OPERATORS:
+        return UNARY_OPERATORS[type(node.op)](check_number(evaluate_node(node.operand, names)))
+    if isinstance(node, (ast.List, ast.Tuple)):
+        return [evaluate_node(element, names) for element in node.elts]
+    if isinstance(node, ast.Name):
+        if node.id in names:
+            return check_number(names[node.id])
+        raise CalculatorError(f"name '{node.id}' is not defined")
+    if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in SAFE_FUNCTIONS and not node.keywords:
+        args = [evaluate_node(arg, names) for arg in node.args]
+        return check_number(SAFE_FUNCTIONS[node.func.id](*args))
+    raise CalculatorError(f'unsupported expression {type(node).__name__}')
+
+def evaluate_expression(code_str, names=None):
+    """
+    Evaluates an arithmetic expression without eval: numbers, + - * / // % **, parentheses, abs, min, max and sum
+    over lists, and the names given in names. Any other syntax, and any number over MAX_INT_BITS bits or exponent
+    over MAX_EXPONENT, raises an exception, so every call runs in bounded time.
+    """
+    if len(code_str) > MAX_EXPRESSION_LENGTH:
+        raise CalculatorError(f'expression longer than {MAX_EXPRESSION_LENGTH} characters')
+    return check_number(evaluate_node(ast.parse(code_str.strip(), mode='eval').body, names or {}))
+
+@lru_cache(maxsize=CACHE_SIZE)
+def calculate(code_str):
+    try:
+        return ' <execution_result> ' + str(evaluate_expression(code_str)) + ' </execution_result>'
+    except Exception as e:
+        return f" <execution_result> Error: {e} </execution_result>"
+
+def calculator_tool(code_str, allowed_names=None):
+    if allowed_names:
+        # Results depend on the names, so they are not cached
+        try:
+            result = ' <execution_result> ' + str(evaluate_expression(code_str, allowed_names)) + ' </execution_result>'
+        except Exception as e:
+            return f" <execution_result> Error: {e} </execution_result>"
+    else:
+        result = calculate(code_str)
+        if result.startswith(' <execution_result> Error:'):
+            return result
+    logger.info(f'CORRECT USE OF CALCULATOR TOOL. Code: {code_str}, Result: {result}')
+    return result
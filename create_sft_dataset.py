@@ -1,27 +1,8 @@
-import re
 from torch.utils.data import Dataset, DataLoader
 import pickle
 import random
 from tqdm import tqdm
-
-def spa_to_wayu_dictionary(spanish_word, max_matches=5):
-    dictionary_path = 'assets/spanish_to_wayuunaiki_short.csv'
-
-    with open(dictionary_path, 'r', encoding='utf-8') as f:
-        all_matches = []
-        line = f.readline()
-        while line != '' and len(all_matches) < max_matches:
-            data = line.strip().split(',')
-            if re.search(rf'\b{re.escape(spanish_word)}\b', data[0], re.IGNORECASE):
-                all_matches.append(data)
-            line = f.readline()
-
-    if len(all_matches) > 0:
-        result = " <matches> " + '\n'.join(f'{spa}: {wayuu}' for spa, wayuu in all_matches) + " </matches>"
-    else:
-        result = " <matches> No matches found </matches>"
-
-    return result
+from dictionary_tool import spa_to_wayu_dictionary
 
 class TextDataset(Dataset):
     def __init__(self, spa_path, wayuu_path):
@@ -43,6 +24,7 @@ class TextDataset(Dataset):
 spanish_train_file = 'datasets/train.es.txt'
 wayuu_train_file = 'datasets/train.guc.txt'
 batch_size = 1000
+batched_searches = False # Look up all the words in a single dictionary call, separated by commas
 dataset_size_to_create = 59715
 steps = dataset_size_to_create / batch_size
 
@@ -57,6 +39,13 @@ Once you have all the information you need, provide the final translation enclos
 
 Spanish text: {}"""
 
+translate_prompt_template_tool_batched="""Translate the following Spanish text into Wayuunaiki.
+Begin by identifying any words or phrases you're unsure how to translate. Then, you may look up those words using the dictionary tool by wrapping them in <spa_to_wayuu> and </spa_to_wayuu>.
+You can look up several words in the same call by separating them with commas, for example <spa_to_wayuu> casa, perro </spa_to_wayuu>. The dictionary will return the matches of every word enclosed in <matches> and </matches>.
+Once you have all the information you need, provide the final translation enclosed in <answer> and </answer>. For example: <answer> xxx </answer>.
+
+Spanish text: {}"""
+
 # Create the dataset
 dataset = []
 i = 0
@@ -64,7 +53,10 @@ for (spa_batch, wayuu_batch) in tqdm(dataloader):
     if i > steps:
         break
     for spa, wayuu in zip(spa_batch, wayuu_batch):
-        prompt = translate_prompt_template_tool.format(spa)
+        if batched_searches:
+            prompt = translate_prompt_template_tool_batched.format(spa)
+        else:
+            prompt = translate_prompt_template_tool.format(spa)
 
         # Make random searches in the dictionary, between 0 and 4
         num_searches = random.randint(0, 4)
@@ -73,9 +65,14 @@ for (spa_batch, wayuu_batch) in tqdm(dataloader):
         answer = ''
         if len(spa_words) >= num_searches:
             words_to_translate = spa_words[:num_searches]
-            for word in words_to_translate:
-                translation = spa_to_wayu_dictionary(word)
-                answer += f' <spa_to_wayuu> {word} </spa_to_wayuu>' + translation
+            if batched_searches and len(words_to_translate) > 0:
+                words = ', '.join(word.strip(',') for word in words_to_translate)
+                translation = spa_to_wayu_dictionary(words)
+                answer += f' <spa_to_wayuu> {words} </spa_to_wayuu>' + translation
+            else:
+                for word in words_to_translate:
+                    translation = spa_to_wayu_dictionary(word)
+                    answer += f' <spa_to_wayuu> {word} </spa_to_wayuu>' + translation
         answer += f' <answer> {wayuu} </answer>'
 
         dataset.append((prompt, answer))
@@ -0,0 +1,424 @@
+import hashlib
+import heapq
+import mmap
+import os
+import re
+import struct
+import threading
+import unicodedata
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+from itertools import accumulate
+from logging import getLogger
+
+logger = getLogger(__name__)
+
+DICTIONARY_PATH = 'assets/spanish_to_wayuunaiki_short.csv'
+
+# Same notion of "word" as the \b boundaries used by the lookup regex
+WORD_PATTERN = re.compile(r'\w+')
+# Shortest prefix or stem considered by the fuzzy lookup mode
+MIN_PREFIX_LENGTH = 3
+LOOKUP_MODES = ['exact', 'fuzzy', 'fallback']
+
+
+def fold(word):
+    # Accent and case insensitive form of a word: canción, CANCION -> cancion
+    return ''.join(char for char in unicodedata.normalize('NFKD', word) if not unicodedata.combining(char)).casefold()
+
+def format_matches(all_matches):
+    if len(all_matches) > 0:
+        return " <matches> " + '\n'.join(f'{spa}: {wayuu}' for spa, wayuu in all_matches) + " </matches>"
+    return " <matches> No matches found </matches>"
+
+
+# Binary format of the compiled dictionary. All the integers are native unsigned 32 bits; after the header come
+# key_offsets[num_keys+1], posting_offsets[num_keys+1], postings[num_postings], line_offsets[num_rows+1],
+# spanish_offsets[num_rows+1] and then the key, line and Spanish UTF-8 blobs. Keys are the lowercased words of the
+# Spanish side sorted by code point, postings are row ids in file order.
+BINARY_MAGIC = b'SPWY'
+BINARY_VERSION = 1
+BYTE_ORDER_MARK = 0x01020304
+HEADER = struct.Struct('=4sII32s6I')
+
+def get_binary_path(dictionary_path):
+    return os.path.splitext(dictionary_path)[0] + '.bin'
+
+def get_csv_digest(dictionary_path):
+    with open(dictionary_path, 'rb') as f:
+        return hashlib.sha256(f.read()).digest()
+
+def build_dictionary_binary(dictionary_path=DICTIONARY_PATH, binary_path=None):
+    """
+    Compiles the csv dictionary into the binary format read by SpanishWayuuDictionary.
+    Every line of the csv (header included, as the original scan did) is a row. The file is written to a
+    temporary path and moved into place, so processes reading the previous version are not affected.
+    """
+    binary_path = binary_path or get_binary_path(dictionary_path)
+    with open(dictionary_path, 'rb') as f:
+        csv_bytes = f.read()
+
+    # Same line splitting as reading the csv in text mode (universal new lines)
+    lines = csv_bytes.decode('utf-8').replace('\r\n', '\n').replace('\r', '\n').split('\n')
+    if lines[-1] == '':
+        lines.pop()
+    lines = [line.strip() for line in lines]
+    spanish_texts = [line.split(',')[0] for line in lines]
+    index = defaultdict(list)
+    for row_id, spanish_text in enumerate(spanish_texts):
+        for word in set(WORD_PATTERN.findall(spanish_text.lower())):
+            index[word].append(row_id)
+    keys = sorted(index)
+
+    def encode_strings(strings, separator=b''):
+        offsets = array('I', [0])
+        blob = bytearray()
+        for string in strings:
+            blob += string.encode('utf-8')
+            offsets.append(len(blob))
+            blob += separator
+        return offsets, bytes(blob)
+
+    key_offsets, key_blob = encode_strings(keys)
+    posting_offsets = array('I', [0])
+    postings = array('I')
+    for key in keys:
+        postings.extend(index[key])
+        posting_offsets.append(len(postings))
+    line_offsets, line_blob = encode_strings(lines)
+    # Spanish texts are separated by new lines so the blob can be searched as a whole for queries without words
+    spanish_offsets, spanish_blob = encode_strings(spanish_texts, separator=b'\n')
+
+    header = HEADER.pack(BINARY_MAGIC, BINARY_VERSION, BYTE_ORDER_MARK, hashlib.sha256(csv_bytes).digest(),
+                         len(lines), len(keys), len(postings), len(key_blob), len(line_blob), len(spanish_blob))
+    tmp_path = f'{binary_path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(header)
+        for section in (key_offsets, posting_offsets, postings, line_offsets, spanish_offsets):
+            section.tofile(f)
+        f.write(key_blob)
+        f.write(line_blob)
+        f.write(spanish_blob)
+    os.replace(tmp_path, binary_path)
+    logger.info(f'Dictionary {dictionary_path} compiled into {binary_path}: {len(lines)} rows, {len(keys)} keys')
+    return binary_path
+
+def read_binary_header(binary_path):
+    with open(binary_path, 'rb') as f:
+        header = f.read(HEADER.size)
+    if len(header) < HEADER.size:
+        return None
+    return HEADER.unpack(header)
+
+def binary_is_up_to_date(dictionary_path, binary_path):
+    if not os.path.exists(binary_path):
+        return False
+    header = read_binary_header(binary_path)
+    if header is None:
+        return False
+    magic, version, byte_order_mark, csv_digest = header[:4]
+    if magic != BINARY_MAGIC or version != BINARY_VERSION or byte_order_mark != BYTE_ORDER_MARK:
+        return False
+    # Without the csv the compiled file is all there is
+    return not os.path.exists(dictionary_path) or csv_digest == get_csv_digest(dictionary_path)
+
+
+class SpanishWayuuDictionary:
+    """
+    Spanish to Wayuunaiki dictionary read from its compiled binary file.
+
+    The file is memory-mapped and its tables are accessed in place, so processes on the same host share the same
+    pages. The file is (re)built from the csv when it is missing, comes from another format version or the csv
+    changed. Lookups only visit the rows that contain the searched words.
+    """
+    def __init__(self, dictionary_path=DICTIONARY_PATH, binary_path=None):
+        self.dictionary_path = dictionary_path
+        self.binary_path = binary_path or get_binary_path(dictionary_path)
+        if not binary_is_up_to_date(dictionary_path, self.binary_path):
+            build_dictionary_binary(dictionary_path, self.binary_path)
+
+        with open(self.binary_path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        _, _, _, _, self.num_rows, self.num_keys, num_postings, key_blob_size, line_blob_size, spanish_blob_size = \
+            HEADER.unpack_from(self.mm)
+
+        view = memoryview(self.mm)
+        position = HEADER.size
+        def next_section(size, fmt=None):
+            nonlocal position
+            section = view[position:position+size]
+            position += size
+            return section.cast(fmt) if fmt else section
+        int_size = array('I').itemsize
+        self.key_offsets = next_section((self.num_keys+1)*int_size, 'I')
+        self.posting_offsets = next_section((self.num_keys+1)*int_size, 'I')
+        self.postings = next_section(num_postings*int_size, 'I')
+        self.line_offsets = next_section((self.num_rows+1)*int_size, 'I')
+        self.spanish_offsets = next_section((self.num_rows+1)*int_size, 'I')
+        self.key_blob = next_section(key_blob_size)
+        self.line_blob = next_section(line_blob_size)
+        self.spanish_blob = next_section(spanish_blob_size)
+
+        # Decoded lazily, only queries without words need it
+        self.spanish_text = None
+        self.row_starts = None
+        # Trie of the folded keys, built on the first fuzzy lookup
+        self.trie = None
+        # Lookups run on several threads (ToolExecutor, the async engine), the lazy tables are built under the lock
+        # and published once complete
+        self.lock = threading.Lock()
+
+    def key(self, key_id):
+        return bytes(self.key_blob[self.key_offsets[key_id]:self.key_offsets[key_id+1]])
+
+    def row(self, row_id):
+        return str(self.line_blob[self.line_offsets[row_id]:self.line_offsets[row_id+1]], 'utf-8').split(',')
+
+    def spanish(self, row_id):
+        return str(self.spanish_blob[self.spanish_offsets[row_id]:self.spanish_offsets[row_id+1]], 'utf-8')
+
+    def word_postings(self, word):
+        word = word.encode('utf-8')
+        key_id = bisect_left(range(self.num_keys), word, key=self.key)
+        if key_id == self.num_keys or self.key(key_id) != word:
+            return []
+        return self.postings[self.posting_offsets[key_id]:self.posting_offsets[key_id+1]]
+
+    def candidate_rows(self, spanish_word):
+        # Every word of the query is delimited by the \b anchors or by the non-word characters around it, so it
+        # must appear as a whole word in any matching row. Queries without words can't be answered from the index
+        words = WORD_PATTERN.findall(spanish_word.lower())
+        if not words:
+            return None
+
+        postings = [self.word_postings(word) for word in set(words)]
+        if len(postings) == 1:
+            return postings[0]
+        postings.sort(key=len)
+        common = set(postings[0]).intersection(*postings[1:])
+        return [row_id for row_id in postings[0] if row_id in common]
+
+    def scan_rows(self, pattern, max_matches):
+        row_ids = []
+        if max_matches <= 0 or '\n' in pattern.pattern:
+            return row_ids
+        if self.spanish_text is None:
+            self.decode_spanish()
+        for match in pattern.finditer(self.spanish_text):
+            row_id = bisect_right(self.row_starts, match.start()) - 1
+            if row_ids and row_ids[-1] == row_id:
+                continue
+            row_ids.append(row_id)
+            if len(row_ids) >= max_matches:
+                break
+        return row_ids
+
+    def decode_spanish(self):
+        with self.lock:
+            if self.spanish_text is not None:
+                return
+            spanish_text = str(self.spanish_blob, 'utf-8')
+            self.row_starts = list(accumulate((len(line) + 1 for line in spanish_text.split('\n')[:self.num_rows-1]), initial=0))
+            self.spanish_text = spanish_text
+
+    def lookup(self, spanish_word, max_matches=5):
+        pattern = re.compile(rf'\b{re.escape(spanish_word)}\b', re.IGNORECASE)
+        row_ids = self.candidate_rows(spanish_word)
+        if row_ids is None:
+            return [self.row(row_id) for row_id in self.scan_rows(pattern, max_matches)]
+
+        all_matches = []
+        for row_id in row_ids:
+            if len(all_matches) >= max_matches:
+                break
+            if pattern.search(self.spanish(row_id)):
+                all_matches.append(self.row(row_id))
+        return all_matches
+
+    def build_trie(self):
+        # Every node maps a character to its child node, the key ids of a complete folded key are stored under ''
+        with self.lock:
+            if self.trie is not None:
+                return
+            trie = {}
+            for key_id in range(self.num_keys):
+                node = trie
+                for char in fold(self.key(key_id).decode('utf-8')):
+                    node = node.setdefault(char, {})
+                node.setdefault('', []).append(key_id)
+            self.trie = trie
+
+    def fuzzy_word_rows(self, word):
+        """
+        Finds the rows with a word similar to the given one and returns {row_id: quality}, where quality is 0 for the
+        same word, 1 for the same word once accents and case are folded, and 2 plus the length difference when one
+        of the words is a prefix of the other (vete -> vetelo, vayase -> vaya).
+        """
+        if self.trie is None:
+            self.build_trie()
+
+        qualities = {}
+        def add_key(key_id, quality):
+            for row_id in self.postings[self.posting_offsets[key_id]:self.posting_offsets[key_id+1]]:
+                if quality < qualities.get(row_id, quality + 1):
+                    qualities[row_id] = quality
+
+        folded_word = fold(word)
+        node = self.trie
+        for depth, char in enumerate(folded_word, 1):
+            node = node.get(char)
+            if node is None:
+                return qualities
+            # Stems of the word
+            if MIN_PREFIX_LENGTH <= depth < len(folded_word):
+                for key_id in node.get('', []):
+                    add_key(key_id, 2 + len(folded_word) - depth)
+
+        word_bytes = word.lower().encode('utf-8')
+        for key_id in node.get('', []):
+            add_key(key_id, 0 if self.key(key_id) == word_bytes else 1)
+        # Words that start with the given one
+        if len(folded_word) >= MIN_PREFIX_LENGTH:
+            stack = [(child, 1) for char, child in node.items() if char != '']
+            while stack:
+                node, extra_length = stack.pop()
+                for char, child in node.items():
+                    if char == '':
+                        for key_id in child:
+                            add_key(key_id, 2 + extra_length)
+                    else:
+                        stack.append((child, extra_length + 1))
+        return qualities
+
+    def fuzzy_lookup(self, spanish_word, max_matches=5):
+        """
+        Accent and case insensitive lookup that also accepts prefixes and stems of the searched words. Rows must
+        have a similar word for every word of the query and are ranked by the sum of the word qualities, then by
+        the length of their Spanish side (the closest entries first) and then by file order.
+        """
+        words = list(dict.fromkeys(WORD_PATTERN.findall(spanish_word)))
+        if not words:
+            return self.lookup(spanish_word, max_matches)
+
+        word_qualities = sorted((self.fuzzy_word_rows(word) for word in words), key=len)
+        scores = []
+        for row_id, quality in word_qualities[0].items():
+            for other_qualities in word_qualities[1:]:
+                if row_id not in other_qualities:
+                    break
+                quality += other_qualities[row_id]
+            else:
+                spanish_length = self.spanish_offsets[row_id+1] - self.spanish_offsets[row_id]
+                scores.append((quality, spanish_length, row_id))
+        return [self.row(row_id) for _, _, row_id in heapq.nsmallest(max_matches, scores)]
+
+    def fallback_lookup(self, spanish_word, max_matches=5):
+        # Exact lookup, and the fuzzy one for the words without exact matches
+        return self.lookup(spanish_word, max_matches) or self.fuzzy_lookup(spanish_word, max_matches)
+
+    def lookup_phrase(self, spanish_words, max_matches=5, mode='exact', memo=None):
+        """
+        Looks up every word of a tool call: the call can be a single word or phrase, or a comma separated list of
+        them. A phrase without matches is looked up word by word. Only those two cases differ from looking up the
+        call as a single word, which for them always finds nothing.
+        Returns a list of (word, matches) pairs. memo can be shared between calls so repeated words are looked up
+        only once.
+        """
+        lookup_fn = self.get_lookup_fn(mode)
+        memo = {} if memo is None else memo
+        def lookup_word(spanish_word):
+            if spanish_word not in memo:
+                memo[spanish_word] = lookup_fn(spanish_word, max_matches)
+            return memo[spanish_word]
+
+        # The Spanish side of the csv has no commas, so splitting on them never loses a match. Calls without commas
+        # are looked up as given
+        if ',' in spanish_words:
+            words = [word.strip() for word in spanish_words.split(',') if word.strip()] or [spanish_words]
+        else:
+            words = [spanish_words]
+        groups = []
+        for word in dict.fromkeys(words):
+            matches = lookup_word(word)
+            if len(matches) == 0 and len(word.split()) > 1:
+                groups += [(phrase_word, lookup_word(phrase_word)) for phrase_word in dict.fromkeys(word.split())]
+            else:
+                groups.append((word, matches))
+        return groups
+
+    def lookup_batch(self, spanish_words, max_matches=5, mode='exact'):
+        """
+        Resolves all the calls of a tool-call round at once. Repeated words are looked up only once.
+        Results are returned in the same order as spanish_words.
+        """
+        memo = {}
+        return [self.lookup_phrase(spanish_word, max_matches, mode, memo) for spanish_word in spanish_words]
+
+    def get_lookup_fn(self, mode):
+        if mode == 'exact':
+            return self.lookup
+        if mode == 'fuzzy':
+            return self.fuzzy_lookup
+        if mode == 'fallback':
+            return self.fallback_lookup
+        raise ValueError(f'Unknown lookup mode: {mode}. Available modes: {LOOKUP_MODES}')
+
+
+_dictionaries = {}
+_dictionaries_lock = threading.Lock()
+
+def get_dictionary(dictionary_path=DICTIONARY_PATH):
+    # Load every dictionary only once per process
+    if dictionary_path not in _dictionaries:
+        with _dictionaries_lock:
+            if dictionary_path not in _dictionaries:
+                _dictionaries[dictionary_path] = SpanishWayuuDictionary(dictionary_path)
+    return _dictionaries[dictionary_path]
+
+def format_groups(groups):
+    # A single word keeps the original format, several words get one <matches> block each
+    if len(groups) == 1:
+        return format_matches(groups[0][1])
+    return ''.join(format_matches(matches) if len(matches) > 0 else f" <matches> No matches found for {word} </matches>"
+                   for word, matches in groups)
+
+def log_tool_call(spanish_word, groups, result):
+    if any(len(matches) > 0 for _, matches in groups):
+        logger.debug(f'CORRECT USE OF SPA_TO_WAYU TOOL. Word: {spanish_word}, Result: {result}')
+    else:
+        logger.debug(f'NO_MATCHES SPA_TO_WAYU TOOL. Word: {spanish_word}')
+
+def spa_to_wayu_dictionary(spanish_word, max_matches=5, mode='exact'):
+    groups = get_dictionary().lookup_phrase(spanish_word, max_matches, mode)
+    result = format_groups(groups)
+    log_tool_call(spanish_word, groups, result)
+
+    return result
+
+def spa_to_wayu_dictionary_batch(spanish_words, max_matches=5, mode='exact'):
+    results = []
+    for spanish_word, groups in zip(spanish_words, get_dictionary().lookup_batch(spanish_words, max_matches, mode)):
+        result = format_groups(groups)
+        log_tool_call(spanish_word, groups, result)
+        results.append(result)
+
+    return results
+
+def spa_to_wayu_dictionary_scan(spanish_word, max_matches=5, dictionary_path=DICTIONARY_PATH):
+    # Original linear scan over the csv, kept as the reference implementation for benchmarks
+    with open(dictionary_path, 'r', encoding='utf-8') as f:
+        all_matches = []
+        line = f.readline()
+        while line != '' and len(all_matches) < max_matches:
+            data = line.strip().split(',')
+            if re.search(rf'\b{re.escape(spanish_word)}\b', data[0], re.IGNORECASE):
+                all_matches.append(data)
+            line = f.readline()
+
+    return format_matches(all_matches)
+
+
+if __name__ == '__main__':
+    # Build step: compile the csv dictionary into its binary file
+    print(f'Dictionary compiled into {build_dictionary_binary()}')
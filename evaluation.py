@@ -3,6 +3,10 @@ from logging import getLogger
 import logging
 import os
 import time
+from functools import partial
+from dictionary_tool import spa_to_wayu_dictionary, spa_to_wayu_dictionary_batch
+from tool_execution import ToolResultCache, ToolExecutor
+from tool_rollout import generate_with_tools, generate_with_tools_async, run_async, VLLMAsyncEngine
 
 os.environ["CUDA_VISIBLE_DEVICES"] = "0"
 
@@ -11,6 +15,12 @@ logfile_name = 'evaluation_exp9_qwen_notools.log'
 vllm_lora_adapter = "models/best_policy_model13"
 base_model_name = "Qwen/Qwen2.5-0.5B-Instruct"
 prompt_with_tools = False
+tool_cache_size = 4096 # Tool results kept in the LRU cache
+tool_threads = 8 # Tool calls of a round run concurrently on this many threads
+tool_timeout = 10.0 # Seconds before a tool call of a round is answered with a timeout error
+enabled_tools = ['spa_to_wayu']
+dictionary_mode = 'exact' # 'fallback' for accent insensitive and prefix matches of the words without exact matches, 'fuzzy' for them only
+async_rollouts = False # Stream every sequence through vLLM's AsyncLLMEngine instead of generating in rounds
 
 start_time = time.time()
 
@@ -122,50 +132,21 @@ def generate_batch_completion(model, tokenizer, prompts: list, actions_num=1, cu
     model_inputs = tokenizer(texts)
 
     inputs = model_inputs.input_ids
-    dones = [False] * len(prompts)
-    prompt_length = [len(input_ids) for input_ids in inputs]
-    mask = [[1] * len(input_ids) for input_ids in inputs]
-    responses = [""] * len(prompts)
     tools_enabled = kwargs.get('tools', [])
     tools_enabled = [] if tools_enabled is None else tools_enabled
     stop_tokens = [tool['end_token'] for tool in tools_enabled]
-    tool_used = [False] * len(prompts)
-    how_many_tool_calls = [0] * len(prompts)
-    unfinished_answers = 0
-    for action_step in range(actions_num + 1 if len(tools_enabled) > 0 else 1):
-        sampling_params = SamplingParams(temperature=default_sampling_args["temperature"], top_p=default_sampling_args['top_p'], top_k=-1, max_tokens=default_sampling_args['max_new_tokens'],
-            stop=stop_tokens)
-        outputs = model.generate(prompt_token_ids=inputs, sampling_params=sampling_params, lora_request=kwargs['lora_request'], use_tqdm=False)
-
-        for j, output in enumerate(outputs):
-            if dones[j]:
-                continue
-            
-            for tool in tools_enabled:
-                if output.outputs[0].stop_reason == tool['end_token'] and tool['start_token'] in output.outputs[0].text:
-                    api_args = output.outputs[0].text.split(tool['start_token'])[1].strip()
-                    api_result = tool['api'](api_args)
-                    # responses[j] += f"{tool['start_token']} " + api_args + f" {tool['end_token']}" + api_result
-                    responses[j] += output.outputs[0].text + f"{tool['end_token']}" + api_result
-                    api_result_tokens = tokenizer.encode(api_result, return_tensors=None)
-                    inputs[j] += list(output.outputs[0].token_ids) + api_result_tokens
-
-                    tool_used[j] = True
-                    how_many_tool_calls[j] += 1
-                    break # Only one tool can be used at a time
-            if output.outputs[0].finish_reason == "stop" and output.outputs[0].stop_reason is None:
-                responses[j] += output.outputs[0].text
-                inputs[j] += list(output.outputs[0].token_ids)
-                dones[j] = True
-            elif output.outputs[0].stop_reason not in stop_tokens:
-                # print(f"Unexpected finish reason: {output.outputs[0].finish_reason} {output.outputs[0].stop_reason}")
-                unfinished_answers += 1
-                responses[j] += tokenizer.eos_token
-                inputs[j] += [tokenizer.eos_token_id]
-                dones[j] = True
-        
-        if all(dones):
-            break
+    sampling_params = SamplingParams(temperature=default_sampling_args["temperature"], top_p=default_sampling_args['top_p'], top_k=-1, max_tokens=default_sampling_args['max_new_tokens'],
+        stop=stop_tokens)
+    if isinstance(model, VLLMAsyncEngine):
+        rollout_buffer, rollout_stats = run_async(generate_with_tools_async(model, tokenizer, inputs, sampling_params, tools_enabled, stop_tokens, actions_num=actions_num,
+            lora_request=kwargs['lora_request'], tool_cache=kwargs.get('tool_cache'), tool_executor=kwargs.get('tool_executor')))
+    else:
+        rollout_buffer, rollout_stats = generate_with_tools(model, tokenizer, inputs, sampling_params, tools_enabled, stop_tokens, actions_num=actions_num, lora_request=kwargs['lora_request'],
+            use_tqdm=False, tool_cache=kwargs.get('tool_cache'), tool_executor=kwargs.get('tool_executor'))
+    responses = rollout_buffer.responses()
+    how_many_tool_calls = rollout_stats['tool_calls']
+    tool_used = [tool_calls > 0 for tool_calls in how_many_tool_calls]
+    unfinished_answers = rollout_stats['unfinished_answers']
 
     return responses, tool_used, how_many_tool_calls, unfinished_answers
 
@@ -180,7 +161,7 @@ def extract_answer(response, transform_fn = lambda x: x, nan_val = None)->str|No
             return nan_val
     return nan_val
 
-def evaluate_model(model, tokenizer, dataloader, actions_num=1, lora_request=None, tools=None, custom_prompt_template=None):
+def evaluate_model(model, tokenizer, dataloader, actions_num=1, lora_request=None, tools=None, custom_prompt_template=None, tool_cache=None, tool_executor=None):
     sum_bleu = 0
     num_samples = 0
     tools_used_in_total = 0
@@ -191,7 +172,7 @@ def evaluate_model(model, tokenizer, dataloader, actions_num=1, lora_request=Non
             inputs, targets = batch
 
             # Generate translations
-            outputs, tools_used, how_many_tool_calls, unfinished_answers = generate_batch_completion(model, tokenizer, inputs, actions_num=actions_num, lora_request=lora_request, tools=tools, temperature=0, top_p=1, max_new_tokens=768, custom_prompt_template=custom_prompt_template)
+            outputs, tools_used, how_many_tool_calls, unfinished_answers = generate_batch_completion(model, tokenizer, inputs, actions_num=actions_num, lora_request=lora_request, tools=tools, temperature=0, top_p=1, max_new_tokens=768, custom_prompt_template=custom_prompt_template, tool_cache=tool_cache, tool_executor=tool_executor)
 
             tools_used_in_total += sum(tools_used)
             calls_per_sample += sum(how_many_tool_calls)
@@ -211,32 +192,13 @@ def evaluate_model(model, tokenizer, dataloader, actions_num=1, lora_request=Non
     unfinished_answers_avg = unfinished_answers / num_samples if num_samples > 0 else 0
     return avg_bleu, tools_used_avg, calls_per_sample_avg, unfinished_answers_avg
 
-def spa_to_wayu_dictionary(spanish_word, max_matches=5):
-    dictionary_path = 'assets/spanish_to_wayuunaiki_short.csv'
-
-    with open(dictionary_path, 'r', encoding='utf-8') as f:
-        all_matches = []
-        line = f.readline()
-        while line != '' and len(all_matches) < max_matches:
-            data = line.strip().split(',')
-            if re.search(rf'\b{re.escape(spanish_word)}\b', data[0], re.IGNORECASE):
-                all_matches.append(data)
-            line = f.readline()
-
-    if len(all_matches) > 0:
-        result = " <matches> " + '\n'.join(f'{spa}: {wayuu}' for spa, wayuu in all_matches) + " </matches>"
-        # print(f'CORRECT USE OF SPA_TO_WAYU TOOL. Word: {spanish_word}, Result: {result}')
-    else:
-        result = " <matches> No matches found </matches>"
-        # print(f'NO_MATCHES SPA_TO_WAYU TOOL. Word: {spanish_word}')
-
-    return result
-
 TOOLS = [
     {
         'name': 'spa_to_wayu',
         'description': 'A tool that translates a word from Spanish to Wayuunaiki.',
-        'api': spa_to_wayu_dictionary,
+        'api': partial(spa_to_wayu_dictionary, mode=dictionary_mode),
+        'batch_api': partial(spa_to_wayu_dictionary_batch, mode=dictionary_mode),
+        'timeout_result': ' <matches> Error: timed out </matches>',
         'start_token': '<spa_to_wayuu>',
         'end_token': '</spa_to_wayuu>',
     }
@@ -252,7 +214,7 @@ from vllm.lora.request import LoRARequest
 
 tokenizer = AutoTokenizer.from_pretrained(base_model_name)
 
-inference_engine = LLM(
+engine_args = dict(
     model=base_model_name,
     enable_lora=True,
     max_lora_rank=64,
@@ -265,31 +227,42 @@ inference_engine = LLM(
     max_model_len=2060,
     # enable_sleep_mode=True,
     )
+if async_rollouts:
+    inference_engine = VLLMAsyncEngine.from_engine_args(**engine_args)
+else:
+    inference_engine = LLM(**engine_args)
 
 if vllm_lora_adapter:
     lora_request=LoRARequest('adapter', 1, vllm_lora_adapter)
 else:
     lora_request=None
 
+tools = [tool for tool in TOOLS if tool['name'] in enabled_tools]
 dataloader = DataLoader(dataset, batch_size=64, shuffle=True)
+tool_result_cache = ToolResultCache(max_size=tool_cache_size)
+tool_executor = ToolExecutor(max_workers=tool_threads, timeout=tool_timeout)
 
 # Evaluate the model
 logger.info(f'Validation dataset')
-avg_bleu, tools_used_avg, calls_per_sample_avg, unfinished_avg = evaluate_model(inference_engine, tokenizer, dataloader, actions_num=4, lora_request=lora_request, tools=TOOLS, custom_prompt_template=custom_prompt_template)
+avg_bleu, tools_used_avg, calls_per_sample_avg, unfinished_avg = evaluate_model(inference_engine, tokenizer, dataloader, actions_num=4, lora_request=lora_request, tools=tools, custom_prompt_template=custom_prompt_template, tool_cache=tool_result_cache, tool_executor=tool_executor)
 logger.info(f"Average BLEU score: {avg_bleu:.4f}")
 logger.info(f"Average tools used: {tools_used_avg:.4f}")
 logger.info(f"Average calls per sample: {calls_per_sample_avg:.4f}")
 logger.info(f"Average unfinished answers: {unfinished_avg:.4f}")
+logger.info(f"Tool cache: {tool_result_cache.pop_stats()}")
+logger.info(f"Tool executor: {tool_executor.pop_stats()}")
 
 dataloader = DataLoader(test_dataset, batch_size=64, shuffle=True)
 
 # Evaluate the model
 logger.info(f'Test dataset')
-avg_bleu, tools_used_avg, calls_per_sample_avg, unfinished_avg = evaluate_model(inference_engine, tokenizer, dataloader, actions_num=4, lora_request=lora_request, tools=TOOLS, custom_prompt_template=custom_prompt_template)
+avg_bleu, tools_used_avg, calls_per_sample_avg, unfinished_avg = evaluate_model(inference_engine, tokenizer, dataloader, actions_num=4, lora_request=lora_request, tools=tools, custom_prompt_template=custom_prompt_template, tool_cache=tool_result_cache, tool_executor=tool_executor)
 logger.info(f"Average BLEU score: {avg_bleu:.4f}")
 logger.info(f"Average tools used: {tools_used_avg:.4f}")
 logger.info(f"Average calls per sample: {calls_per_sample_avg:.4f}")
 logger.info(f"Average unfinished answers: {unfinished_avg:.4f}")
+logger.info(f"Tool cache: {tool_result_cache.pop_stats()}")
+logger.info(f"Tool executor: {tool_executor.pop_stats()}")
 
 end_time = time.time()
 execution_time = end_time - start_time
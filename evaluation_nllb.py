@@ -5,6 +5,7 @@ import os
 import time
 from transformers.tokenization_utils import AddedToken
 from peft import PeftModel
+from dictionary_tool import spa_to_wayu_dictionary
 
 os.environ["CUDA_VISIBLE_DEVICES"] = "2"
 
@@ -158,27 +159,6 @@ def evaluate_model(model, tokenizer, dataloader, actions_num=1, lora_request=Non
     avg_bleu = sum_bleu / num_samples if num_samples > 0 else 0
     return avg_bleu
 
-def spa_to_wayu_dictionary(spanish_word, max_matches=5):
-    dictionary_path = 'assets/spanish_to_wayuunaiki_short.csv'
-
-    with open(dictionary_path, 'r', encoding='utf-8') as f:
-        all_matches = []
-        line = f.readline()
-        while line != '' and len(all_matches) < max_matches:
-            data = line.strip().split(',')
-            if re.search(rf'\b{re.escape(spanish_word)}\b', data[0], re.IGNORECASE):
-                all_matches.append(data)
-            line = f.readline()
-
-    if len(all_matches) > 0:
-        result = " <matches> " + '\n'.join(f'{spa}: {wayuu}' for spa, wayuu in all_matches) + " </matches>"
-        # print(f'CORRECT USE OF SPA_TO_WAYU TOOL. Word: {spanish_word}, Result: {result}')
-    else:
-        result = " <matches> No matches found </matches>"
-        # print(f'NO_MATCHES SPA_TO_WAYU TOOL. Word: {spanish_word}')
-
-    return result
-
 TOOLS = [
     {
         'name': 'spa_to_wayu',
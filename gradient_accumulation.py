@@ -0,0 +1,42 @@
+from torch import nn
+
+
+class GradientAccumulator:
+    """
+    Backward and optimizer step of update_policy, which calls backward(loss) for every minibatch, the loss weighted
+    by the share of the batch in the minibatch, and step() once the whole batch of an epoch is accumulated. The
+    optimizer steps every accum_grad_steps calls of step(), with the mean gradient of those batches clipped to
+    max_grad_norm. With update_epochs=1 that is every accum_grad_steps rollouts; with several epochs per rollout
+    accum_grad_steps must be 1, so an optimizer step never mixes the epochs of a rollout.
+
+    A DeepSpeed engine clips and accumulates by itself: every backward is followed by engine.step(), which only
+    updates the weights on its accumulation boundary, so its gradient_accumulation_steps must be the minibatches of
+    an epoch times accum_grad_steps.
+    """
+    def __init__(self, model, optimizer=None, accum_grad_steps=1, max_grad_norm=1.0, use_deepspeed=False):
+        self.model = model
+        self.optimizer = optimizer
+        self.accum_grad_steps = accum_grad_steps
+        self.max_grad_norm = max_grad_norm
+        self.use_deepspeed = use_deepspeed
+        self.accumulated_steps = 0
+
+    def backward(self, loss):
+        loss = loss / self.accum_grad_steps
+        if self.use_deepspeed:
+            self.model.backward(loss, scale_wrt_gas=False)
+            self.model.step()
+        else:
+            loss.backward()
+
+    def step(self)->bool:
+        # True when the policy weights were updated
+        self.accumulated_steps += 1
+        if self.accumulated_steps < self.accum_grad_steps:
+            return False
+        self.accumulated_steps = 0
+        if not self.use_deepspeed:
+            nn.utils.clip_grad_norm_(self.model.parameters(), self.max_grad_norm) # Avoid large gradients
+            self.optimizer.step()
+            self.optimizer.zero_grad()
+        return True
@@ -3,12 +3,20 @@ from transformers import AutoModelForCausalLM, AutoTokenizer
 from logging import getLogger
 import logging
 import os
+import math
 import time
 from vllm import LLM, SamplingParams
 from vllm.lora.request import LoRARequest
 from functools import partial
 from collections import defaultdict
+from contextlib import nullcontext
 import sacrebleu
+from hf_generation import generate_samples
+from tool_rollout import sampled_logprobs
+from lora_sync import LoRASync
+from advantages import compute_advantages, get_eos_index, get_is_terminal
+from packed_sequences import pack_rows, packed_logits
+from token_logprobs import batched_log_probs, completion_logits, token_log_probs
 
 start_time = time.time()
 
@@ -30,7 +38,7 @@ def get_policy_model(model_name):
     tokenizer = AutoTokenizer.from_pretrained(model_name)
     return model, tokenizer
 
-def generate_batch_completion(model, tokenizer, prompts: list, return_ids=False, use_vllm=False, **kwargs):
+def generate_batch_completion(model, tokenizer, prompts: list, return_ids=False, use_vllm=False, num_samples=1, return_logprobs=False, **kwargs):
     batch = [[
         {"role": "system", "content": "You are a helpful assistant."},
         {"role": "user", "content": prompt}
@@ -52,31 +60,42 @@ def generate_batch_completion(model, tokenizer, prompts: list, return_ids=False,
         return_tensors="pt" if not use_vllm else None)
     
     if use_vllm:
-        sampling_params = SamplingParams(temperature=default_sampling_args["temperature"], top_p=default_sampling_args['top_p'], top_k=-1, max_tokens=default_sampling_args['max_new_tokens'])
+        # Every prompt is prefilled once and sampled num_samples times
+        sampling_params = SamplingParams(n=num_samples, temperature=default_sampling_args["temperature"], top_p=default_sampling_args['top_p'], top_k=-1, max_tokens=default_sampling_args['max_new_tokens'],
+            logprobs=0 if return_logprobs else None)
         outputs = model.generate(prompt_token_ids=model_inputs.input_ids, sampling_params=sampling_params, lora_request=kwargs['lora_request'])
 
         if return_ids:
-            generation_ids = [output.prompt_token_ids + list(output.outputs[0].token_ids) for output in outputs]
+            generation_ids = [output.prompt_token_ids + list(completion.token_ids) for output in outputs for completion in output.outputs]
             # padding the generation_ids to the max length
             max_length = max([len(ids) for ids in generation_ids])
+            log_probs = None
+            if return_logprobs:
+                # Log-probs of the sampled tokens at their positions, 0 for the prompt and the padding
+                log_probs = [[0.0]*len(output.prompt_token_ids) + sampled_logprobs(completion) for output in outputs for completion in output.outputs]
+                log_probs = torch.tensor([row + [0.0]*(max_length-len(row)) for row in log_probs])
             generation_ids = [ids + [tokenizer.pad_token_id]*(max_length-len(ids)) for ids in generation_ids]
             generation_ids = torch.tensor(generation_ids)
-            return generation_ids, len(model_inputs.input_ids[0])
+            return generation_ids, len(model_inputs.input_ids[0]), log_probs
 
-        return [output.outputs[0].text for output in outputs]
+        return [completion.text for output in outputs for completion in output.outputs]
     
     model_inputs = model_inputs.to(model.device)
 
-    generated_ids = model.generate(
-        **model_inputs,
-        **default_sampling_args
-    )
+    if return_logprobs:
+        generated_ids, generated_log_probs = generate_samples(model, model_inputs.input_ids, model_inputs.attention_mask, num_samples=num_samples, return_logprobs=True, **default_sampling_args)
+    else:
+        generated_ids = generate_samples(model, model_inputs.input_ids, model_inputs.attention_mask, num_samples=num_samples, **default_sampling_args)
 
     if return_ids:
-        return generated_ids, len(model_inputs.input_ids[0])
+        log_probs = None
+        if return_logprobs:
+            log_probs = torch.zeros(generated_ids.shape)
+            log_probs[:, -generated_log_probs.shape[1]:] = generated_log_probs.cpu()
+        return generated_ids, len(model_inputs.input_ids[0]), log_probs
     
     generated_ids = [
-        output_ids[len(input_ids):] for input_ids, output_ids in zip(model_inputs.input_ids, generated_ids)
+        output_ids[len(input_ids):] for input_ids, output_ids in zip(model_inputs.input_ids.repeat_interleave(num_samples, dim=0), generated_ids)
     ]
 
     response = tokenizer.batch_decode(generated_ids, skip_special_tokens=True)
@@ -131,17 +150,14 @@ from torch import nn
 
 # %%
 def make_rollouts(model, simulations, initial_prompt: str, max_size = 256, temperature=1.0, **kwargs):
-    prompts = [initial_prompt]*simulations
-    
+    # The prompt is tokenized and prefilled once, and sampled simulations times. The log-probs of the sampled tokens
+    # are kept as the old log-probs of the update
     with torch.no_grad():
-        generations, prompt_length = generate_batch_completion(model, tokenizer, prompts, return_ids=True, temperature=temperature, top_p=1, max_new_tokens=max_size, **kwargs)
+        generations, prompt_length, log_probs = generate_batch_completion(model, tokenizer, [initial_prompt], return_ids=True, temperature=temperature, top_p=1, max_new_tokens=max_size, num_samples=simulations, return_logprobs=True, **kwargs)
 
     # Create mask for padding and eos tokens
-    is_terminal = torch.zeros_like(generations, device='cpu')
-    is_terminal[generations == tokenizer.pad_token_id] = 1
-    eos_token = is_terminal.shape[1]-is_terminal.count_nonzero(dim=1)-1
-    is_terminal[torch.arange(len(is_terminal)), eos_token] = 1
-    return generations[:,prompt_length:], is_terminal[:,prompt_length:], generations, prompt_length
+    is_terminal = get_is_terminal(generations[:,prompt_length:], tokenizer.pad_token_id)
+    return generations[:,prompt_length:], is_terminal, generations, prompt_length, log_probs[:,prompt_length:]
 
 # %%
 def get_rewards(samples, is_terminal, correct_result):
@@ -153,9 +169,8 @@ def get_rewards(samples, is_terminal, correct_result):
     logger.debug(f'samples: {samples}')
     answer = torch.tensor([extract_answer(response, lambda x: int(x) if x.isnumeric() else correct_result+1, torch.nan) for response in samples])
 
-    eos_index = (is_terminal == 0).sum(dim=1)
-    logger.info(f'Response length mean: {eos_index.to(torch.float16).mean():,.2f}')
-    eos_index = torch.min(eos_index, torch.tensor(is_terminal.shape[1]-1))
+    logger.info(f'Response length mean: {(is_terminal == 0).sum(dim=1).to(torch.float16).mean():,.2f}')
+    eos_index = get_eos_index(is_terminal)
 
     answer_is_correct = (answer == correct_result)
     answer_is_not_correct = (answer != correct_result)
@@ -194,8 +209,7 @@ def get_rewards_translation(samples, is_terminal, correct_translation):
         for sample in samples
     ])
 
-    eos_index = (is_terminal == 0).sum(dim=1)
-    eos_index = torch.min(eos_index, torch.tensor(is_terminal.shape[1]-1))
+    eos_index = get_eos_index(is_terminal)
 
     # Assign rewards based in BLEU score
     rewards[torch.arange(len(samples)), eos_index] += answer_bleu_scores
@@ -212,38 +226,41 @@ def run_one_mul_simulation(model, generations_num, temperature=1.0, **kwargs):
     prompts = [prompt.format(*nums) for nums in numbers]
 
     # Generate the responses for the prompt
-    inputs, is_terminal, complete_prompts, prompt_length = make_rollouts(model, generations_num, prompts[0], temperature=temperature, **kwargs)
+    inputs, is_terminal, complete_prompts, prompt_length, old_log_probs = make_rollouts(model, generations_num, prompts[0], temperature=temperature, **kwargs)
     # Calculate the rewards for each response
     rewards = get_rewards(inputs, is_terminal, correct_result)
-    return inputs, rewards, is_terminal, complete_prompts, prompt_length
-
-
-# %%
-def compute_advantages(rewards, is_terminal, gamma=1.0, gae_lambda=0.2, dr_grpo=False):
-    # Find the longest response in the batch
-    num_rollout_steps = torch.max((is_terminal==0).sum(1))
-    num_rollout_steps = torch.min(num_rollout_steps, torch.tensor(rewards.shape[1])-1)
-    advantages = torch.zeros((len(rewards), torch.tensor(rewards.shape[1])))
-
-    eos_index = (is_terminal == 0).sum(dim=1)
-    eos_index = torch.min(num_rollout_steps, eos_index)
-    rewards_of_outputs = rewards[torch.arange(len(rewards)), eos_index]
-    norm_rewards = (rewards_of_outputs - rewards_of_outputs.mean()) 
-    if not dr_grpo:
-        norm_rewards /= (rewards_of_outputs.std() + 1e-8)
-
-    for i in range(len(rewards)):
-        advantages[i,:eos_index[i]+1] = norm_rewards[i]
+    return inputs, rewards, is_terminal, complete_prompts, prompt_length, old_log_probs
 
-    logger.debug(f'advantages: {advantages}')
-    return advantages
 
 # %%
 import numpy as np
 
 
 # %%
-def update_policy(model, ref_model, old_model, optimizer, is_terminal, advantanges, complete_prompts, prompt_length, generations, minibatch_size, update_epochs, scheduler=None, normalize_advantage=False, lower_clip=None, upper_clip=None, kl_penalty_coef=0.04, dr_grpo=False, no_kl=False, temperature=1.0, use_deepspeed=False):
+def reference_log_probs(model, ref_model, complete_prompts, prompt_length, generations, max_tokens, batch_size, temperature=1.0, use_deepspeed=False, logprob_chunk_size=None):
+    # Log-probs of the generated tokens under the ref model (the policy without its adapter when ref_model is None)
+    # in no-grad passes of batch_size rows. They only depend on the rollout, so update_policy reuses them across
+    # minibatches and epochs
+    complete_prompts = complete_prompts.to(model.device)
+    if ref_model is not None:
+        forward_model, context = ref_model, nullcontext()
+    else:
+        forward_model = model
+        context = model.module.disable_adapter() if use_deepspeed else model.disable_adapter()
+    def logits_fn(rows):
+        ref_logits = completion_logits(forward_model, complete_prompts[rows,:prompt_length+max_tokens], max_tokens)
+        ref_logits /= temperature
+        return ref_logits
+    with context:
+        return batched_log_probs(logits_fn, generations[:,:max_tokens], batch_size=batch_size, chunk_size=logprob_chunk_size)
+
+def update_policy(model, optimizer, is_terminal, advantanges, complete_prompts, prompt_length, generations, minibatch_size, update_epochs, scheduler=None, normalize_advantage=False, lower_clip=None, upper_clip=None, kl_penalty_coef=0.04, dr_grpo=False, no_kl=False, temperature=1.0, use_deepspeed=False, logprob_chunk_size=None, ref_log_probs=None, pack_sequences=False, old_log_probs=None):
+    # advantanges: one advantage per generation (compute_advantages with sparse), spread over its generated tokens
+    # old_log_probs: log-probs of the generated tokens under the policy that sampled them, captured at generation,
+    # for the ratio. Without them the ratio is 1 and the clipping does nothing
+    # ref_log_probs: log-probs of the generated tokens under the ref model (reference_log_probs), None to skip the KL
+    # when it is not in the loss
+    assert ref_log_probs is not None or dr_grpo or no_kl, 'The KL penalty needs ref_log_probs'
     lower_clipped_threshold = lower_clip
     upper_clipped_threshold = upper_clip
 
@@ -261,68 +278,51 @@ def update_policy(model, ref_model, old_model, optimizer, is_terminal, advantang
         for start in range(0, len(advantanges), minibatch_size):
             end = start + minibatch_size
             minibatch_indices = batch_indices[start:end]
-            # Calculate the logits for the generated responses with the policy model (the logits of the previous token represents the distribution of the current token, that's why the -1)
-            logits = model(complete_prompts[minibatch_indices,:prompt_length+advantanges.shape[1]]).logits[:,prompt_length-1:-1]
-            logits /= temperature
-            if old_model is not None:
-                with torch.no_grad():
-                    old_logits  = old_model(complete_prompts[minibatch_indices,:prompt_length+advantanges.shape[1]]).logits[:,prompt_length-1:-1]
-                    old_logits /= temperature
-            # Calculate the logits for the generated responses with the ref model
-            if ref_model is not None:
-                with torch.no_grad():
-                    ref_logits  = ref_model(complete_prompts[minibatch_indices,:prompt_length+advantanges.shape[1]]).logits[:,prompt_length-1:-1]
-                    ref_logits /= temperature
+            actual_minibatch_size = len(minibatch_indices)
+            max_tokens = is_terminal.shape[1]
+            # terminal state is shift to the right so the eos token that has the reward is taken in account
+            minibatch_is_not_terminal = torch.cat((torch.ones(actual_minibatch_size,1, device=model.device), 1-is_terminal[minibatch_indices]), dim=1)[:,:max_tokens]
+            if pack_sequences:
+                # Prompts and completions (up to the eos) of the minibatch one after the other, without padding
+                packed = pack_rows(complete_prompts[minibatch_indices,:prompt_length+max_tokens], prompt_length, minibatch_is_not_terminal, tokenizer.pad_token_id)
+                logits = packed_logits(model, packed)
+                logits /= temperature
+                # Log-probabilities of the flattened completion tokens, put back in their place in the minibatch
+                packed_log_probs = token_log_probs(logits, packed.completion_ids, chunk_size=logprob_chunk_size)[0]
+                log_probs_sum = torch.zeros(minibatch_is_not_terminal.shape, device=model.device).masked_scatter(minibatch_is_not_terminal.bool(), packed_log_probs)
             else:
-                with torch.no_grad():
-                    if use_deepspeed:
-                        with model.module.disable_adapter():
-                            ref_logits  = model(complete_prompts[minibatch_indices,:prompt_length+advantanges.shape[1]]).logits[:,prompt_length-1:-1]
-                            ref_logits /= temperature
-                    else:
-                        with model.disable_adapter():
-                            ref_logits  = model(complete_prompts[minibatch_indices,:prompt_length+advantanges.shape[1]]).logits[:,prompt_length-1:-1]
-                            ref_logits /= temperature
-            # Get the ids of the actual generated tokens
-            completion_ids = generations[minibatch_indices]
-            completion_ids = generations[minibatch_indices,:advantanges.shape[1]].reshape(-1)
-            actual_minibatch_size = len(logits)
-            max_tokens = advantanges.shape[1]
-            # Calculate the probabilities of each token generated with the policy and ref model
-            probs = nn.functional.softmax(logits.reshape(actual_minibatch_size*max_tokens,-1), dim=1)
-            probs_tokens = probs[torch.arange(len(completion_ids)), completion_ids].reshape(advantanges.shape)
-            log_probs_sum = torch.log(probs_tokens)
-            if old_model:
-                old_probs = nn.functional.softmax(old_logits.reshape(actual_minibatch_size*max_tokens,-1), dim=1)
-                old_probs_tokens = old_probs[torch.arange(len(completion_ids)), completion_ids]
-                log_old_probs_sum = torch.log(old_probs_tokens).reshape(advantanges.shape)
+                # Calculate the logits for the generated responses with the policy model (the logits of the previous token represents the distribution of the current token, that's why the -1)
+                logits = completion_logits(model, complete_prompts[minibatch_indices,:prompt_length+max_tokens], max_tokens)
+                logits /= temperature
+                # Get the ids of the actual generated tokens
+                completion_ids = generations[minibatch_indices,:max_tokens]
+                # Log-probabilities of each token generated with the policy
+                log_probs_sum = token_log_probs(logits, completion_ids, chunk_size=logprob_chunk_size)
+            if old_log_probs is not None:
+                log_old_probs_sum = old_log_probs[minibatch_indices,:max_tokens].to(model.device)
             else:
-                old_probs_tokens = probs_tokens.detach().reshape(advantanges.shape)
                 log_old_probs_sum = log_probs_sum.detach()
-            ref_probs = nn.functional.softmax(ref_logits.reshape(actual_minibatch_size*max_tokens,-1), dim=1)
-            ref_probs_tokens = ref_probs[torch.arange(len(completion_ids)), completion_ids]
-            log_ref_probs_sum = torch.log(ref_probs_tokens).reshape(advantanges.shape)
-
-            # terminal state is shift to the right so the eos token that has the reward is taken in account
-            minibatch_is_not_terminal = torch.cat((torch.ones(actual_minibatch_size,1, device=model.device), 1-is_terminal[minibatch_indices]), dim=1)[:,:advantanges.shape[1]]
 
             # Track KL divergence
-            log_prob_ratio = log_probs_sum - log_ref_probs_sum
-            probability_ratio = log_prob_ratio.exp()
-            minibatch_approx_kl = ((probability_ratio - 1) - log_prob_ratio) * minibatch_is_not_terminal
-            minibatch_approx_kl_by_generation = (minibatch_approx_kl.sum(dim=1) / minibatch_is_not_terminal.count_nonzero(dim=1))
-            minibatch_approx_kl_mean = minibatch_approx_kl_by_generation.mean()
-            logger.info(f'minibatch_approx_kl_by_generation: {minibatch_approx_kl_by_generation}')
-            logger.debug(f'Approx KL divergence of minibatch: {minibatch_approx_kl_mean:.6f}')
-
-            minibatch_advantages = advantanges[minibatch_indices,:advantanges.shape[1]] * minibatch_is_not_terminal
+            if ref_log_probs is not None:
+                log_ref_probs_sum = ref_log_probs[minibatch_indices,:max_tokens].to(model.device)
+                # Zero outside the generations, where the packed log-probs are 0, so exp cannot overflow
+                log_prob_ratio = (log_probs_sum - log_ref_probs_sum) * minibatch_is_not_terminal
+                probability_ratio = log_prob_ratio.exp()
+                minibatch_approx_kl = ((probability_ratio - 1) - log_prob_ratio) * minibatch_is_not_terminal
+                minibatch_approx_kl_by_generation = (minibatch_approx_kl.sum(dim=1) / minibatch_is_not_terminal.count_nonzero(dim=1))
+                minibatch_approx_kl_mean = minibatch_approx_kl_by_generation.mean()
+                logger.info(f'minibatch_approx_kl_by_generation: {minibatch_approx_kl_by_generation}')
+                logger.debug(f'Approx KL divergence of minibatch: {minibatch_approx_kl_mean:.6f}')
+                logger.debug(f'probability ratio: mean - {probability_ratio.mean()}, min - {probability_ratio.min()}, max: {probability_ratio.max()}')
+
+            minibatch_advantages = advantanges[minibatch_indices,None] * minibatch_is_not_terminal
 
             # The policy loss is to maximize the probability_ratio times the advantages
             new_old_prob_ratio = (log_probs_sum-log_old_probs_sum).exp()
             # Verification in case the old model is the same as the current one
             logger.debug(f'new_old_prob_ratio. This should be 1, {(new_old_prob_ratio*minibatch_is_not_terminal).sum()/minibatch_is_not_terminal.count_nonzero()}')
             loss = new_old_prob_ratio * minibatch_advantages
-            logger.debug(f'probability ratio: mean - {probability_ratio.mean()}, min - {probability_ratio.min()}, max: {probability_ratio.max()}')
             # Clipped loss: Only considers the probability_ratio change between a reasonable range
             if lower_clipped_threshold != None and upper_clipped_threshold != None:
                 clipped_loss = torch.clamp(new_old_prob_ratio, lower_clipped_threshold, upper_clipped_threshold) * minibatch_advantages
@@ -479,7 +479,13 @@ lower_clip=0.8
 upper_clip=1.2
 dr_grpo = True
 no_kl=True
-logger.info(f'Hyperparameters:\nupdate_epochs:{update_epochs}\nrl_steps:{rl_steps}\nsims_per_prompt:{sims_per_prompt}\nminibatch_size:{minibatch_size}\npolicy_lr:{policy_lr}\nwarmup_steps:{warmup_steps}\ngae_lambda: {gae_lambda}\nnormalize advantage:{normalize_advantage}\nlower_clip:{lower_clip}\nupper_clip:{upper_clip}\nkl_penalty_coef:{kl_penalty_coef}\ntemperature:{temperature}\ndr_grpo:{dr_grpo}\nno_kl={no_kl}\nuse_deepspeed={use_deepspeed}\nuse_vllm={use_vllm}')
+lora_verify_steps = 50 # Rl steps between checks that vLLM holds the LoRA weights of the policy
+full_lora_validation = False # Debug: compare every LoRA tensor instead of checksums and sampled elements
+logprob_chunk_size = 64 # Completion positions per chunk when computing token log-probs, None for all at once
+log_kl = True # Log the KL to the ref model when it is not in the loss (dr_grpo or no_kl), False skips the ref forward
+ref_batch_size = None # Rows per ref forward pass, None for minibatch_size
+pack_sequences = False # Policy forward of update_policy on the minibatch packed into one row without padding
+logger.info(f'Hyperparameters:\nupdate_epochs:{update_epochs}\nrl_steps:{rl_steps}\nsims_per_prompt:{sims_per_prompt}\nminibatch_size:{minibatch_size}\npolicy_lr:{policy_lr}\nwarmup_steps:{warmup_steps}\ngae_lambda: {gae_lambda}\nnormalize advantage:{normalize_advantage}\nlower_clip:{lower_clip}\nupper_clip:{upper_clip}\nkl_penalty_coef:{kl_penalty_coef}\ntemperature:{temperature}\ndr_grpo:{dr_grpo}\nno_kl={no_kl}\nuse_deepspeed={use_deepspeed}\nuse_vllm={use_vllm}\nlora_verify_steps={lora_verify_steps}\nfull_lora_validation={full_lora_validation}\nlogprob_chunk_size={logprob_chunk_size}\nlog_kl={log_kl}\nref_batch_size={ref_batch_size}\npack_sequences={pack_sequences}')
 
 
 model, tokenizer = get_policy_model(base_model_name)
@@ -581,8 +587,9 @@ if use_vllm:
     inference_engine.generate(['Hello'], SamplingParams(max_tokens=2), lora_request=lora_request)
 
     # Update the LoRA weights to match the policy model
-    update_vllm_instance(inference_engine, model_engine)
-    update_vllm_instance(inference_engine, model_engine, just_validate=True)
+    lora_sync = LoRASync(inference_engine, model_engine)
+    lora_sync.sync()
+    assert lora_sync.verify(sample_elements=16, full=full_lora_validation)
 
 ref_model = None
 
@@ -608,31 +615,44 @@ try:
 
     logger.info(f'Evaluation before training: {acc}')
     model_engine.train()
-    old_model = None
 
     rl_step = 0
     while rl_step < rl_steps:
         logger.info(f'rl_step: {rl_step+1:,}')
         if use_vllm:
             # update_vllm_instance(inference_engine, model_engine, just_validate=True)
-            generations, rewards, is_terminal, complete_prompts, prompt_length = run_one_mul_simulation(inference_engine, sims_per_prompt, temperature=temperature, use_vllm=use_vllm, lora_request=LoRARequest('tuning', 1, lora_path=starter_vllm_lora_adapter))
+            generations, rewards, is_terminal, complete_prompts, prompt_length, old_log_probs = run_one_mul_simulation(inference_engine, sims_per_prompt, temperature=temperature, use_vllm=use_vllm, lora_request=LoRARequest('tuning', 1, lora_path=starter_vllm_lora_adapter))
             # inference_engine.sleep(1)
             # time.sleep(1)
         else:
-            generations, rewards, is_terminal, complete_prompts, prompt_length = run_one_mul_simulation(model_engine, sims_per_prompt, temperature=temperature)
-        # generations, rewards, is_terminal, complete_prompts, prompt_length = run_one_mul_simulation(model_engine, sims_per_prompt, temperature=temperature)
-        advantanges = compute_advantages(rewards, is_terminal, gae_lambda=gae_lambda, dr_grpo=dr_grpo)
+            generations, rewards, is_terminal, complete_prompts, prompt_length, old_log_probs = run_one_mul_simulation(model_engine, sims_per_prompt, temperature=temperature)
+        # generations, rewards, is_terminal, complete_prompts, prompt_length, old_log_probs = run_one_mul_simulation(model_engine, sims_per_prompt, temperature=temperature)
+        # One advantage per generation, update_policy broadcasts it over the generated tokens
+        advantanges = compute_advantages(rewards, is_terminal, dr_grpo=dr_grpo, sparse=True)
+        logger.debug(f'advantages: {advantanges}')
         if (advantanges == 0).all().item():
             continue
 
+        # Ref log-probs once per rollout instead of once per minibatch and epoch
+        ref_log_probs = None
+        ref_forward_passes = 0
+        if log_kl or not (dr_grpo or no_kl):
+            ref_log_probs = reference_log_probs(model_engine, ref_model, complete_prompts, prompt_length, generations, is_terminal.shape[1], ref_batch_size or minibatch_size, temperature=temperature, use_deepspeed=use_deepspeed, logprob_chunk_size=logprob_chunk_size)
+            ref_forward_passes = math.ceil(len(advantanges) / (ref_batch_size or minibatch_size))
+        per_minibatch_passes = update_epochs * math.ceil(len(advantanges) / minibatch_size)
+        logger.info(f'Ref forward passes: {ref_forward_passes}, saved {per_minibatch_passes - ref_forward_passes} of {per_minibatch_passes}')
+
         logger.info('Updating policy')
         if scheduler:
             logger.debug(f'Learning rate: {scheduler.get_lr()}')
-        update_policy(model_engine, ref_model, old_model, optimizer, is_terminal, advantanges, complete_prompts, prompt_length, generations, minibatch_size, update_epochs, scheduler=scheduler, normalize_advantage=normalize_advantage, lower_clip=lower_clip, upper_clip=upper_clip, dr_grpo=dr_grpo, no_kl=no_kl, temperature=temperature, use_deepspeed=use_deepspeed)
+        update_policy(model_engine, optimizer, is_terminal, advantanges, complete_prompts, prompt_length, generations, minibatch_size, update_epochs, scheduler=scheduler, normalize_advantage=normalize_advantage, lower_clip=lower_clip, upper_clip=upper_clip, dr_grpo=dr_grpo, no_kl=no_kl, temperature=temperature, use_deepspeed=use_deepspeed, logprob_chunk_size=logprob_chunk_size, ref_log_probs=ref_log_probs, pack_sequences=pack_sequences, old_log_probs=old_log_probs)
 
         if use_vllm:
             # Update the LoRA adapter
-            update_vllm_instance(inference_engine, model_engine)
+            lora_sync.sync()
+            logger.info(f'LoRA sync: {lora_sync.pop_stats()}')
+            if (rl_step+1)%lora_verify_steps == 0:
+                lora_sync.verify(sample_elements=16, full=full_lora_validation)
             # inference_engine.wake_up()
             pass
 
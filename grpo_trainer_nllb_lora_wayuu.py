@@ -3,9 +3,9 @@ import os
 import gc
 import re
 import copy
+import math
 
 import torch
-from torch import nn
 os.environ["CUDA_VISIBLE_DEVICES"] = "3"
 os.environ["CUDA_LAUNCH_BLOCKING"] = "1"
 os.environ['TORCH_USE_CUDA_DSA'] = "1"
@@ -18,6 +18,7 @@ import os
 import time
 from functools import partial
 from collections import defaultdict
+from contextlib import nullcontext
 import numpy as np
 from tqdm import tqdm
 from torch.utils.data import Dataset, DataLoader
@@ -25,6 +26,10 @@ from peft import LoraConfig, get_peft_model
 import evaluate
 import sacrebleu
 from transformers.tokenization_utils import AddedToken
+from hf_generation import generate_samples
+from advantages import compute_advantages, get_eos_index, get_is_terminal
+from gradient_accumulation import GradientAccumulator
+from token_logprobs import batched_log_probs, token_log_probs
 
 
 start_time = time.time()
@@ -49,7 +54,7 @@ def get_policy_model(model_name, src_lang, tgt_lang):
     tokenizer.add_tokens(AddedToken(tgt_lang, normalized=False, special=True))
     return model, tokenizer
 
-def generate_batch_completion(model, tokenizer, prompts: list, return_ids=False, **kwargs):
+def generate_batch_completion(model, tokenizer, prompts: list, return_ids=False, num_samples=1, **kwargs):
     default_sampling_args = {
         'do_sample': True, # FIXME not enough memory in local
         'max_new_tokens': 512,
@@ -61,14 +66,20 @@ def generate_batch_completion(model, tokenizer, prompts: list, return_ids=False,
     model_inputs = tokenizer(prompts, padding='longest', padding_side='left', \
         return_tensors="pt").to(model.device) # No VLLM
     
-    outputs = model.generate(
-        inputs=model_inputs.input_ids,
+    # The encoder runs once per prompt for its num_samples samples
+    outputs = generate_samples(
+        model,
+        model_inputs.input_ids,
+        model_inputs.attention_mask,
+        num_samples=num_samples,
         forced_bos_token_id=tokenizer.convert_tokens_to_ids("way_Latn"), # FIXME convert to param
         **default_sampling_args
     ) # Generation no VLLM
 
     if return_ids:
-        generation_ids = [model_inputs.input_ids.tolist()[0] + list(output) for output in outputs.tolist()]  # Diferent tokenizer model.inputs
+        # Every sample after its own prompt (num_samples consecutive rows per prompt)
+        prompts_ids = model_inputs.input_ids.repeat_interleave(num_samples, dim=0).tolist()
+        generation_ids = [prompt_ids + list(output) for prompt_ids, output in zip(prompts_ids, outputs.tolist())]  # Diferent tokenizer model.inputs
         # padding the generation_ids to the max length
         max_length = max([len(ids) for ids in generation_ids])
         generation_ids = [ids + [tokenizer.pad_token_id]*(max_length-len(ids)) for ids in generation_ids]
@@ -108,24 +119,22 @@ def eval_translations(model, tokenizer, dataset, batches=10, batch_size=128, gen
 
     return bleu_sum/samples_num
 
-def make_rollouts(model, simulations, initial_prompt: str, max_size = 256, temperature=1.0, **kwargs):
-    prompts = [initial_prompt]*simulations
-    
+def make_rollouts(model, simulations, initial_prompt: str|list, max_size = 256, temperature=1.0, **kwargs):
+    prompts = [initial_prompt] if isinstance(initial_prompt, str) else list(initial_prompt)
     with torch.no_grad():
         model_params = {k: v for k, v in kwargs.items() if k not in ["spa", "wayuu"]}
-        generations, prompt_length = generate_batch_completion(model, tokenizer, prompts, return_ids=True, temperature=temperature, top_p=1, max_new_tokens=max_size, **model_params)
+        generations, prompt_length = generate_batch_completion(model, tokenizer, prompts, return_ids=True, temperature=temperature, top_p=1, max_new_tokens=max_size, num_samples=simulations, **model_params)
 
     # Create mask for padding and eos tokens
-    is_terminal = torch.zeros_like(generations, device='cpu')
-    is_terminal[generations == tokenizer.pad_token_id] = 1
-    eos_token = is_terminal.shape[1]-is_terminal.count_nonzero(dim=1)-1
-    is_terminal[torch.arange(len(is_terminal)), eos_token] = 1
-    return generations[:,prompt_length:], is_terminal[:,prompt_length:], generations, prompt_length
+    is_terminal = get_is_terminal(generations[:,prompt_length:], tokenizer.pad_token_id)
+    return generations[:,prompt_length:], is_terminal, generations, prompt_length
 
 def get_rewards_translation_character(samples, is_terminal, correct_translation):
     samples = samples.cpu()
     is_terminal = is_terminal.cpu()
     rewards = torch.zeros_like(samples, dtype=torch.float)
+    # One reference for all the samples, or one per sample when the batch has several prompts
+    correct_translations = [correct_translation]*len(samples) if isinstance(correct_translation, str) else list(correct_translation)
 
     samples = tokenizer.batch_decode(samples, skip_special_tokens=True)
     logger.debug(f'samples: {samples}')
@@ -139,12 +148,11 @@ def get_rewards_translation_character(samples, is_terminal, correct_translation)
         return 1 - score
 
     answer_character_scores = torch.tensor([
-        get_character_score(sample, correct_translation)
-        for sample in samples
+        get_character_score(sample, translation)
+        for sample, translation in zip(samples, correct_translations)
     ])
 
-    eos_index = (is_terminal == 0).sum(dim=1)
-    eos_index = torch.min(eos_index, torch.tensor(is_terminal.shape[1]-1))
+    eos_index = get_eos_index(is_terminal)
 
     # Assign rewards based on character score
     rewards[torch.arange(len(samples)), eos_index] += answer_character_scores
@@ -156,6 +164,8 @@ def get_rewards_translation(samples, is_terminal, correct_translation):
     samples = samples.cpu()
     is_terminal = is_terminal.cpu()
     rewards = torch.zeros_like(samples, dtype=torch.float)
+    # One reference for all the samples, or one per sample when the batch has several prompts
+    correct_translations = [correct_translation]*len(samples) if isinstance(correct_translation, str) else list(correct_translation)
 
     samples = tokenizer.batch_decode(samples, skip_special_tokens=True)
     logger.debug(f'samples: {samples}')
@@ -169,12 +179,11 @@ def get_rewards_translation(samples, is_terminal, correct_translation):
                                    ).score / 100.0 
 
     answer_bleu_scores = torch.tensor([
-        get_bleu_score(sample, correct_translation)
-        for sample in samples
+        get_bleu_score(sample, translation)
+        for sample, translation in zip(samples, correct_translations)
     ])
 
-    eos_index = (is_terminal == 0).sum(dim=1)
-    eos_index = torch.min(eos_index, torch.tensor(is_terminal.shape[1]-1))
+    eos_index = get_eos_index(is_terminal)
 
     # Assign rewards based in BLEU score
     rewards[torch.arange(len(samples)), eos_index] += answer_bleu_scores
@@ -183,10 +192,13 @@ def get_rewards_translation(samples, is_terminal, correct_translation):
     return rewards
 
 def translation_simulation(model, generations_num, temperature=1.0, **kwargs):
-    spanish_text = kwargs['spa']
-    wayuu_text = kwargs['wayuu']
+    # spa and wayuu are a sentence or a list of sentences, every one gets generations_num consecutive rows
+    spanish_text = kwargs.pop('spa')
+    wayuu_text = kwargs.pop('wayuu')
     logger.debug(f'Texto en español: {spanish_text}')
     logger.debug(f'Traducción Wayuu: {wayuu_text}')
+    spanish_texts = [spanish_text] if isinstance(spanish_text, str) else list(spanish_text)
+    wayuu_texts = [wayuu_text] if isinstance(wayuu_text, str) else list(wayuu_text)
 
     # Generate the responses for the prompt
     if 'max_new_tokens' in kwargs:
@@ -194,36 +206,44 @@ def translation_simulation(model, generations_num, temperature=1.0, **kwargs):
         del kwargs['max_new_tokens']
     else:
         max_size = None
-    inputs, is_terminal, complete_prompts, prompt_length = make_rollouts(model, generations_num, spanish_text, temperature=temperature, max_size=max_size, **kwargs)
+    inputs, is_terminal, complete_prompts, prompt_length = make_rollouts(model, generations_num, spanish_texts, temperature=temperature, max_size=max_size, **kwargs)
     # Calculate the rewards for each response
+    wayuu_text = [text for text in wayuu_texts for _ in range(generations_num)]
     rewards = get_rewards_translation(inputs, is_terminal, wayuu_text)
     # rewards = get_rewards_translation_character(inputs, is_terminal, wayuu_text)
     return inputs, rewards, is_terminal, complete_prompts, prompt_length
 
 
-def compute_advantages(rewards, is_terminal, gamma=1.0, gae_lambda=0.2, dr_grpo=False):
-    # Find the longest response in the batch
-    num_rollout_steps = torch.max((is_terminal==0).sum(1))
-    num_rollout_steps = torch.min(num_rollout_steps, torch.tensor(rewards.shape[1])-1)
-    advantages = torch.zeros((len(rewards), torch.tensor(rewards.shape[1])))
-
-    eos_index = (is_terminal == 0).sum(dim=1)
-    eos_index = torch.min(num_rollout_steps, eos_index)
-    rewards_of_outputs = rewards[torch.arange(len(rewards)), eos_index]
-    norm_rewards = (rewards_of_outputs - rewards_of_outputs.mean()) 
-    if not dr_grpo:
-        norm_rewards /= (rewards_of_outputs.std() + 1e-8)
-
-    for i in range(len(rewards)):
-        advantages[i,:eos_index[i]+1] = norm_rewards[i]
 
-    logger.debug(f'advantages: {advantages}')
-    return advantages
-
-
-def update_policy(model, ref_model, old_model, optimizer, is_terminal, advantanges, complete_prompts, prompt_length, generations, minibatch_size, update_epochs, scheduler=None, normalize_advantage=False, lower_clip=None, upper_clip=None, kl_penalty_coef=0.04, dr_grpo=False, no_kl=False, temperature=1.0):
+def reference_log_probs(model, ref_model, complete_prompts, prompt_length, generations, max_tokens, batch_size, temperature=1.0, logprob_chunk_size=None):
+    # Log-probs of the generated tokens under the ref model (the policy without its adapter when ref_model is None)
+    # in no-grad passes of batch_size rows. They only depend on the rollout, so update_policy reuses them across
+    # minibatches and epochs
+    forward_model, context = (ref_model, nullcontext()) if ref_model is not None else (model, model.disable_adapter())
+    def logits_fn(rows):
+        inputs = complete_prompts[rows,:prompt_length]
+        ref_logits = forward_model(
+            input_ids=inputs.to(forward_model.device),
+            attention_mask=(inputs != tokenizer.pad_token_id).long().to(forward_model.device),
+            decoder_input_ids=complete_prompts[rows,prompt_length:].to(forward_model.device)
+        ).logits[:,:max_tokens]
+        ref_logits /= temperature
+        return ref_logits
+    with context:
+        return batched_log_probs(logits_fn, generations[:,:max_tokens], batch_size=batch_size, chunk_size=logprob_chunk_size)
+
+def update_policy(model, old_model, accumulator, is_terminal, advantanges, complete_prompts, prompt_length, generations, minibatch_size, update_epochs, scheduler=None, normalize_advantage=False, lower_clip=None, upper_clip=None, kl_penalty_coef=0.04, dr_grpo=False, no_kl=False, temperature=1.0, logprob_chunk_size=None, ref_log_probs=None):
+    # Every minibatch of every epoch goes through accumulator.backward (GradientAccumulator), and accumulator.step
+    # is called once the batch of an epoch is accumulated. Returns the mean loss and the samples used
+    # ref_log_probs: log-probs of the generated tokens under the ref model (reference_log_probs), None to skip the KL
+    # when it is not in the loss
+    assert ref_log_probs is not None or dr_grpo or no_kl, 'The KL penalty needs ref_log_probs'
     lower_clipped_threshold = lower_clip
     upper_clipped_threshold = upper_clip
+    total_loss = 0.0
+    samples_used = 0
+    minibatches_used = 0
+    optimizer_steps = 0
 
 
     is_terminal = is_terminal.to(model.device)
@@ -232,73 +252,55 @@ def update_policy(model, ref_model, old_model, optimizer, is_terminal, advantang
     for epoch in range(update_epochs):
         batch_indices = np.arange(len(advantanges))
         np.random.shuffle(batch_indices)
-        minibatches= len(advantanges) // minibatch_size
         batch_size = len(batch_indices)
 
         ## Iterate in minibatches (random minibatch_size responses)
         for start in range(0, len(advantanges), minibatch_size):
             end = start + minibatch_size
             minibatch_indices = batch_indices[start:end]
+            minibatch_inputs = complete_prompts[minibatch_indices,:prompt_length]
+            minibatch_attention_mask = (minibatch_inputs != tokenizer.pad_token_id).long()
+            minibatch_decoder_inputs = complete_prompts[minibatch_indices,prompt_length:]
             # Calculate the logits for the generated responses with the policy model (the logits of the previous token represents the distribution of the current token, that's why the -1)
             logits = model(
-                input_ids=complete_prompts.to(model.device)[:,:prompt_length],
-                decoder_input_ids=complete_prompts.to(model.device)[:,prompt_length:]
+                input_ids=minibatch_inputs.to(model.device),
+                attention_mask=minibatch_attention_mask.to(model.device),
+                decoder_input_ids=minibatch_decoder_inputs.to(model.device)
             ).logits
             logits /= temperature
             if old_model is not None:
                 with torch.no_grad():
                     old_logits = old_model(
-                        input_ids=complete_prompts.to(old_model.device)[:,:prompt_length],
-                        decoder_input_ids=complete_prompts.to(old_model.device)[:,prompt_length:]
+                        input_ids=minibatch_inputs.to(old_model.device),
+                        attention_mask=minibatch_attention_mask.to(old_model.device),
+                        decoder_input_ids=minibatch_decoder_inputs.to(old_model.device)
                     ).logits
                     old_logits /= temperature
-            # Calculate the logits for the generated responses with the ref model
-            if ref_model is not None:
-                with torch.no_grad():
-                    ref_logits = ref_model(
-                        input_ids=complete_prompts.to(ref_model.device)[:,:prompt_length],
-                        decoder_input_ids=complete_prompts.to(ref_model.device)[:,prompt_length:]
-                    ).logits
-                    ref_logits /= temperature
-            else:
-                with torch.no_grad():
-                    with model.disable_adapter():
-                        ref_logits = model(
-                            input_ids=complete_prompts.to(model.device)[:,:prompt_length],
-                            decoder_input_ids=complete_prompts.to(model.device)[:,prompt_length:]
-                        ).logits
-                        ref_logits /= temperature
             # Get the ids of the actual generated tokens
-            completion_ids = generations[minibatch_indices]
-            completion_ids = generations[minibatch_indices,:advantanges.shape[1]].reshape(-1)
+            completion_ids = generations[minibatch_indices,:advantanges.shape[1]]
             actual_minibatch_size = len(logits)
             max_tokens = advantanges.shape[1]
-            # Calculate the probabilities of each token generated with the policy and ref model
-            probs = nn.functional.softmax(logits.reshape(actual_minibatch_size*max_tokens,-1), dim=1)
-            probs_tokens = probs[torch.arange(len(completion_ids)), completion_ids].reshape(advantanges.shape)
-            log_probs_sum = torch.log(probs_tokens)
+            # Log-probabilities of each token generated with the policy
+            log_probs_sum = token_log_probs(logits, completion_ids, chunk_size=logprob_chunk_size)
             if old_model:
-                old_probs = nn.functional.softmax(old_logits.reshape(actual_minibatch_size*max_tokens,-1), dim=1)
-                old_probs_tokens = old_probs[torch.arange(len(completion_ids)), completion_ids]
-                log_old_probs_sum = torch.log(old_probs_tokens).reshape(advantanges.shape)
+                log_old_probs_sum = token_log_probs(old_logits, completion_ids, chunk_size=logprob_chunk_size)
             else:
-                old_probs_tokens = probs_tokens.detach().reshape(advantanges.shape)
                 log_old_probs_sum = log_probs_sum.detach()
-            ref_probs = nn.functional.softmax(ref_logits.reshape(actual_minibatch_size*max_tokens,-1), dim=1)
-            ref_probs_tokens = ref_probs[torch.arange(len(completion_ids)), completion_ids]
-            log_ref_probs_sum = torch.log(ref_probs_tokens).reshape(advantanges.shape)
 
             # terminal state is shift to the right so the eos token that has the reward is taken in account
             minibatch_is_not_terminal = torch.cat((torch.ones(actual_minibatch_size,1, device=model.device), 1-is_terminal[minibatch_indices]), dim=1)[:,:advantanges.shape[1]]
 
             # Track KL divergence
-            log_prob_ratio = log_probs_sum - log_ref_probs_sum
-            probability_ratio = log_prob_ratio.exp()
-            minibatch_approx_kl = ((probability_ratio - 1) - log_prob_ratio) * minibatch_is_not_terminal
-            minibatch_approx_kl_by_generation = (minibatch_approx_kl.sum(dim=1) / minibatch_is_not_terminal.count_nonzero(dim=1))
-            minibatch_approx_kl_mean = minibatch_approx_kl_by_generation.mean()
-            logger.info(f'minibatch_approx_kl_by_generation: {minibatch_approx_kl_by_generation}')
-            logger.debug(f'Approx KL divergence of minibatch: {minibatch_approx_kl_mean:.6f}')
+            if ref_log_probs is not None:
+                log_ref_probs_sum = ref_log_probs[minibatch_indices,:max_tokens].to(model.device)
+                log_prob_ratio = log_probs_sum - log_ref_probs_sum
+                probability_ratio = log_prob_ratio.exp()
+                minibatch_approx_kl = ((probability_ratio - 1) - log_prob_ratio) * minibatch_is_not_terminal
+                minibatch_approx_kl_by_generation = (minibatch_approx_kl.sum(dim=1) / minibatch_is_not_terminal.count_nonzero(dim=1))
+                minibatch_approx_kl_mean = minibatch_approx_kl_by_generation.mean()
+                logger.info(f'minibatch_approx_kl_by_generation: {minibatch_approx_kl_by_generation}')
+                logger.debug(f'Approx KL divergence of minibatch: {minibatch_approx_kl_mean:.6f}')
+                logger.debug(f'probability ratio: mean - {probability_ratio.mean()}, min - {probability_ratio.min()}, max: {probability_ratio.max()}')
 
             minibatch_advantages = advantanges[minibatch_indices,:advantanges.shape[1]] * minibatch_is_not_terminal
 
@@ -307,7 +309,6 @@ def update_policy(model, ref_model, old_model, optimizer, is_terminal, advantang
             # Verification in case the old model is the same as the current one
             logger.debug(f'new_old_prob_ratio. This should be 1, {(new_old_prob_ratio*minibatch_is_not_terminal).sum()/minibatch_is_not_terminal.count_nonzero()}')
             loss = new_old_prob_ratio * minibatch_advantages
-            logger.debug(f'probability ratio: mean - {probability_ratio.mean()}, min - {probability_ratio.min()}, max: {probability_ratio.max()}')
             # Clipped loss: Only considers the probability_ratio change between a reasonable range
             if lower_clipped_threshold != None and upper_clipped_threshold != None:
                 clipped_loss = torch.clamp(new_old_prob_ratio, lower_clipped_threshold, upper_clipped_threshold) * minibatch_advantages
@@ -333,11 +334,24 @@ def update_policy(model, ref_model, old_model, optimizer, is_terminal, advantang
 
             logger.debug(f'loss: {loss.item()}')
 
-            return loss
+            # Every minibatch adds its share of the batch loss to the gradients
+            minibatch_weight = actual_minibatch_size / batch_size
+            accumulator.backward(loss * minibatch_weight)
+            total_loss += loss.detach() * minibatch_weight
+            samples_used += actual_minibatch_size
+            minibatches_used += 1
+        # Update the policy weights with the gradients of the whole batch
+        optimizer_steps += accumulator.step()
 
     # Update the scheduler every rl step no matter the epochs
     if scheduler:
         scheduler.step()
+    return {
+        'loss': round(float(total_loss) / update_epochs, 6),
+        'minibatches': minibatches_used,
+        'samples_used': samples_used,
+        'optimizer_steps': optimizer_steps,
+    }
 
 # Cosine scheduler with warmup
 class CosineAnnealingWithWarmup:
@@ -409,9 +423,13 @@ upper_clip=1.2
 dr_grpo = True
 no_kl=True
 max_new_tokens=512 # FIXME poquita memoria GPU
-accum_grad_steps = 4
+accum_grad_steps = 4 # Rollouts per optimizer step, 1 when update_epochs > 1
+prompts_per_step = 1 # Prompts rolled out together in one generate call, each with sims_per_prompt samples
+logprob_chunk_size = 64 # Completion positions per chunk when computing token log-probs, None for all at once
+log_kl = True # Log the KL to the ref model when it is not in the loss (dr_grpo or no_kl), False skips the ref forward
+ref_batch_size = None # Rows per ref forward pass, None for minibatch_size
 
-logger.info(f'Hyperparameters:\nupdate_epochs:{update_epochs}\nrl_steps:{rl_steps}\nsims_per_prompt:{sims_per_prompt}\nminibatch_size:{minibatch_size}\npolicy_lr:{policy_lr}\nwarmup_steps:{warmup_steps}\ngae_lambda: {gae_lambda}\nnormalize advantage:{normalize_advantage}\nlower_clip:{lower_clip}\nupper_clip:{upper_clip}\nkl_penalty_coef:{kl_penalty_coef}\ntemperature:{temperature}\ndr_grpo:{dr_grpo}\nno_kl={no_kl}\n')
+logger.info(f'Hyperparameters:\nupdate_epochs:{update_epochs}\nrl_steps:{rl_steps}\nsims_per_prompt:{sims_per_prompt}\nminibatch_size:{minibatch_size}\npolicy_lr:{policy_lr}\nwarmup_steps:{warmup_steps}\ngae_lambda: {gae_lambda}\nnormalize advantage:{normalize_advantage}\nlower_clip:{lower_clip}\nupper_clip:{upper_clip}\nkl_penalty_coef:{kl_penalty_coef}\ntemperature:{temperature}\ndr_grpo:{dr_grpo}\nno_kl={no_kl}\nprompts_per_step={prompts_per_step}\nlogprob_chunk_size={logprob_chunk_size}\nlog_kl={log_kl}\nref_batch_size={ref_batch_size}\n')
 
 config = LoraConfig(
     r=64, # Rank de las matrices A y B
@@ -442,7 +460,7 @@ ref_model = None
 
 # Load the dataset
 dataset = TextDataset(spanish_train_file, wayuu_train_file)
-dataloader = DataLoader(dataset, batch_size=1, shuffle=True)
+dataloader = DataLoader(dataset, batch_size=prompts_per_step, shuffle=True)
 
 # Load validation dataset
 validation_dataset = TextDataset(spanish_train_file, wayuu_train_file)
@@ -458,33 +476,46 @@ try:
 
     old_model = None
 
+    # The policy weights change every accum_grad_steps rollouts
+    assert update_epochs == 1 or accum_grad_steps == 1, 'Gradients are accumulated across rollouts only with update_epochs=1'
+    gradient_accumulator = GradientAccumulator(model, optimizer, accum_grad_steps=accum_grad_steps, max_grad_norm=0.1)
     rl_step = 0
-    accumulated_grad_steps = 0
-    loss = None
     while rl_step < rl_steps:
         logger.info(f'rl_step: {rl_step+1:,}')
-        spa_sample, wayuu_sample = next(iter(dataloader))
-        spa_sample, wayuu_sample = spa_sample[0], wayuu_sample[0]
-        generations, rewards, is_terminal, complete_prompts, prompt_length = translation_simulation(model, sims_per_prompt, temperature=temperature, spa=spa_sample, wayuu=wayuu_sample, max_new_tokens=max_new_tokens)
-        advantanges = compute_advantages(rewards, is_terminal, gae_lambda=gae_lambda, dr_grpo=dr_grpo)
+        spa_samples, wayuu_samples = next(iter(dataloader))
+        spa_samples, wayuu_samples = list(spa_samples), list(wayuu_samples)
+        rollout_start = time.perf_counter()
+        generations, rewards, is_terminal, complete_prompts, prompt_length = translation_simulation(model, sims_per_prompt, temperature=temperature, spa=spa_samples, wayuu=wayuu_samples, max_new_tokens=max_new_tokens)
+        generated_samples = len(generations)
+        rollout_time = time.perf_counter() - rollout_start
+        generated_tokens = (is_terminal == 0).sum().item()
+        logger.info(f'Rollout: {len(spa_samples)} prompts x {sims_per_prompt} samples, {generated_tokens} tokens, {generated_tokens/rollout_time:.1f} tokens/s')
+        # Samples of the same prompt are consecutive rows
+        group_index = torch.arange(len(spa_samples)).repeat_interleave(sims_per_prompt)
+        advantanges = compute_advantages(rewards, is_terminal, dr_grpo=dr_grpo, group_index=group_index)
+        logger.debug(f'advantages: {advantanges}')
         if (advantanges == 0).all().item():
             torch.cuda.empty_cache() # FIXME se comia toda la GPU rip
             gc.collect()
             continue
 
+        # Ref log-probs once per rollout instead of once per minibatch and epoch
+        ref_log_probs = None
+        ref_forward_passes = 0
+        if log_kl or not (dr_grpo or no_kl):
+            ref_log_probs = reference_log_probs(model, ref_model, complete_prompts, prompt_length, generations, advantanges.shape[1], ref_batch_size or minibatch_size, temperature=temperature, logprob_chunk_size=logprob_chunk_size)
+            ref_forward_passes = math.ceil(len(advantanges) / (ref_batch_size or minibatch_size))
+        per_minibatch_passes = update_epochs * math.ceil(len(advantanges) / minibatch_size)
+        logger.info(f'Ref forward passes: {ref_forward_passes}, saved {per_minibatch_passes - ref_forward_passes} of {per_minibatch_passes}')
+
         logger.info('Updating policy')
         logger.debug(f'Learning rate: {scheduler.get_lr()}')
-        loss = update_policy(model, ref_model, old_model, optimizer, is_terminal, advantanges, complete_prompts, prompt_length, generations, minibatch_size, update_epochs, scheduler=scheduler, normalize_advantage=normalize_advantage, lower_clip=lower_clip, upper_clip=upper_clip, dr_grpo=dr_grpo, no_kl=no_kl, temperature=temperature)
-        loss = loss / accum_grad_steps
-        accumulated_grad_steps += 1
-        loss.backward()
- 
-        if accumulated_grad_steps == accum_grad_steps:
-            # Update the policy weights
-            nn.utils.clip_grad_norm_(model.parameters(), 0.1) # Avoid large gradients
-            optimizer.step()
-            optimizer.zero_grad()
-            accumulated_grad_steps = 0
+        update_start = time.perf_counter()
+        update_stats = update_policy(model, old_model, gradient_accumulator, is_terminal, advantanges, complete_prompts, prompt_length, generations, minibatch_size, update_epochs, scheduler=scheduler, normalize_advantage=normalize_advantage, lower_clip=lower_clip, upper_clip=upper_clip, dr_grpo=dr_grpo, no_kl=no_kl, temperature=temperature, logprob_chunk_size=logprob_chunk_size, ref_log_probs=ref_log_probs)
+        update_time = time.perf_counter() - update_start
+        update_tokens = update_epochs * complete_prompts.numel()
+        logger.info(f'Update: {update_tokens} tokens, {update_tokens/update_time:.1f} tokens/s')
+        logger.info(f'Update: {update_stats}, {update_stats["samples_used"]/generated_samples:.2f} samples used per generated sample')
 
         # Track progress on specific task
         if (rl_step+1)%10 == 0:
@@ -3,6 +3,7 @@ from transformers import AutoModelForCausalLM, AutoTokenizer
 from logging import getLogger
 import logging
 import os
+import math
 import time
 from vllm import LLM, SamplingParams
 from vllm.lora.request import LoRARequest
@@ -12,6 +13,18 @@ import sacrebleu
 from torch.utils.data import Dataset, DataLoader
 from peft import PeftModel
 import evaluate
+from dictionary_tool import spa_to_wayu_dictionary, spa_to_wayu_dictionary_batch
+from calculator_tool import calculator_tool
+from tool_execution import ToolResultCache, ToolExecutor
+from tool_rollout import generate_with_tools
+from rollout_pipeline import RolloutProducer
+from replay_buffer import ReplayBuffer
+from lora_sync import LoRASync
+from gradient_accumulation import GradientAccumulator
+from advantages import compute_advantages, get_eos_index, get_is_terminal
+from packed_sequences import pack_rows, packed_logits
+from token_logprobs import batched_log_probs, completion_logits, token_log_probs
+from hf_generation import generate_samples
 
 os.environ["CUDA_VISIBLE_DEVICES"] = "2"
 
@@ -36,63 +49,29 @@ def get_policy_model(model_name):
     tokenizer = AutoTokenizer.from_pretrained(model_name)
     return model, tokenizer
 
-def calculator_tool(code_str, allowed_names=None):
-    allowed_names = allowed_names or {}
-
-    # Built-in safe functions you might allow
-    safe_builtins = {
-        'abs': abs,
-        'min': min,
-        'max': max,
-        'sum': sum
-    }
-
-    try:
-        result = ' <execution_result> ' + str(eval(code_str, {"__builtins__": safe_builtins, **allowed_names}, {})) + ' </execution_result>'
-        logger.info(f'CORRECT USE OF CALCULATOR TOOL. Code: {code_str}, Result: {result}')
-        return result
-    except Exception as e:
-        return f" <execution_result> Error: {e} </execution_result>"
-    
-def spa_to_wayu_dictionary(spanish_word, max_matches=5):
-    dictionary_path = 'assets/spanish_to_wayuunaiki_short.csv'
-
-    with open(dictionary_path, 'r', encoding='utf-8') as f:
-        all_matches = []
-        line = f.readline()
-        while line != '' and len(all_matches) < max_matches:
-            data = line.strip().split(',')
-            if re.search(rf'\b{re.escape(spanish_word)}\b', data[0], re.IGNORECASE):
-                all_matches.append(data)
-            line = f.readline()
-
-    if len(all_matches) > 0:
-        result = " <matches> " + '\n'.join(f'{spa}: {wayuu}' for spa, wayuu in all_matches) + " </matches>"
-        logger.debug(f'CORRECT USE OF SPA_TO_WAYU TOOL. Word: {spanish_word}, Result: {result}')
-    else:
-        result = " <matches> No matches found </matches>"
-        logger.debug(f'NO_MATCHES SPA_TO_WAYU TOOL. Word: {spanish_word}')
-
-    return result
+dictionary_mode = 'exact' # 'fallback' for accent insensitive and prefix matches of the words without exact matches, 'fuzzy' for them only
 
 TOOLS = [
     {
         'name': 'calculator',
         'description': 'A calculator tool that can perform basic arithmetic operations. You can use it to calculate the result of a mathematical expression.',
         'api': calculator_tool,
+        'timeout_result': ' <execution_result> Error: timed out </execution_result>',
         'start_token': '<calculator>',
         'end_token': '</calculator>',
     },
     {
         'name': 'spa_to_wayu',
         'description': 'A tool that translates a word from Spanish to Wayuunaiki.',
-        'api': spa_to_wayu_dictionary,
+        'api': partial(spa_to_wayu_dictionary, mode=dictionary_mode),
+        'batch_api': partial(spa_to_wayu_dictionary_batch, mode=dictionary_mode),
+        'timeout_result': ' <matches> Error: timed out </matches>',
         'start_token': '<spa_to_wayuu>',
         'end_token': '</spa_to_wayuu>',
     }
 ]
 
-def generate_batch_completion(model, tokenizer, prompts: list, return_ids=False, use_vllm=False, actions_num=1, **kwargs):
+def generate_batch_completion(model, tokenizer, prompts: list, return_ids=False, use_vllm=False, actions_num=1, num_samples=1, return_logprobs=False, **kwargs):
     batch = [[
         {"role": "system", "content": "You are a helpful assistant."},
         {"role": "user", "content": prompt}
@@ -118,68 +97,43 @@ def generate_batch_completion(model, tokenizer, prompts: list, return_ids=False,
     
     if use_vllm:
         inputs = model_inputs.input_ids
-        dones = [False] * len(prompts)
-        prompt_length = [len(input_ids) for input_ids in inputs]
-        mask = [[1] * len(input_ids) for input_ids in inputs]
-        responses = [""] * len(prompts)
         tools_enabled = kwargs.get('tools', [])
         stop_tokens = [tool['end_token'] for tool in tools_enabled] + [tokenizer.eos_token]
-        for action_step in range(actions_num + 1 if len(tools_enabled) > 0 else 1):
-            sampling_params = SamplingParams(temperature=default_sampling_args["temperature"], top_p=default_sampling_args['top_p'], top_k=-1, max_tokens=default_sampling_args['max_new_tokens'],
-                stop=stop_tokens)
-            outputs = model.generate(prompt_token_ids=inputs, sampling_params=sampling_params, lora_request=kwargs['lora_request'], use_tqdm=kwargs['use_tqdm'] if 'use_tqdm' in kwargs else None)
-
-            for j, output in enumerate(outputs):
-                if dones[j]:
-                    continue
-                
-                for tool in tools_enabled:
-                    if output.outputs[0].stop_reason == tool['end_token'] and tool['start_token'] in output.outputs[0].text:
-                        api_args = output.outputs[0].text.split(tool['start_token'])[1].strip()
-                        api_result = tool['api'](api_args)
-                        responses[j] += output.outputs[0].text + f"{tool['end_token']}" + api_result
-                        api_result_tokens = tokenizer.encode(api_result, return_tensors=None)
-                        inputs[j] += list(output.outputs[0].token_ids) + api_result_tokens
-                        mask[j] += [1] * len(output.outputs[0].token_ids) + [0] * len(api_result_tokens)
-                        break # Only one tool can be used at a time
-                if output.outputs[0].finish_reason == "stop" and output.outputs[0].stop_reason is None:
-                    responses[j] += output.outputs[0].text
-                    inputs[j] += list(output.outputs[0].token_ids)
-                    dones[j] = True
-                    mask[j] += [1] * len(output.outputs[0].token_ids)
-                elif output.outputs[0].stop_reason not in stop_tokens:
-                    logger.warning(f"Unexpected finish reason: {output.outputs[0].finish_reason} {output.outputs[0].stop_reason}")
-                    responses[j] += tokenizer.eos_token
-                    inputs[j] += [tokenizer.eos_token_id]
-                    mask[j] += [1]
-                    dones[j] = True
+        sampling_params = SamplingParams(temperature=default_sampling_args["temperature"], top_p=default_sampling_args['top_p'], top_k=-1, max_tokens=default_sampling_args['max_new_tokens'],
+            stop=stop_tokens, logprobs=0 if return_logprobs else None)
+        rollout_buffer, rollout_stats = generate_with_tools(model, tokenizer, inputs, sampling_params, tools_enabled, stop_tokens, actions_num=actions_num, lora_request=kwargs['lora_request'],
+            use_tqdm=kwargs['use_tqdm'] if 'use_tqdm' in kwargs else None, tool_cache=kwargs.get('tool_cache'), tool_executor=kwargs.get('tool_executor'), num_samples=num_samples)
+        logger.debug(f"Generation rounds: {rollout_stats['generation_rounds']}, generated tokens: {rollout_stats['generated_tokens']}")
 
         if return_ids:
-            generation_ids = inputs
-            # padding the generation_ids to the max length
-            max_length = max([len(ids) for ids in generation_ids])
-            generation_ids = [ids + [tokenizer.pad_token_id]*(max_length-len(ids)) for ids in generation_ids]
-            mask = [m + [0]*(max_length-len(m)) for m in mask]
-            generation_ids = torch.tensor(generation_ids)
-            return generation_ids, max(prompt_length), torch.tensor(mask)
-
-        return responses
+            # Prompts are left padded, so every completion starts at rollout_buffer.prompt_length
+            generation_ids, mask = rollout_buffer.tensors()
+            # Log-probs of the sampled tokens (None unless return_logprobs), the behavior policy of the rollout
+            return generation_ids, rollout_buffer.prompt_length, mask, rollout_buffer.log_probs()
+
+        return rollout_buffer.responses()
     
     if 'tools' in kwargs:
         raise NotImplementedError("Only vllm is supported for now when using tools")
         
     model_inputs = model_inputs.to(model.device)
 
-    generated_ids = model.generate(
-        **model_inputs,
-        **default_sampling_args
-    )
+    if return_logprobs:
+        generated_ids, generated_log_probs = generate_samples(model, model_inputs.input_ids, model_inputs.attention_mask, num_samples=num_samples, return_logprobs=True, **default_sampling_args)
+    else:
+        generated_ids = generate_samples(model, model_inputs.input_ids, model_inputs.attention_mask, num_samples=num_samples, **default_sampling_args)
 
     if return_ids:
-        return generated_ids, len(model_inputs.input_ids[0])
+        # Without tools every token is generated by the model
+        mask = torch.ones(generated_ids.shape, dtype=torch.uint8)
+        log_probs = None
+        if return_logprobs:
+            log_probs = torch.zeros(generated_ids.shape)
+            log_probs[:, -generated_log_probs.shape[1]:] = generated_log_probs.cpu()
+        return generated_ids, len(model_inputs.input_ids[0]), mask, log_probs
     
     generated_ids = [
-        output_ids[len(input_ids):] for input_ids, output_ids in zip(model_inputs.input_ids, generated_ids)
+        output_ids[len(input_ids):] for input_ids, output_ids in zip(model_inputs.input_ids.repeat_interleave(num_samples, dim=0), generated_ids)
     ]
 
     response = tokenizer.batch_decode(generated_ids, skip_special_tokens=True)
@@ -259,22 +213,19 @@ def eval_translations(model, tokenizer, dataset, prompt_template, batches=10, ba
     return bleu_sum/samples_num
 
 import torch
-from torch import nn
 
 
 # %%
-def make_rollouts(model, simulations, initial_prompt: str, max_size = 256, temperature=1.0, **kwargs):
-    prompts = [initial_prompt]*simulations
-    
+def make_rollouts(model, simulations, initial_prompt: str|list, max_size = 256, temperature=1.0, **kwargs):
+    # Every prompt is tokenized and prefilled once, and sampled simulations times (consecutive rows)
+    prompts = [initial_prompt] if isinstance(initial_prompt, str) else list(initial_prompt)
     with torch.no_grad():
-        generations, prompt_length, mask = generate_batch_completion(model, tokenizer, prompts, return_ids=True, temperature=temperature, top_p=1, max_new_tokens=max_size, **kwargs)
+        generations, prompt_length, mask, log_probs = generate_batch_completion(model, tokenizer, prompts, return_ids=True, temperature=temperature, top_p=1, max_new_tokens=max_size, num_samples=simulations, **kwargs)
 
     # Create mask for padding and eos tokens
-    is_terminal = torch.zeros_like(generations, device='cpu')
-    is_terminal[generations == tokenizer.pad_token_id] = 1
-    eos_token = is_terminal.shape[1]-is_terminal.count_nonzero(dim=1)-1
-    is_terminal[torch.arange(len(is_terminal)), eos_token] = 1
-    return generations[:,prompt_length:], is_terminal[:,prompt_length:], generations, prompt_length, mask[:,prompt_length:]
+    is_terminal = get_is_terminal(generations[:,prompt_length:], tokenizer.pad_token_id)
+    old_log_probs = log_probs[:,prompt_length:] if log_probs is not None else None
+    return generations[:,prompt_length:], is_terminal, generations, prompt_length, mask[:,prompt_length:], old_log_probs
 
 # %%
 def get_rewards(samples, is_terminal, correct_result):
@@ -286,9 +237,8 @@ def get_rewards(samples, is_terminal, correct_result):
     logger.debug(f'samples: {samples}')
     answer = torch.tensor([extract_answer(response, lambda x: int(x) if x.isnumeric() else correct_result+1, torch.nan) for response in samples])
 
-    eos_index = (is_terminal == 0).sum(dim=1)
-    logger.info(f'Response length mean: {eos_index.to(torch.float16).mean():,.2f}')
-    eos_index = torch.min(eos_index, torch.tensor(is_terminal.shape[1]-1))
+    logger.info(f'Response length mean: {(is_terminal == 0).sum(dim=1).to(torch.float16).mean():,.2f}')
+    eos_index = get_eos_index(is_terminal)
 
     answer_is_correct = (answer == correct_result)
     answer_is_not_correct = (answer != correct_result)
@@ -310,6 +260,8 @@ def get_rewards_translation(samples, is_terminal, correct_translation):
     samples = samples.cpu()
     is_terminal = is_terminal.cpu()
     rewards = torch.zeros_like(samples, dtype=torch.float)
+    # One reference for all the samples, or one per sample when the batch has several prompts
+    correct_translations = [correct_translation]*len(samples) if isinstance(correct_translation, str) else list(correct_translation)
 
     samples = tokenizer.batch_decode(samples, skip_special_tokens=True)
     logger.debug(f'samples: {samples}')
@@ -324,12 +276,11 @@ def get_rewards_translation(samples, is_terminal, correct_translation):
                                    ).score / 100.0 
 
     answer_bleu_scores = torch.tensor([
-        get_bleu_score(sample, correct_translation)
-        for sample in samples
+        get_bleu_score(sample, translation)
+        for sample, translation in zip(samples, correct_translations)
     ])
 
-    eos_index = (is_terminal == 0).sum(dim=1)
-    eos_index = torch.min(eos_index, torch.tensor(is_terminal.shape[1]-1))
+    eos_index = get_eos_index(is_terminal)
 
     # Assign rewards based in BLEU score
     rewards[torch.arange(len(samples)), eos_index] += answer_bleu_scores
@@ -341,6 +292,8 @@ def get_rewards_translation_character(samples, is_terminal, correct_translation)
     samples = samples.cpu()
     is_terminal = is_terminal.cpu()
     rewards = torch.zeros_like(samples, dtype=torch.float)
+    # One reference for all the samples, or one per sample when the batch has several prompts
+    correct_translations = [correct_translation]*len(samples) if isinstance(correct_translation, str) else list(correct_translation)
 
     samples = tokenizer.batch_decode(samples, skip_special_tokens=True)
     logger.debug(f'samples: {samples}')
@@ -356,12 +309,11 @@ def get_rewards_translation_character(samples, is_terminal, correct_translation)
         return 1 - score
 
     answer_character_scores = torch.tensor([
-        get_character_score(sample, correct_translation)
-        for sample in samples
+        get_character_score(sample, translation)
+        for sample, translation in zip(samples, correct_translations)
     ])
 
-    eos_index = (is_terminal == 0).sum(dim=1)
-    eos_index = torch.min(eos_index, torch.tensor(is_terminal.shape[1]-1))
+    eos_index = get_eos_index(is_terminal)
 
     # Assign rewards based on character score
     rewards[torch.arange(len(samples)), eos_index] += answer_character_scores
@@ -386,10 +338,10 @@ def run_one_mul_simulation(model, generations_num, temperature=1.0, **kwargs):
     prompts = [prompt_template.format(prompt.format(*nums)) for nums in numbers]
 
     # Generate the responses for the prompt
-    inputs, is_terminal, complete_prompts, prompt_length, mask = make_rollouts(model, generations_num, prompts[0], temperature=temperature, **kwargs)
+    inputs, is_terminal, complete_prompts, prompt_length, mask, old_log_probs = make_rollouts(model, generations_num, prompts[0], temperature=temperature, **kwargs)
     # Calculate the rewards for each response
     rewards = get_rewards(inputs, is_terminal, correct_result)
-    return inputs, rewards, is_terminal, complete_prompts, prompt_length, mask
+    return inputs, rewards, is_terminal, complete_prompts, prompt_length, mask, old_log_probs
 
 
 translate_prompt_template_tool="""Translate the following Spanish text into Wayuunaiki.
@@ -403,11 +355,14 @@ translate_prompt_template = """Translate the following Spanish text to Wayuunaik
 Provide the translated text inside <answer> and </answer>. For example, <answer> xxx </answer>. Text in spanish: {}"""
 
 def translation_simulation(model, generations_num, temperature=1.0, **kwargs):
-    spanish_text = kwargs['spa']
-    wayuu_text = kwargs['wayuu']
+    # spa and wayuu are a sentence or a list of sentences, every one gets generations_num consecutive rows
+    spanish_text = kwargs.pop('spa')
+    wayuu_text = kwargs.pop('wayuu')
     logger.debug(f'Texto en español: {spanish_text}')
     logger.debug(f'Traducción Wayuu: {wayuu_text}')
-    prompt = translate_prompt_template_tool.format(spanish_text)
+    spanish_texts = [spanish_text] if isinstance(spanish_text, str) else list(spanish_text)
+    wayuu_texts = [wayuu_text] if isinstance(wayuu_text, str) else list(wayuu_text)
+    prompt = [translate_prompt_template_tool.format(text) for text in spanish_texts]
 
     # Generate the responses for the prompt
     if 'max_new_tokens' in kwargs:
@@ -415,42 +370,58 @@ def translation_simulation(model, generations_num, temperature=1.0, **kwargs):
         del kwargs['max_new_tokens']
     else:
         max_size = None
-    inputs, is_terminal, complete_prompts, prompt_length, mask = make_rollouts(model, generations_num, prompt, temperature=temperature, max_size=max_size, **kwargs)
+    inputs, is_terminal, complete_prompts, prompt_length, mask, old_log_probs = make_rollouts(model, generations_num, prompt, temperature=temperature, max_size=max_size, **kwargs)
     # Calculate the rewards for each response
+    wayuu_text = [text for text in wayuu_texts for _ in range(generations_num)]
     rewards = get_rewards_translation(inputs, is_terminal, wayuu_text)
     # rewards = get_rewards_translation_character(inputs, is_terminal, wayuu_text)
-    return inputs, rewards, is_terminal, complete_prompts, prompt_length, mask
+    return inputs, rewards, is_terminal, complete_prompts, prompt_length, mask, old_log_probs
 
 
-# %%
-def compute_advantages(rewards, is_terminal, gamma=1.0, gae_lambda=0.2, dr_grpo=False):
-    # Find the longest response in the batch
-    num_rollout_steps = torch.max((is_terminal==0).sum(1))
-    num_rollout_steps = torch.min(num_rollout_steps, torch.tensor(rewards.shape[1])-1)
-    advantages = torch.zeros((len(rewards), torch.tensor(rewards.shape[1])))
-
-    eos_index = (is_terminal == 0).sum(dim=1)
-    eos_index = torch.min(num_rollout_steps, eos_index)
-    rewards_of_outputs = rewards[torch.arange(len(rewards)), eos_index]
-    norm_rewards = (rewards_of_outputs - rewards_of_outputs.mean()) 
-    # if not dr_grpo:
-    #     norm_rewards /= (rewards_of_outputs.std() + 1e-8)
-    norm_rewards /= (rewards_of_outputs.std() + 1e-8)
-
-    for i in range(len(rewards)):
-        advantages[i,:eos_index[i]+1] = norm_rewards[i]
-
-    logger.debug(f'advantages: {advantages}')
-    return advantages
-
 # %%
 import numpy as np
 
 
 # %%
-def update_policy(model, ref_model, old_model, optimizer, is_terminal, advantanges, complete_prompts, prompt_length, generations, minibatch_size, update_epochs, scheduler=None, normalize_advantage=False, lower_clip=None, upper_clip=None, kl_penalty_coef=0.04, dr_grpo=False, no_kl=False, temperature=1.0, use_deepspeed=False, mask=None):
+def left_padding_inputs(input_ids, pad_token_id):
+    # Attention mask and positions that skip the left padding of the prompts when a batch has several prompts
+    attention_mask = ((input_ids != pad_token_id).cumsum(dim=1) > 0).long()
+    position_ids = (attention_mask.cumsum(dim=1) - 1).clamp(min=0)
+    return attention_mask, position_ids
+
+def reference_log_probs(model, ref_model, complete_prompts, prompt_length, generations, max_tokens, batch_size, temperature=1.0, use_deepspeed=False, logprob_chunk_size=None):
+    # Log-probs of the generated tokens under the ref model (the policy without its adapter when ref_model is None)
+    # in no-grad passes of batch_size rows. They only depend on the rollout, so update_policy reuses them across
+    # minibatches and epochs
+    complete_prompts = complete_prompts.to(model.device)
+    if ref_model is not None:
+        forward_model, context = ref_model, nullcontext()
+    else:
+        forward_model = model
+        context = model.module.disable_adapter() if use_deepspeed else model.disable_adapter()
+    def logits_fn(rows):
+        inputs = complete_prompts[rows,:prompt_length+max_tokens]
+        attention_mask, position_ids = left_padding_inputs(inputs, tokenizer.pad_token_id)
+        ref_logits = completion_logits(forward_model, inputs, max_tokens, attention_mask=attention_mask, position_ids=position_ids)
+        ref_logits /= temperature
+        return ref_logits
+    with context:
+        return batched_log_probs(logits_fn, generations[:,:max_tokens], batch_size=batch_size, chunk_size=logprob_chunk_size)
+
+def update_policy(model, accumulator, is_terminal, advantanges, complete_prompts, prompt_length, generations, minibatch_size, update_epochs, scheduler=None, normalize_advantage=False, lower_clip=None, upper_clip=None, kl_penalty_coef=0.04, dr_grpo=False, no_kl=False, temperature=1.0, use_deepspeed=False, mask=None, old_log_probs=None, logprob_chunk_size=None, ref_log_probs=None, pack_sequences=False):
+    # Every minibatch of every epoch goes through accumulator.backward (GradientAccumulator), and accumulator.step
+    # is called once the batch of an epoch is accumulated. Returns the mean loss and the samples used
+    # old_log_probs: log-probs of the generated tokens under the policy that sampled them, captured at generation,
+    # for the ratio. Without them the ratio is 1 and the clipping does nothing
+    # ref_log_probs: log-probs of the generated tokens under the ref model (reference_log_probs), None to skip the KL
+    # when it is not in the loss
+    assert ref_log_probs is not None or dr_grpo or no_kl, 'The KL penalty needs ref_log_probs'
     lower_clipped_threshold = lower_clip
     upper_clipped_threshold = upper_clip
+    total_loss = 0.0
+    samples_used = 0
+    minibatches_used = 0
+    optimizer_steps = 0
 
 
     is_terminal = is_terminal.to(model.device)
@@ -463,66 +434,51 @@ def update_policy(model, ref_model, old_model, optimizer, is_terminal, advantang
     for epoch in range(update_epochs):
         batch_indices = np.arange(len(advantanges))
         np.random.shuffle(batch_indices)
-        minibatches= len(advantanges) // minibatch_size
         batch_size = len(batch_indices)
 
         ## Iterate in minibatches (random minibatch_size responses)
         for start in range(0, len(advantanges), minibatch_size):
             end = start + minibatch_size
             minibatch_indices = batch_indices[start:end]
-            # Calculate the logits for the generated responses with the policy model (the logits of the previous token represents the distribution of the current token, that's why the -1)
-            logits = model(complete_prompts[minibatch_indices,:prompt_length+advantanges.shape[1]]).logits[:,prompt_length-1:-1]
-            logits /= temperature
-            if old_model is not None:
-                with torch.no_grad():
-                    old_logits  = old_model(complete_prompts[minibatch_indices,:prompt_length+advantanges.shape[1]]).logits[:,prompt_length-1:-1]
-                    old_logits /= temperature
-            # Calculate the logits for the generated responses with the ref model
-            if ref_model is not None:
-                with torch.no_grad():
-                    ref_logits  = ref_model(complete_prompts[minibatch_indices,:prompt_length+advantanges.shape[1]]).logits[:,prompt_length-1:-1]
-                    ref_logits /= temperature
-            else:
-                with torch.no_grad():
-                    if use_deepspeed:
-                        with model.module.disable_adapter():
-                            ref_logits  = model(complete_prompts[minibatch_indices,:prompt_length+advantanges.shape[1]]).logits[:,prompt_length-1:-1]
-                            ref_logits /= temperature
-                    else:
-                        with model.disable_adapter():
-                            ref_logits  = model(complete_prompts[minibatch_indices,:prompt_length+advantanges.shape[1]]).logits[:,prompt_length-1:-1]
-                            ref_logits /= temperature
-            # Get the ids of the actual generated tokens
-            completion_ids = generations[minibatch_indices]
-            completion_ids = generations[minibatch_indices,:advantanges.shape[1]].reshape(-1)
-            actual_minibatch_size = len(logits)
+            actual_minibatch_size = len(minibatch_indices)
             max_tokens = advantanges.shape[1]
-            # Calculate the probabilities of each token generated with the policy and ref model
-            probs = nn.functional.softmax(logits.reshape(actual_minibatch_size*max_tokens,-1), dim=1)
-            probs_tokens = probs[torch.arange(len(completion_ids)), completion_ids].reshape(advantanges.shape)
-            log_probs_sum = torch.log(probs_tokens)
-            if old_model:
-                old_probs = nn.functional.softmax(old_logits.reshape(actual_minibatch_size*max_tokens,-1), dim=1)
-                old_probs_tokens = old_probs[torch.arange(len(completion_ids)), completion_ids]
-                log_old_probs_sum = torch.log(old_probs_tokens).reshape(advantanges.shape)
-            else:
-                old_probs_tokens = probs_tokens.detach().reshape(advantanges.shape)
-                log_old_probs_sum = log_probs_sum.detach()
-            ref_probs = nn.functional.softmax(ref_logits.reshape(actual_minibatch_size*max_tokens,-1), dim=1)
-            ref_probs_tokens = ref_probs[torch.arange(len(completion_ids)), completion_ids]
-            log_ref_probs_sum = torch.log(ref_probs_tokens).reshape(advantanges.shape)
-
             # terminal state is shift to the right so the eos token that has the reward is taken in account
             minibatch_is_not_terminal = torch.cat((torch.ones(actual_minibatch_size,1, device=model.device), 1-is_terminal[minibatch_indices]), dim=1)[:,:advantanges.shape[1]]
+            if pack_sequences:
+                # Prompts and completions (up to the eos) of the minibatch one after the other, without padding
+                packed = pack_rows(complete_prompts[minibatch_indices,:prompt_length+max_tokens], prompt_length, minibatch_is_not_terminal, tokenizer.pad_token_id)
+                logits = packed_logits(model, packed)
+                logits /= temperature
+                # Log-probabilities of the flattened completion tokens, put back in their place in the minibatch
+                packed_log_probs = token_log_probs(logits, packed.completion_ids, chunk_size=logprob_chunk_size)[0]
+                log_probs_sum = torch.zeros(minibatch_is_not_terminal.shape, device=model.device).masked_scatter(minibatch_is_not_terminal.bool(), packed_log_probs)
+            else:
+                minibatch_inputs = complete_prompts[minibatch_indices,:prompt_length+advantanges.shape[1]]
+                minibatch_attention_mask, minibatch_position_ids = left_padding_inputs(minibatch_inputs, tokenizer.pad_token_id)
+                # Calculate the logits for the generated responses with the policy model (the logits of the previous token represents the distribution of the current token, that's why the -1)
+                logits = completion_logits(model, minibatch_inputs, advantanges.shape[1], attention_mask=minibatch_attention_mask, position_ids=minibatch_position_ids)
+                logits /= temperature
+                # Get the ids of the actual generated tokens
+                completion_ids = generations[minibatch_indices,:advantanges.shape[1]]
+                # Log-probabilities of each token generated with the policy
+                log_probs_sum = token_log_probs(logits, completion_ids, chunk_size=logprob_chunk_size)
+            if old_log_probs is not None:
+                log_old_probs_sum = old_log_probs[minibatch_indices,:max_tokens].to(model.device)
+            else:
+                log_old_probs_sum = log_probs_sum.detach()
 
             # Track KL divergence
-            log_prob_ratio = log_probs_sum - log_ref_probs_sum
-            probability_ratio = log_prob_ratio.exp()
-            minibatch_approx_kl = ((probability_ratio - 1) - log_prob_ratio) * minibatch_is_not_terminal
-            minibatch_approx_kl_by_generation = (minibatch_approx_kl.sum(dim=1) / minibatch_is_not_terminal.count_nonzero(dim=1))
-            minibatch_approx_kl_mean = minibatch_approx_kl_by_generation.mean()
-            logger.info(f'minibatch_approx_kl_by_generation: {minibatch_approx_kl_by_generation}')
-            logger.debug(f'Approx KL divergence of minibatch: {minibatch_approx_kl_mean:.6f}')
+            if ref_log_probs is not None:
+                log_ref_probs_sum = ref_log_probs[minibatch_indices,:max_tokens].to(model.device)
+                # Zero outside the generations, where the packed log-probs are 0, so exp cannot overflow
+                log_prob_ratio = (log_probs_sum - log_ref_probs_sum) * minibatch_is_not_terminal
+                probability_ratio = log_prob_ratio.exp()
+                minibatch_approx_kl = ((probability_ratio - 1) - log_prob_ratio) * minibatch_is_not_terminal
+                minibatch_approx_kl_by_generation = (minibatch_approx_kl.sum(dim=1) / minibatch_is_not_terminal.count_nonzero(dim=1))
+                minibatch_approx_kl_mean = minibatch_approx_kl_by_generation.mean()
+                logger.info(f'minibatch_approx_kl_by_generation: {minibatch_approx_kl_by_generation}')
+                logger.debug(f'Approx KL divergence of minibatch: {minibatch_approx_kl_mean:.6f}')
+                logger.debug(f'probability ratio: mean - {probability_ratio.mean()}, min - {probability_ratio.min()}, max: {probability_ratio.max()}')
 
             minibatch_advantages = advantanges[minibatch_indices,:advantanges.shape[1]] * minibatch_is_not_terminal
 
@@ -531,7 +487,6 @@ def update_policy(model, ref_model, old_model, optimizer, is_terminal, advantang
             # Verification in case the old model is the same as the current one
             logger.debug(f'new_old_prob_ratio. This should be 1, {(new_old_prob_ratio*minibatch_is_not_terminal).sum()/minibatch_is_not_terminal.count_nonzero()}')
             loss = new_old_prob_ratio * minibatch_advantages
-            logger.debug(f'probability ratio: mean - {probability_ratio.mean()}, min - {probability_ratio.min()}, max: {probability_ratio.max()}')
             # Clipped loss: Only considers the probability_ratio change between a reasonable range
             if lower_clipped_threshold != None and upper_clipped_threshold != None:
                 clipped_loss = torch.clamp(new_old_prob_ratio, lower_clipped_threshold, upper_clipped_threshold) * minibatch_advantages
@@ -557,20 +512,24 @@ def update_policy(model, ref_model, old_model, optimizer, is_terminal, advantang
 
             logger.debug(f'loss: {loss.item()}')
 
-            # # Update the policy weights
-            # if not use_deepspeed:
-            #     optimizer.zero_grad()
-            #     loss.backward()
-            #     nn.utils.clip_grad_norm_(model.parameters(), 0.1) # Avoid large gradients
-            #     optimizer.step()
-            # else:
-            #     model.backward(loss, scale_wrt_gas=False)
-            #     model.step()
-
-            # Update the scheduler every rl step no matter the epochs
-            if scheduler:
-                scheduler.step()
-            return loss
+            # Every minibatch adds its share of the batch loss to the gradients
+            minibatch_weight = actual_minibatch_size / batch_size
+            accumulator.backward(loss * minibatch_weight)
+            total_loss += loss.detach() * minibatch_weight
+            samples_used += actual_minibatch_size
+            minibatches_used += 1
+        # Update the policy weights with the gradients of the whole batch
+        optimizer_steps += accumulator.step()
+
+    # Update the scheduler every rl step no matter the epochs
+    if scheduler:
+        scheduler.step()
+    return {
+        'loss': round(float(total_loss) / update_epochs, 6),
+        'minibatches': minibatches_used,
+        'samples_used': samples_used,
+        'optimizer_steps': optimizer_steps,
+    }
 
 def update_vllm_instance(vllm_instance, model, just_validate=False)->bool:
     adapter_id = 1
@@ -714,11 +673,29 @@ enabled_tools = ['spa_to_wayu']
 checkpoint_to_start = "models/sft_base_qwen7b_tools"
 # checkpoint_to_start = None
 action_calls = 4
-accum_grad_steps = 8
-logger.info(f'Hyperparameters:\nupdate_epochs:{update_epochs}\nrl_steps:{rl_steps}\nsims_per_prompt:{sims_per_prompt}\nminibatch_size:{minibatch_size}\npolicy_lr:{policy_lr}\nwarmup_steps:{warmup_steps}\ngae_lambda: {gae_lambda}\nnormalize advantage:{normalize_advantage}\nlower_clip:{lower_clip}\nupper_clip:{upper_clip}\nkl_penalty_coef:{kl_penalty_coef}\ntemperature:{temperature}\ndr_grpo:{dr_grpo}\nno_kl={no_kl}\nuse_deepspeed={use_deepspeed}\nuse_vllm={use_vllm}\nenabled_tools={enabled_tools}\nbase_model_name={base_model_name}\nspanish_train_file={spanish_train_file}\nwayuu_train_file={wayuu_train_file}\nmax_new_tokens={max_new_tokens}\ncheckpoint_to_start={checkpoint_to_start}\naccum_grad_steps={accum_grad_steps}\naction_calls={action_calls}\nspanish_val_file={spanish_val_file}\nwayuu_val_file={wayuu_val_file}\nbest_adapter_path={best_adapter_path}\nsave_adapter_path={save_adapter_path}')
+accum_grad_steps = 8 # Rollouts per optimizer step, 1 when update_epochs > 1
+tool_cache_size = 4096 # Tool results kept in the LRU cache
+tool_threads = 8 # Tool calls of a round run concurrently on this many threads
+tool_timeout = 10.0 # Seconds before a tool call of a round is answered with a timeout error
+prompts_per_step = 1 # Prompts rolled out together in one engine call, each with sims_per_prompt samples
+pipeline_rollouts = False # Generate the next rollout with the previous weights while updating on the current one
+max_pending_rollouts = 1 # Rollouts generated ahead of the update when pipelining
+replay_steps = 1 # Rl steps whose rollouts the update samples from (1 only uses the current rollout)
+replay_memory_steps = 2 # Replayed steps kept in memory, older ones are spilled to memory mapped files
+replay_dir = None # Directory of the spilled steps, a temporary one if None
+replay_batch_size = None # Rollouts sampled for each update, the size of a rollout if None
+lora_verify_steps = 50 # Rl steps between checks that vLLM holds the LoRA weights of the policy
+full_lora_validation = False # Debug: compare every LoRA tensor instead of checksums and sampled elements
+logprob_chunk_size = 64 # Completion positions per chunk when computing token log-probs, None for all at once
+log_kl = True # Log the KL to the ref model when it is not in the loss (dr_grpo or no_kl), False skips the ref forward
+ref_batch_size = None # Rows per ref forward pass, None for minibatch_size
+pack_sequences = False # Policy forward of update_policy on the minibatch packed into one row without padding
+logger.info(f'Hyperparameters:\nupdate_epochs:{update_epochs}\nrl_steps:{rl_steps}\nsims_per_prompt:{sims_per_prompt}\nminibatch_size:{minibatch_size}\npolicy_lr:{policy_lr}\nwarmup_steps:{warmup_steps}\ngae_lambda: {gae_lambda}\nnormalize advantage:{normalize_advantage}\nlower_clip:{lower_clip}\nupper_clip:{upper_clip}\nkl_penalty_coef:{kl_penalty_coef}\ntemperature:{temperature}\ndr_grpo:{dr_grpo}\nno_kl={no_kl}\nuse_deepspeed={use_deepspeed}\nuse_vllm={use_vllm}\nenabled_tools={enabled_tools}\ndictionary_mode={dictionary_mode}\nbase_model_name={base_model_name}\nspanish_train_file={spanish_train_file}\nwayuu_train_file={wayuu_train_file}\nmax_new_tokens={max_new_tokens}\ncheckpoint_to_start={checkpoint_to_start}\naccum_grad_steps={accum_grad_steps}\naction_calls={action_calls}\nspanish_val_file={spanish_val_file}\nwayuu_val_file={wayuu_val_file}\nbest_adapter_path={best_adapter_path}\nsave_adapter_path={save_adapter_path}\ntool_cache_size={tool_cache_size}\ntool_threads={tool_threads}\ntool_timeout={tool_timeout}\nprompts_per_step={prompts_per_step}\npipeline_rollouts={pipeline_rollouts}\nmax_pending_rollouts={max_pending_rollouts}\nreplay_steps={replay_steps}\nreplay_memory_steps={replay_memory_steps}\nreplay_dir={replay_dir}\nreplay_batch_size={replay_batch_size}\nlora_verify_steps={lora_verify_steps}\nfull_lora_validation={full_lora_validation}\nlogprob_chunk_size={logprob_chunk_size}\nlog_kl={log_kl}\nref_batch_size={ref_batch_size}\npack_sequences={pack_sequences}')
 
 tools = [tool for tool in TOOLS if tool['name'] in enabled_tools]
-generate_batch_completion = partial(generate_batch_completion, tools=tools, actions_num=action_calls)
+tool_result_cache = ToolResultCache(max_size=tool_cache_size)
+tool_executor = ToolExecutor(max_workers=tool_threads, timeout=tool_timeout)
+generate_batch_completion = partial(generate_batch_completion, tools=tools, actions_num=action_calls, tool_cache=tool_result_cache, tool_executor=tool_executor)
 
 model, tokenizer = get_policy_model(base_model_name)
 # ref_model, _ = get_policy_model()
@@ -768,12 +745,15 @@ if use_deepspeed:
     os.environ["RANK"] = "1"
     os.environ["LOCAL_RANK"] = "1"
     os.environ["WORLD_SIZE"] = "1"
+    # update_policy runs a micro batch per minibatch of every epoch, the weights change every accum_grad_steps rollouts
+    update_rows = (replay_batch_size if replay_steps > 1 else None) or sims_per_prompt*prompts_per_step
+    update_minibatches = math.ceil(update_rows / minibatch_size)
     deepspeed_config = {
             "bf16": {"enabled": True},
             "zero_optimization": {"stage": 2, "overlap_comm": False},
-            "train_batch_size": sims_per_prompt*accum_grad_steps,
+            "train_batch_size": minibatch_size*update_minibatches*accum_grad_steps,
             "train_micro_batch_size_per_gpu": minibatch_size,
-            "gradient_accumulation_steps": accum_grad_steps,
+            "gradient_accumulation_steps": update_minibatches*accum_grad_steps,
             "gradient_clipping": 0.1,
             "optimizer": {
                 "type": "AdamW",
@@ -824,19 +804,44 @@ if use_vllm:
     inference_engine.generate(['Hello'], SamplingParams(max_tokens=2), lora_request=lora_request)
 
     # Update the LoRA weights to match the policy model
-    update_vllm_instance(inference_engine, model_engine)
-    assert update_vllm_instance(inference_engine, model_engine, just_validate=True)
+    lora_sync = LoRASync(inference_engine, model_engine)
+    lora_sync.sync()
+    assert lora_sync.verify(sample_elements=16, full=full_lora_validation)
 
 ref_model = None
 
 # Load the dataset
 dataset = TextDataset(spanish_train_file, wayuu_train_file)
-dataloader = DataLoader(dataset, batch_size=1, shuffle=True)
+dataloader = DataLoader(dataset, batch_size=prompts_per_step, shuffle=True)
 
 # Load validation dataset
 validation_dataset = TextDataset(spanish_train_file, wayuu_train_file)
 
 import copy
+from contextlib import nullcontext
+
+def collect_rollout():
+    spa_samples, wayuu_samples = next(iter(dataloader))
+    spa_samples, wayuu_samples = list(spa_samples), list(wayuu_samples)
+    rollout_start = time.perf_counter()
+    # spa_sample, wayuu_sample = dataset[0]
+    if use_vllm:
+        # rollout = run_one_mul_simulation(inference_engine, sims_per_prompt, temperature=temperature, use_vllm=use_vllm, lora_request=LoRARequest('tuning', 1, lora_path=save_adapter_path))
+        # The log-probs the rollout was sampled with are the old log-probs of the ratio, also for pipelined and replayed rollouts that are older than the policy
+        rollout = translation_simulation(inference_engine, sims_per_prompt, temperature=temperature, use_vllm=use_vllm, lora_request=LoRARequest('tuning', 1, lora_path=save_adapter_path), spa=spa_samples, wayuu=wayuu_samples, max_new_tokens=max_new_tokens, return_logprobs=True)
+    else:
+        # rollout = run_one_mul_simulation(model_engine, sims_per_prompt, temperature=temperature)
+        rollout = translation_simulation(model_engine, sims_per_prompt, temperature=temperature, spa=spa_samples, wayuu=wayuu_samples, max_new_tokens=max_new_tokens, return_logprobs=True)
+    rollout_time = time.perf_counter() - rollout_start
+    is_terminal = rollout[2]
+    generated_tokens = (is_terminal == 0).sum().item()
+    logger.info(f'Rollout: {len(spa_samples)} prompts x {sims_per_prompt} samples, {generated_tokens} tokens, {generated_tokens/rollout_time:.1f} tokens/s')
+    logger.info(f'Tool cache: {tool_result_cache.pop_stats()}')
+    logger.info(f'Tool executor: {tool_executor.pop_stats()}')
+    return spa_samples, rollout
+
+rollout_producer = None
+replay_buffer = ReplayBuffer(tokenizer.pad_token_id, max_steps=replay_steps, in_memory_steps=replay_memory_steps, spill_dir=replay_dir) if replay_steps > 1 else None
 # Training loop
 try:
     model_engine.eval()
@@ -850,22 +855,30 @@ try:
     max_performance = acc
 
     model_engine.train()
-    old_model = None
 
+    if pipeline_rollouts:
+        # The inference engine generates the next rollouts while the policy is updated
+        rollout_producer = RolloutProducer(collect_rollout, max_pending=max_pending_rollouts).start()
+
+    # The policy weights change every accum_grad_steps rollouts
+    assert update_epochs == 1 or accum_grad_steps == 1, 'Gradients are accumulated across rollouts only with update_epochs=1'
+    gradient_accumulator = GradientAccumulator(model_engine, optimizer, accum_grad_steps=accum_grad_steps, max_grad_norm=1.0, use_deepspeed=use_deepspeed)
     rl_step = 0
-    accumulated_grad_steps = 0
     while rl_step < rl_steps:
         logger.info(f'rl_step: {rl_step+1:,}')
-        spa_sample, wayuu_sample = next(iter(dataloader))
-        spa_sample, wayuu_sample = spa_sample[0], wayuu_sample[0]
-        # spa_sample, wayuu_sample = dataset[0]
-        if use_vllm:
-            # generations, rewards, is_terminal, complete_prompts, prompt_length, mask = run_one_mul_simulation(inference_engine, sims_per_prompt, temperature=temperature, use_vllm=use_vllm, lora_request=LoRARequest('tuning', 1, lora_path=save_adapter_path))
-            generations, rewards, is_terminal, complete_prompts, prompt_length, mask = translation_simulation(inference_engine, sims_per_prompt, temperature=temperature, use_vllm=use_vllm, lora_request=LoRARequest('tuning', 1, lora_path=save_adapter_path), spa=spa_sample, wayuu=wayuu_sample, max_new_tokens=max_new_tokens)
+        if rollout_producer is not None:
+            wait_start = time.perf_counter()
+            (spa_samples, rollout), rollout_version = rollout_producer.get()
+            logger.info(f'Rollout staleness: {rollout_producer.staleness(rollout_version)} policy updates, waited {time.perf_counter()-wait_start:.2f} s')
         else:
-            # generations, rewards, is_terminal, complete_prompts, prompt_length = run_one_mul_simulation(model_engine, sims_per_prompt, temperature=temperature)
-            generations, rewards, is_terminal, complete_prompts, prompt_length = translation_simulation(model_engine, sims_per_prompt, temperature=temperature, spa=spa_sample, wayuu=wayuu_sample, max_new_tokens=max_new_tokens)
-        advantanges = compute_advantages(rewards, is_terminal, gae_lambda=gae_lambda, dr_grpo=dr_grpo)
+            spa_samples, rollout = collect_rollout()
+        generations, rewards, is_terminal, complete_prompts, prompt_length, mask, old_log_probs = rollout
+        generated_samples = len(generations)
+        # Samples of the same prompt are consecutive rows
+        group_index = torch.arange(len(spa_samples)).repeat_interleave(sims_per_prompt)
+        # The rewards are divided by the group std with dr_grpo too
+        advantanges = compute_advantages(rewards, is_terminal, group_index=group_index)
+        logger.debug(f'advantages: {advantanges}')
 
         if generations.shape[1] > 320:
             logger.warning(f'Generations shape is too large: {generations.shape}. Skipping this step.')
@@ -873,42 +886,60 @@ try:
         if (advantanges == 0).all().item():
             continue
 
+        if replay_buffer is not None:
+            # The update samples from the rollouts of the last replay_steps steps
+            replay_buffer.add(complete_prompts, prompt_length, is_terminal, advantanges, rewards=rewards, mask=mask, old_log_probs=old_log_probs)
+            logger.info(f'Replay buffer: {replay_buffer.stats()}')
+            replay_batch = replay_buffer.sample(replay_batch_size or len(advantanges))
+            logger.debug(f'Replayed steps: {replay_batch["step_ids"].unique(return_counts=True)}')
+            generations, is_terminal, complete_prompts, prompt_length = replay_batch['generations'], replay_batch['is_terminal'], replay_batch['complete_prompts'], replay_batch['prompt_length']
+            advantanges, mask, old_log_probs = replay_batch['advantages'], replay_batch['mask'], replay_batch['old_log_probs']
+
+        # Ref log-probs once per rollout instead of once per minibatch and epoch
+        ref_log_probs = None
+        ref_forward_passes = 0
+        if log_kl or not (dr_grpo or no_kl):
+            ref_log_probs = reference_log_probs(model_engine, ref_model, complete_prompts, prompt_length, generations, advantanges.shape[1], ref_batch_size or minibatch_size, temperature=temperature, use_deepspeed=use_deepspeed, logprob_chunk_size=logprob_chunk_size)
+            ref_forward_passes = math.ceil(len(advantanges) / (ref_batch_size or minibatch_size))
+        per_minibatch_passes = update_epochs * math.ceil(len(advantanges) / minibatch_size)
+        logger.info(f'Ref forward passes: {ref_forward_passes}, saved {per_minibatch_passes - ref_forward_passes} of {per_minibatch_passes}')
+
         logger.info('Updating policy')
         if scheduler:
             logger.debug(f'Learning rate: {scheduler.get_lr()}')
-        loss = update_policy(model_engine, ref_model, old_model, optimizer, is_terminal, advantanges, complete_prompts, prompt_length, generations, minibatch_size, update_epochs, scheduler=scheduler, normalize_advantage=normalize_advantage, lower_clip=lower_clip, upper_clip=upper_clip, dr_grpo=dr_grpo, no_kl=no_kl, temperature=temperature, use_deepspeed=use_deepspeed, mask=mask)
-        loss = loss / accum_grad_steps
-        accumulated_grad_steps += 1
-        if not use_deepspeed:
-            loss.backward()
-        else:
-            model_engine.backward(loss, scale_wrt_gas=False)
-
-        if use_deepspeed:
-            model_engine.step()
-        elif accumulated_grad_steps == accum_grad_steps:
-            # Update the policy weights
-            nn.utils.clip_grad_norm_(model_engine.parameters(), 1.0) # Avoid large gradients
-            optimizer.step()
-            optimizer.zero_grad()
-            
-            accumulated_grad_steps = 0
+        update_start = time.perf_counter()
+        update_stats = update_policy(model_engine, gradient_accumulator, is_terminal, advantanges, complete_prompts, prompt_length, generations, minibatch_size, update_epochs, scheduler=scheduler, normalize_advantage=normalize_advantage, lower_clip=lower_clip, upper_clip=upper_clip, dr_grpo=dr_grpo, no_kl=no_kl, temperature=temperature, use_deepspeed=use_deepspeed, mask=mask, old_log_probs=old_log_probs, logprob_chunk_size=logprob_chunk_size, ref_log_probs=ref_log_probs, pack_sequences=pack_sequences)
+        update_time = time.perf_counter() - update_start
+        update_tokens = update_epochs * complete_prompts.numel()
+        logger.info(f'Update: {update_tokens} tokens, {update_tokens/update_time:.1f} tokens/s')
+        logger.info(f'Update: {update_stats}, {update_stats["samples_used"]/generated_samples:.2f} samples used per generated sample')
 
 
         if use_vllm:
             # Update the LoRA adapter
-            update_vllm_instance(inference_engine, model_engine)
+            if rollout_producer is not None:
+                rollout_producer.sync(lora_sync.sync)
+            else:
+                lora_sync.sync()
+            logger.info(f'LoRA sync: {lora_sync.pop_stats()}')
+            if (rl_step+1)%lora_verify_steps == 0:
+                # Reads the vLLM buffers, so the producer must not be generating from them
+                with rollout_producer.paused() if rollout_producer is not None else nullcontext():
+                    lora_verified = lora_sync.verify_or_resync(sample_elements=16, full=full_lora_validation)
+                logger.info(f'LoRA verification: {"passed" if lora_verified else "failed, weights resynced"}')
 
         # Track progress on specific task
         if (rl_step+1)%50 == 0:
             model_engine.eval()
-            with torch.no_grad():
+            with torch.no_grad(), rollout_producer.paused() if rollout_producer is not None else nullcontext():
                 if use_vllm:
                     # update_vllm_instance(inference_engine, model_engine)
                     acc = eval_translations(inference_engine, tokenizer, validation_dataset, translate_prompt_template_tool, batches=10, batch_size=64, generate_fn=partial(generate_batch_completion, use_vllm=True, lora_request=lora_request))
                 else:
                     raise ValueError('use_vllm is False')
             logger.info(f'Evaluation on rl step {rl_step+1:,}: {acc}')
+            logger.info(f'Tool cache during evaluation: {tool_result_cache.pop_stats()}')
+            logger.info(f'Tool executor during evaluation: {tool_executor.pop_stats()}')
             model_engine.train()
 
             # Save the model if the performance is better
@@ -927,6 +958,11 @@ try:
 except Exception as error:
     logger.critical(error, exc_info=True)
     pass
+finally:
+    if rollout_producer is not None:
+        rollout_producer.close()
+    if replay_buffer is not None:
+        replay_buffer.close()
 
 model_engine.eval()
 with torch.no_grad():
@@ -0,0 +1,53 @@
+import torch
+
+
+def sampled_log_probs(scores, tokens, eos_token_id=None):
+    # Log-probs of tokens ([rows, steps]) under the processed scores of every step (output_scores), 0 after the eos
+    # of rows that finished, whose remaining tokens are padding
+    log_probs = torch.stack([step_scores.float().log_softmax(dim=-1).gather(1, tokens[:, step, None]).squeeze(1) for step, step_scores in enumerate(scores)], dim=1)
+    if eos_token_id is not None:
+        is_eos = torch.isin(tokens, torch.tensor(eos_token_id, device=tokens.device))
+        finished = (is_eos.cumsum(dim=1) - is_eos.int()) > 0
+        log_probs.masked_fill_(finished, 0.0)
+    return log_probs
+
+def generate_samples(model, input_ids, attention_mask=None, num_samples=1, return_logprobs=False, **generate_kwargs):
+    """
+    model.generate with num_samples samples per prompt, returned as consecutive rows like num_return_sequences.
+
+    For encoder-decoder models num_return_sequences already runs the encoder once per prompt. Decoder-only models
+    would prefill every copy of the prompt, so here all prompt tokens but the last are prefilled once, the cache is
+    repeated num_samples times, and generation continues from the last prompt token.
+
+    With return_logprobs it returns (sequences, log_probs), log_probs ([rows, generated tokens], the last columns of
+    sequences) being the log-probs of the sampled tokens under the distribution they were sampled from, after
+    temperature, top-k and top-p, taken from output_scores.
+    """
+    if return_logprobs:
+        generate_kwargs.update(output_scores=True, return_dict_in_generate=True)
+    if num_samples == 1 or model.config.is_encoder_decoder:
+        outputs = model.generate(input_ids=input_ids, attention_mask=attention_mask, num_return_sequences=num_samples, **generate_kwargs)
+    else:
+        if attention_mask is None:
+            attention_mask = torch.ones_like(input_ids)
+        # Positions skip the left padding, the same way generate computes them
+        position_ids = attention_mask.long().cumsum(-1) - 1
+        position_ids.masked_fill_(attention_mask == 0, 1)
+        with torch.no_grad():
+            # The decoder alone, the logits of the prompt are not needed
+            prefill = model.get_decoder()(input_ids=input_ids[:, :-1], attention_mask=attention_mask[:, :-1], position_ids=position_ids[:, :-1], use_cache=True)
+        past_key_values = prefill.past_key_values
+        past_key_values.batch_repeat_interleave(num_samples)
+        del prefill
+
+        outputs = model.generate(
+            input_ids=input_ids.repeat_interleave(num_samples, dim=0),
+            attention_mask=attention_mask.repeat_interleave(num_samples, dim=0),
+            past_key_values=past_key_values,
+            **generate_kwargs
+        )
+
+    if not return_logprobs:
+        return outputs
+    eos_token_id = generate_kwargs.get('eos_token_id', model.generation_config.eos_token_id)
+    return outputs.sequences, sampled_log_probs(outputs.scores, outputs.sequences[:, -len(outputs.scores):], eos_token_id)
@@ -0,0 +1,182 @@
+import time
+from logging import getLogger
+
+import torch
+
+logger = getLogger(__name__)
+
+# vLLM fuses these projections into one layer whose LoRA weights are lists with one entry per projection
+FUSED_LAYERS_MAPPING = {
+    'gate_up_proj': ['gate_proj', 'up_proj'],
+    'qkv_proj': ['q_proj', 'k_proj', 'v_proj'],
+}
+
+
+def checksum(tensor):
+    # Wrapping sum of the raw bytes of a buffer read as int64 words, over its contiguous storage
+    if not tensor.is_contiguous():
+        tensor = tensor.T
+    if tensor.is_contiguous() and tensor.numel() * tensor.element_size() % 8 == 0:
+        return tensor.reshape(-1).view(torch.int64).sum()
+    return tensor.reshape(-1).view(torch.int16).sum(dtype=torch.int64)
+
+def get_adapter_manager(vllm_instance):
+    return vllm_instance.llm_engine.model_executor.driver_worker.model_runner.lora_manager._adapter_manager
+
+def lora_parameter_names(lora_layer_name, adapter_name='default'):
+    # (index in the vLLM layer, PEFT name of lora_A, PEFT name of lora_B) of every projection in lora_layer_name
+    layer_type = lora_layer_name.split('.')[-1]
+    names = []
+    for i, unfused_layer_name in enumerate(FUSED_LAYERS_MAPPING.get(layer_type, [None])):
+        lora_a_name = lora_layer_name + f'.lora_A.{adapter_name}.weight'
+        lora_b_name = lora_layer_name + f'.lora_B.{adapter_name}.weight'
+        if unfused_layer_name is not None:
+            lora_a_name = lora_a_name.replace(layer_type, unfused_layer_name)
+            lora_b_name = lora_b_name.replace(layer_type, unfused_layer_name)
+        names.append((i, lora_a_name, lora_b_name))
+    return names
+
+
+class LoRASync:
+    """
+    Copies the LoRA weights of a PEFT policy into the adapter adapter_id of a vLLM LLM.
+
+    The first sync maps every vLLM LoRA layer to its PEFT parameters and replaces the vLLM CPU weights with
+    preallocated bf16 buffers (pinned when CUDA is available), transposed as vLLM expects. Every sync
+    then copy_ the parameters into those buffers and reactivates the adapter once, so the GPU copy of the adapter
+    picks up the new weights. The map is rebuilt if vLLM reloads the adapter. Same result as update_vllm_instance.
+
+    Only the parameters modified since the last sync are copied: the checksum of every parameter cast to bf16 is
+    taken on its device and compared with the one of the weights copied last time. Version counters and pointers
+    would miss updates through .data and DeepSpeed copying its fp32 partitions back. When none changed, for
+    instance on the steps of gradient accumulation, the sync does nothing.
+    """
+    def __init__(self, vllm_instance, model, adapter_id=1, adapter_name='default'):
+        self.vllm_instance = vllm_instance
+        self.model = model
+        self.adapter_id = adapter_id
+        self.adapter_name = adapter_name
+        self.lora_model = None
+        self.slots = []
+        self.checksums = []
+        self.latencies = []
+        self.copied_bytes = []
+        self.skipped_syncs = 0
+
+    def build(self):
+        self.lora_model = get_adapter_manager(self.vllm_instance).list_adapters()[self.adapter_id]
+        parameters = dict(self.model.base_model.model.named_parameters())
+        pin_memory = torch.cuda.is_available()
+        self.slots = []
+        for lora_layer_name, vllm_layer in self.lora_model.loras.items():
+            for i, lora_a_name, lora_b_name in lora_parameter_names(lora_layer_name, self.adapter_name):
+                if lora_a_name not in parameters or lora_b_name not in parameters:
+                    logger.warning(f"Layer: {lora_layer_name} not found in state dict. Lora A: {lora_a_name}, Lora B: {lora_b_name}")
+                    continue
+                for attribute, parameter_name in (('lora_a', lora_a_name), ('lora_b', lora_b_name)):
+                    parameter = parameters[parameter_name]
+                    # Transposed view of a buffer laid out like the parameter, so the copy is a contiguous cast
+                    buffer = torch.empty(parameter.shape, dtype=torch.bfloat16, pin_memory=pin_memory).T
+                    weights = getattr(vllm_layer, attribute)
+                    if isinstance(weights, list):
+                        weights[i] = buffer
+                    else:
+                        setattr(vllm_layer, attribute, buffer)
+                    self.slots.append((parameter_name, parameter, buffer, vllm_layer, attribute, i if isinstance(weights, list) else None))
+        self.checksums = [None] * len(self.slots)
+        logger.debug(f'LoRA sync map: {len(self.slots)} tensors, {sum(slot[2].nbytes for slot in self.slots)/2**20:.1f} MiB')
+
+    def activate(self):
+        adapter_manager = get_adapter_manager(self.vllm_instance)
+        adapter_manager.deactivate_adapter(self.adapter_id)
+        assert self.adapter_id not in adapter_manager._active_adapters, f"Adapter {self.adapter_id} was not deactivated!"
+        # Loads the LoRA weights again for the forward pass
+        adapter_manager.activate_adapter(self.adapter_id)
+
+    def source_checksums(self):
+        # Checksums of the parameters in bf16, laid out like the buffers, read back in one transfer
+        if not self.slots:
+            return []
+        checksums = [checksum(parameter.T.to(torch.bfloat16)) for _, parameter, *_ in self.slots]
+        return torch.stack(checksums).cpu().tolist()
+
+    def sync(self)->bool:
+        start = time.perf_counter()
+        if self.lora_model is None or get_adapter_manager(self.vllm_instance).list_adapters().get(self.adapter_id) is not self.lora_model:
+            self.build()
+        copied_bytes = 0
+        copied_slots = []
+        with torch.no_grad():
+            for k, ((_, parameter, buffer, *_), source_checksum) in enumerate(zip(self.slots, self.source_checksums())):
+                if source_checksum == self.checksums[k]:
+                    continue
+                buffer.copy_(parameter.T, non_blocking=buffer.is_pinned())
+                self.checksums[k] = source_checksum
+                copied_bytes += buffer.nbytes
+                copied_slots.append(k)
+        if len(copied_slots) == 0:
+            self.skipped_syncs += 1
+            return True
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        self.activate()
+        self.latencies.append(time.perf_counter() - start)
+        self.copied_bytes.append(copied_bytes)
+        logger.debug(f'LoRA sync: {len(copied_slots)}/{len(self.slots)} tensors, {copied_bytes/2**20:.1f} MiB, {1000*self.latencies[-1]:.1f} ms')
+        return True
+
+    def verify(self, sample_elements=0, full=False)->bool:
+        """
+        Checks that vLLM holds the weights of the policy, raising AssertionError otherwise. Every vLLM LoRA weight
+        must still be the buffer of its parameter, and the checksum of every buffer must match the one of its
+        parameter cast to bf16, which catches copies that failed or were skipped, parameters changed since the sync
+        and buffers overwritten in vLLM. With sample_elements > 0 that many random elements of every parameter are
+        also compared with vLLM's. full compares every tensor, as update_vllm_instance(just_validate=True) does.
+        It is not free: on the 44 MiB adapter of benchmark_lora_sync.py the checksums alone cost about 30% of a
+        full sync, and with sample_elements=16 about 35-40%.
+        """
+        assert self.lora_model is not None and get_adapter_manager(self.vllm_instance).list_adapters().get(self.adapter_id) is self.lora_model, f"Adapter {self.adapter_id} was reloaded since the last sync"
+        for parameter_name, parameter, buffer, vllm_layer, attribute, i in self.slots:
+            vllm_weight = getattr(vllm_layer, attribute) if i is None else getattr(vllm_layer, attribute)[i]
+            assert vllm_weight is buffer, f"LoRA weights of {parameter_name} were replaced in vLLM"
+        with torch.no_grad():
+            source_checksums = self.source_checksums()
+        buffer_checksums = torch.stack([checksum(buffer) for _, _, buffer, *_ in self.slots]).tolist() if self.slots else []
+        for (parameter_name, *_), source_checksum, buffer_checksum in zip(self.slots, source_checksums, buffer_checksums):
+            assert buffer_checksum == source_checksum, f"Checksum of the LoRA weights of {parameter_name} does not match the policy"
+
+        with torch.no_grad():
+            for parameter_name, parameter, buffer, *_ in self.slots:
+                if full:
+                    assert torch.equal(parameter.T.to(torch.bfloat16).to(buffer.device), buffer), f"LoRA weights do not match for {parameter_name}"
+                elif sample_elements > 0:
+                    rows = torch.randint(0, buffer.shape[0], (sample_elements,))
+                    columns = torch.randint(0, buffer.shape[1], (sample_elements,))
+                    sampled = parameter.T[rows.to(parameter.device), columns.to(parameter.device)].to(torch.bfloat16).cpu()
+                    assert torch.equal(sampled, buffer[rows, columns]), f"Sampled LoRA weights do not match for {parameter_name}"
+        return True
+
+    def verify_or_resync(self, sample_elements=0, full=False)->bool:
+        # verify, logging a mismatch and copying every weight again on a rebuilt map instead of raising. False if
+        # vLLM did not hold the weights of the policy
+        try:
+            return self.verify(sample_elements=sample_elements, full=full)
+        except AssertionError as error:
+            logger.warning(f'LoRA verification failed, resyncing every weight: {error}')
+        self.lora_model = None
+        self.sync()
+        return False
+
+    def pop_stats(self):
+        # Syncs that copied weights, and the ones skipped because nothing changed
+        stats = {
+            'syncs': len(self.latencies),
+            'skipped_syncs': self.skipped_syncs,
+            'latency_mean_ms': round(1000 * sum(self.latencies) / len(self.latencies), 2) if self.latencies else 0.0,
+            'latency_max_ms': round(1000 * max(self.latencies), 2) if self.latencies else 0.0,
+            'copied_bytes': sum(self.copied_bytes),
+        }
+        self.latencies = []
+        self.copied_bytes = []
+        self.skipped_syncs = 0
+        return stats
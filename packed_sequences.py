@@ -0,0 +1,48 @@
+from collections import namedtuple
+
+import torch
+
+# input_ids and position_ids: [1, tokens], the rows one after the other with positions restarting at every row.
+# cu_seqlens: [rows+1] boundaries of the rows in the packed stream. logits_indices: positions whose logits predict
+# completion_ids ([1, completion tokens]), the completion tokens of every row in order
+PackedRows = namedtuple('PackedRows', ['input_ids', 'position_ids', 'cu_seqlens', 'logits_indices', 'completion_ids'])
+
+
+def pack_rows(input_ids, prompt_length, completion_mask, pad_token_id):
+    """
+    Packs rows of left padded prompts (the first prompt_length columns of input_ids) followed by their completions
+    into a single row without padding. completion_mask ([rows, completion columns]) marks the completion tokens of
+    every row and must be a prefix of the row, the rest is padding.
+    """
+    completion_mask = completion_mask.bool()
+    prompt_mask = (input_ids[:, :prompt_length] != pad_token_id).cumsum(dim=1) > 0
+    keep = torch.cat((prompt_mask, completion_mask), dim=1)
+    lengths = keep.sum(dim=1)
+    cu_seqlens = torch.nn.functional.pad(lengths.cumsum(dim=0), (1, 0))
+    packed_ids = input_ids[:, :keep.shape[1]][keep]
+    position_ids = torch.arange(len(packed_ids), device=input_ids.device) - cu_seqlens[:-1].repeat_interleave(lengths)
+    # The logits of the token before every completion token
+    is_completion = torch.cat((torch.zeros_like(prompt_mask), completion_mask), dim=1)[keep]
+    logits_indices = is_completion.nonzero().squeeze(1) - 1
+    completion_ids = input_ids[:, prompt_length:prompt_length+completion_mask.shape[1]][completion_mask]
+    return PackedRows(packed_ids[None], position_ids[None], cu_seqlens, logits_indices, completion_ids[None])
+
+def block_causal_mask(cu_seqlens, dtype, device):
+    # [1, 1, tokens, tokens] additive mask: every token attends to the previous tokens of its own row
+    lengths = cu_seqlens[1:] - cu_seqlens[:-1]
+    segments = torch.arange(len(lengths), device=device).repeat_interleave(lengths.to(device))
+    allowed = (segments[:, None] == segments[None, :]).tril()
+    return torch.zeros(allowed.shape, dtype=dtype, device=device).masked_fill_(~allowed, torch.finfo(dtype).min)[None, None]
+
+def packed_logits(model, packed):
+    """
+    Logits of the packed rows at packed.logits_indices, [1, completion tokens, vocab]. flash_attention_2 keeps the
+    rows apart from the position ids alone (varlen attention); the other attention implementations get a block
+    diagonal causal mask.
+    """
+    module = getattr(model, 'module', model) # DeepSpeed engine
+    kwargs = {}
+    if module.config._attn_implementation != 'flash_attention_2':
+        dtype = module.get_input_embeddings().weight.dtype
+        kwargs['attention_mask'] = block_causal_mask(packed.cu_seqlens, dtype, packed.input_ids.device)
+    return model(packed.input_ids, position_ids=packed.position_ids, logits_to_keep=packed.logits_indices, **kwargs).logits
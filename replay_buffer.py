@@ -0,0 +1,161 @@
+import os
+import shutil
+import tempfile
+from logging import getLogger
+
+import numpy as np
+import torch
+
+logger = getLogger(__name__)
+
+# Compact dtypes of the stored fields, completion fields are [rows, completion length]
+FIELDS = {
+    'complete_prompts': np.int32,
+    'is_terminal': np.uint8,
+    'mask': np.uint8,
+    'advantages': np.float32,
+    'old_log_probs': np.float32,
+    'rewards': np.float32, # Reward of every sequence, [rows]
+}
+# Value of the columns added when steps of different lengths are sampled together
+PADDING = {
+    'is_terminal': 1,
+    'mask': 0,
+    'advantages': 0.0,
+    'old_log_probs': 0.0,
+}
+
+
+class ReplayBuffer:
+    """
+    Rollouts of the last max_steps rl steps, so update passes can sample minibatches across several of them.
+
+    The in_memory_steps most recent steps are kept as numpy arrays with the dtypes in FIELDS; older steps are
+    written to .npy files in spill_dir (a temporary directory if None) and read back through memory maps, and
+    steps older than max_steps are deleted. sample() returns rows of any retained steps in the format update_policy
+    takes: prompts left padded to the longest prompt and completions right padded to the longest completion.
+    """
+    def __init__(self, pad_token_id, max_steps=4, in_memory_steps=2, spill_dir=None):
+        self.pad_token_id = pad_token_id
+        self.max_steps = max_steps
+        self.in_memory_steps = in_memory_steps
+        self.owns_spill_dir = spill_dir is None
+        self.spill_dir = spill_dir or tempfile.mkdtemp(prefix='replay_buffer_')
+        os.makedirs(self.spill_dir, exist_ok=True)
+        self.steps = []
+        self.added_steps = 0
+
+    def add(self, complete_prompts, prompt_length, is_terminal, advantages, rewards=None, mask=None, old_log_probs=None):
+        # Tensors of one rl step as returned by make_rollouts/compute_advantages, rewards may be per token
+        rows = len(complete_prompts)
+        completion_length = advantages.shape[1]
+        if rewards is not None and rewards.dim() > 1:
+            eos_index = (is_terminal == 0).sum(dim=1).clamp(max=rewards.shape[1]-1)
+            rewards = rewards[torch.arange(rows), eos_index]
+        step = {
+            'complete_prompts': complete_prompts[:, :prompt_length+completion_length],
+            'is_terminal': is_terminal[:, :completion_length],
+            'mask': mask[:, :completion_length] if mask is not None else None,
+            'advantages': advantages,
+            'old_log_probs': old_log_probs[:, :completion_length] if old_log_probs is not None else None,
+            'rewards': rewards,
+        }
+        step = {name: torch.as_tensor(value).cpu().numpy().astype(FIELDS[name], copy=False) for name, value in step.items() if value is not None}
+        step['prompt_length'] = prompt_length
+        step['id'] = self.added_steps
+        self.steps.append(step)
+        self.added_steps += 1
+
+        while len(self.steps) > self.max_steps:
+            self.drop(self.steps.pop(0))
+        for old_step in self.steps[:-self.in_memory_steps or None]:
+            if not old_step.get('spilled'):
+                self.spill(old_step)
+
+    def step_path(self, step, name):
+        return os.path.join(self.spill_dir, f'step_{step["id"]}_{name}.npy')
+
+    def spill(self, step):
+        for name in FIELDS:
+            if name in step:
+                np.save(self.step_path(step, name), step[name])
+                step[name] = np.load(self.step_path(step, name), mmap_mode='r')
+        step['spilled'] = True
+
+    def drop(self, step):
+        if step.get('spilled'):
+            for name in FIELDS:
+                if name in step:
+                    del step[name] # Close the memory map before removing its file
+                    os.remove(self.step_path(step, name))
+
+    def __len__(self):
+        return sum(len(step['advantages']) for step in self.steps)
+
+    def sample(self, batch_size, last_steps=None, rng=None):
+        """
+        batch_size rows drawn without replacement from the last_steps most recent steps (all if None). Returns a
+        dict with complete_prompts, prompt_length, generations, is_terminal, advantages, mask, old_log_probs and
+        rewards (the last three None when any sampled step lacks them) and step_ids, the step of every row.
+        """
+        rng = rng or np.random.default_rng()
+        steps = self.steps[-last_steps:] if last_steps else self.steps
+        step_rows = np.array([len(step['advantages']) for step in steps])
+        rows = rng.choice(step_rows.sum(), size=min(batch_size, step_rows.sum()), replace=False)
+        step_index = np.searchsorted(np.cumsum(step_rows), rows, side='right')
+        row_index = rows - np.concatenate([[0], np.cumsum(step_rows)[:-1]])[step_index]
+
+        prompt_length = max(steps[i]['prompt_length'] for i in set(step_index.tolist()))
+        completion_length = max(steps[i]['advantages'].shape[1] for i in set(step_index.tolist()))
+        batch = {
+            'complete_prompts': np.full((len(rows), prompt_length + completion_length), self.pad_token_id, dtype=FIELDS['complete_prompts']),
+            'step_ids': np.empty(len(rows), dtype=np.int64),
+        }
+        for name in ['is_terminal', 'mask', 'advantages', 'old_log_probs']:
+            if all(name in steps[i] for i in set(step_index.tolist())):
+                batch[name] = np.full((len(rows), completion_length), PADDING[name], dtype=FIELDS[name])
+        if all('rewards' in steps[i] for i in set(step_index.tolist())):
+            batch['rewards'] = np.empty(len(rows), dtype=FIELDS['rewards'])
+
+        for i in sorted(set(step_index.tolist())):
+            step = steps[i]
+            selected = step_index == i
+            # Sorted rows keep the reads of a memory map sequential
+            order = np.argsort(row_index[selected])
+            out_rows = np.flatnonzero(selected)[order]
+            in_rows = row_index[selected][order]
+            step_prompt_length = step['prompt_length']
+            step_completion_length = step['advantages'].shape[1]
+            batch['complete_prompts'][out_rows, prompt_length-step_prompt_length:prompt_length+step_completion_length] = step['complete_prompts'][in_rows]
+            batch['step_ids'][out_rows] = step['id']
+            for name in ['is_terminal', 'mask', 'advantages', 'old_log_probs']:
+                if name in batch:
+                    batch[name][out_rows, :step_completion_length] = step[name][in_rows]
+            if 'rewards' in batch:
+                batch['rewards'][out_rows] = step['rewards'][in_rows]
+
+        batch = {name: torch.from_numpy(value) for name, value in batch.items()}
+        batch['prompt_length'] = prompt_length
+        batch['generations'] = batch['complete_prompts'][:, prompt_length:]
+        for name in ['mask', 'old_log_probs', 'rewards']:
+            batch.setdefault(name, None)
+        return batch
+
+    def stats(self):
+        in_memory_bytes = sum(step[name].nbytes for step in self.steps if not step.get('spilled') for name in FIELDS if name in step)
+        spilled_bytes = sum(step[name].nbytes for step in self.steps if step.get('spilled') for name in FIELDS if name in step)
+        rows = len(self)
+        return {
+            'steps': len(self.steps),
+            'rollouts': rows,
+            'in_memory_bytes': in_memory_bytes,
+            'spilled_bytes': spilled_bytes,
+            'bytes_per_1k_rollouts': (in_memory_bytes + spilled_bytes) * 1000 // max(rows, 1),
+        }
+
+    def close(self):
+        for step in self.steps:
+            self.drop(step)
+        self.steps = []
+        if self.owns_spill_dir:
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
@@ -0,0 +1,83 @@
+import numpy as np
+import torch
+
+
+class RolloutBuffer:
+    """
+    Token ids (int32) and mask (uint8, 0 for tool result tokens and padding) of a batch of rollouts, kept in
+    preallocated arrays. Prompts are left padded to the longest one, so every completion starts at the same
+    column, and completions are right padded.
+
+    Segments are copied once into their row, and rows grow by doubling the capacity when a segment does not fit,
+    so appends are amortized O(1) per token. tensors() returns views of the arrays without copying. The text of
+    each segment is kept as given and only joined when responses() is called.
+    Log-probs of the sampled tokens (float32, 0 elsewhere) are only allocated once a segment comes with them.
+    """
+    def __init__(self, prompts_token_ids, pad_token_id, max_new_tokens=256):
+        self.pad_token_id = pad_token_id
+        self.prompt_lengths = np.array([len(token_ids) for token_ids in prompts_token_ids], dtype=np.int64)
+        self.prompt_length = int(self.prompt_lengths.max(initial=0))
+        self.offsets = self.prompt_length - self.prompt_lengths
+        self.lengths = np.full(len(prompts_token_ids), self.prompt_length, dtype=np.int64)
+        capacity = self.prompt_length + max_new_tokens
+        self.ids = np.full((len(prompts_token_ids), capacity), pad_token_id, dtype=np.int32)
+        self.mask = np.zeros((len(prompts_token_ids), capacity), dtype=np.uint8)
+        for j, token_ids in enumerate(prompts_token_ids):
+            self.ids[j, self.offsets[j]:self.prompt_length] = token_ids
+            self.mask[j, self.offsets[j]:self.prompt_length] = 1
+        self.texts = [[] for _ in prompts_token_ids]
+        self.logprobs = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def grow(self, min_capacity):
+        capacity = max(min_capacity, 2 * self.ids.shape[1])
+        ids = np.full((len(self.ids), capacity), self.pad_token_id, dtype=np.int32)
+        mask = np.zeros((len(self.ids), capacity), dtype=np.uint8)
+        ids[:, :self.ids.shape[1]] = self.ids
+        mask[:, :self.mask.shape[1]] = self.mask
+        if self.logprobs is not None:
+            logprobs = np.zeros((len(self.ids), capacity), dtype=np.float32)
+            logprobs[:, :self.logprobs.shape[1]] = self.logprobs
+            self.logprobs = logprobs
+        self.ids, self.mask = ids, mask
+
+    def append(self, j, token_ids, mask_value=1, text='', logprobs=None):
+        start = self.lengths[j]
+        end = start + len(token_ids)
+        if end > self.ids.shape[1]:
+            self.grow(end)
+        self.ids[j, start:end] = token_ids
+        self.mask[j, start:end] = mask_value
+        if logprobs is not None:
+            if self.logprobs is None:
+                self.logprobs = np.zeros(self.ids.shape, dtype=np.float32)
+            self.logprobs[j, start:end] = logprobs
+        self.lengths[j] = end
+        if text:
+            self.texts[j].append(text)
+
+    def token_ids(self, j):
+        # Token ids of row j as a list, the format vLLM takes prompts in
+        return self.ids[j, self.offsets[j]:self.lengths[j]].tolist()
+
+    def sequences(self):
+        return [self.token_ids(j) for j in range(len(self))]
+
+    def masks(self):
+        return [self.mask[j, self.offsets[j]:self.lengths[j]].tolist() for j in range(len(self))]
+
+    def responses(self):
+        return [''.join(texts) for texts in self.texts]
+
+    def tensors(self):
+        # Padded token ids and mask up to the longest row, sharing memory with the buffer
+        max_length = int(self.lengths.max(initial=0))
+        return torch.from_numpy(self.ids[:, :max_length]), torch.from_numpy(self.mask[:, :max_length])
+
+    def log_probs(self):
+        # Same columns as tensors(), None when no segment had log-probs
+        if self.logprobs is None:
+            return None
+        return torch.from_numpy(self.logprobs[:, :int(self.lengths.max(initial=0))])
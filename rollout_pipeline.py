@@ -0,0 +1,82 @@
+import queue
+import threading
+from contextlib import contextmanager
+from logging import getLogger
+
+logger = getLogger(__name__)
+
+
+class RolloutProducer:
+    """
+    Generates rollouts in a background thread while the trainer updates on the previous ones.
+
+    rollout_fn() is called in a loop and its results are kept in a queue of max_pending rollouts, so generation
+    runs at most max_pending steps ahead of training. Anything else that uses the inference engine (weight syncs,
+    evaluations) runs inside paused(), which waits for the rollout in progress and keeps the producer from
+    starting a new one. sync() also counts policy versions, and get() returns the version a rollout was
+    generated with, so the trainer can log how stale it is.
+    """
+    def __init__(self, rollout_fn, max_pending=1):
+        self.rollout_fn = rollout_fn
+        self.rollouts = queue.Queue(maxsize=max_pending)
+        self.engine_lock = threading.Lock()
+        self.resumed = threading.Event()
+        self.resumed.set()
+        self.stopped = threading.Event()
+        self.policy_version = 0
+        self.thread = threading.Thread(target=self.run, name='rollout-producer', daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.resumed.wait()
+            try:
+                with self.engine_lock:
+                    if self.stopped.is_set():
+                        break
+                    version = self.policy_version
+                    item = (self.rollout_fn(), version, None)
+            except Exception as error:
+                item = (None, None, error)
+            while not self.stopped.is_set():
+                try:
+                    self.rollouts.put(item, timeout=0.1)
+                    break
+                except queue.Full:
+                    continue
+            if item[2] is not None:
+                break
+
+    def get(self):
+        # Next rollout and the policy version it was generated with, errors of rollout_fn are raised here
+        rollout, version, error = self.rollouts.get()
+        if error is not None:
+            raise error
+        return rollout, version
+
+    def staleness(self, version):
+        return self.policy_version - version
+
+    @contextmanager
+    def paused(self):
+        self.resumed.clear()
+        try:
+            with self.engine_lock:
+                yield
+        finally:
+            self.resumed.set()
+
+    def sync(self, sync_fn, *args, **kwargs):
+        # Updates the inference weights between two rollouts
+        with self.paused():
+            result = sync_fn(*args, **kwargs)
+            self.policy_version += 1
+        return result
+
+    def close(self):
+        self.stopped.set()
+        self.resumed.set()
+        self.thread.join()
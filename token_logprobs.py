@@ -0,0 +1,58 @@
+import torch
+
+
+class TokenLogProbs(torch.autograd.Function):
+    # log_softmax gathered at token_ids, written as logit - logsumexp one chunk of positions at a time. Only the
+    # logsumexp of every position is kept for backward, which writes softmax - one_hot into the gradient chunk by chunk
+    @staticmethod
+    def forward(ctx, logits, token_ids, chunk_size):
+        log_probs = torch.empty(token_ids.shape, dtype=torch.float32, device=logits.device)
+        logsumexp = torch.empty_like(log_probs)
+        for start in range(0, logits.shape[1], chunk_size):
+            chunk_logits = logits[:, start:start+chunk_size].float()
+            logsumexp[:, start:start+chunk_size] = torch.logsumexp(chunk_logits, dim=-1)
+            log_probs[:, start:start+chunk_size] = chunk_logits.gather(-1, token_ids[:, start:start+chunk_size].unsqueeze(-1)).squeeze(-1)
+        log_probs -= logsumexp
+        ctx.save_for_backward(logits, token_ids, logsumexp)
+        ctx.chunk_size = chunk_size
+        return log_probs
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        logits, token_ids, logsumexp = ctx.saved_tensors
+        grad_logits = torch.empty_like(logits)
+        for start in range(0, logits.shape[1], ctx.chunk_size):
+            chunk = slice(start, start+ctx.chunk_size)
+            chunk_grad = grad_output[:, chunk].float()
+            grad = (logits[:, chunk].float() - logsumexp[:, chunk].unsqueeze(-1)).exp_().mul_(-chunk_grad.unsqueeze(-1))
+            grad.scatter_add_(-1, token_ids[:, chunk].unsqueeze(-1), chunk_grad.unsqueeze(-1))
+            grad_logits[:, chunk] = grad
+        return grad_logits, None, None
+
+
+def token_log_probs(logits, token_ids, chunk_size=None):
+    """
+    Log-probabilities of token_ids ([batch, tokens]) under logits ([batch, tokens, vocab]), in float32.
+
+    Same values as log(softmax(logits)) at the tokens without materializing the probabilities: besides the logits,
+    forward keeps one float per position and backward allocates only the gradient of the logits. With chunk_size the
+    positions are processed chunk_size at a time, so the float32 temporaries are [batch, chunk_size, vocab].
+    """
+    token_ids = token_ids.to(logits.device).long()
+    return TokenLogProbs.apply(logits, token_ids, chunk_size or logits.shape[1])
+
+def completion_logits(model, input_ids, completion_length, **kwargs):
+    # Logits predicting the last completion_length tokens of input_ids, the LM head applied only to those positions
+    # (the logits of the previous token represent the distribution of the current token)
+    return model(input_ids, logits_to_keep=completion_length+1, **kwargs).logits[:,:-1]
+
+def batched_log_probs(logits_fn, token_ids, batch_size=None, chunk_size=None):
+    # Log-probs of token_ids ([rows, tokens]) without grad, logits_fn(rows) returning the logits of a slice of rows,
+    # batch_size rows per forward pass
+    batch_size = batch_size or len(token_ids)
+    log_probs = []
+    with torch.no_grad():
+        for start in range(0, len(token_ids), batch_size):
+            rows = slice(start, start+batch_size)
+            log_probs.append(token_log_probs(logits_fn(rows), token_ids[rows], chunk_size=chunk_size))
+    return torch.cat(log_probs)
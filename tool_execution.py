@@ -0,0 +1,242 @@
+import asyncio
+import math
+import time
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from logging import getLogger
+
+logger = getLogger(__name__)
+
+# Result of a timed out call for tools without 'timeout_result', framed like the dictionary results
+TOOL_TIMEOUT_RESULT = ' <matches> Error: timed out </matches>'
+
+
+def single_call_batch_api(api):
+    # Adapter for tools that only know how to answer one call at a time
+    def batch_api(api_args_list):
+        return [api(api_args) for api_args in api_args_list]
+    return batch_api
+
+def get_batch_api(tool):
+    return tool['batch_api'] if 'batch_api' in tool else single_call_batch_api(tool['api'])
+
+class ToolResultCache:
+    """
+    Bounded LRU cache of tool results, keyed by tool name and normalized arguments.
+
+    Tools can define 'normalize_args' to map equivalent arguments to the same key, only when their results are
+    the same for all of them (the dictionary is case insensitive but repeats the casing of the call, so it keeps
+    the default str.strip). Next to each result the tokenized result is kept, so the tool loop can skip
+    tokenizer.encode on a hit.
+    """
+    def __init__(self, max_size=4096):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.token_hits = 0
+
+    def key(self, tool, api_args):
+        normalize_args = tool.get('normalize_args', str.strip)
+        return tool['name'], normalize_args(api_args)
+
+    def get(self, tool, api_args):
+        key = self.key(tool, api_args)
+        if key not in self.entries:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return self.entries[key]['result']
+
+    def put(self, tool, api_args, api_result):
+        key = self.key(tool, api_args)
+        self.entries[key] = {'result': api_result, 'tokens': None}
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def encode(self, tokenizer, tool, api_args, api_result):
+        entry = self.entries.get(self.key(tool, api_args))
+        if entry is None or entry['result'] != api_result:
+            return tokenizer.encode(api_result, return_tensors=None)
+        if entry['tokens'] is None:
+            entry['tokens'] = tokenizer.encode(api_result, return_tensors=None)
+        else:
+            self.token_hits += 1
+        return entry['tokens']
+
+    def pop_stats(self):
+        # Returns the counters since the last call and resets them
+        stats = {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'token_hits': self.token_hits,
+            'size': len(self.entries),
+        }
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / lookups if lookups > 0 else 0.0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.token_hits = 0
+        return stats
+
+def timed_call(api, api_args):
+    start = time.perf_counter()
+    api_result = api(api_args)
+    return api_result, time.perf_counter() - start
+
+def percentile(values, q):
+    # Nearest rank percentile, q in [0, 100], 0.0 without values
+    if len(values) == 0:
+        return 0.0
+    values = sorted(values)
+    return values[max(0, math.ceil(q / 100 * len(values)) - 1)]
+
+class ToolExecutor:
+    """
+    Thread pool running the tool calls of a generation round concurrently.
+
+    Every api call (a whole batch for tools with 'batch_api') is one task. A call that does not finish within
+    timeout seconds of the round start gets the tool 'timeout_result' (TOOL_TIMEOUT_RESULT by default) for each
+    of its calls. Threads can not be interrupted, so a timed out call keeps its worker until it returns.
+    run_async runs a single call for the streaming tool loop, on the same pool and with the same timeout.
+    Call latencies and the pool utilization (busy worker time over max_workers times the round time) are logged
+    per round and aggregated until pop_stats.
+    """
+    def __init__(self, max_workers=8, timeout=None):
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='tool')
+        self.latencies = []
+        self.timeouts = 0
+        self.rounds = 0
+        self.busy_seconds = 0.0
+        self.round_seconds = 0.0
+
+    def run(self, jobs):
+        """
+        Runs jobs, a list of (api, api_args) pairs, and returns their results in order, None for the ones that
+        timed out.
+        """
+        if len(jobs) == 0:
+            # Round without tool calls, or with every call in the cache
+            return []
+        start = time.perf_counter()
+        futures = [self.pool.submit(timed_call, api, api_args) for api, api_args in jobs]
+        api_results = []
+        latencies = []
+        for future in futures:
+            try:
+                if self.timeout is None:
+                    api_result, latency = future.result()
+                else:
+                    api_result, latency = future.result(timeout=max(0.0, start + self.timeout - time.perf_counter()))
+            except TimeoutError:
+                future.cancel()
+                api_result, latency = None, self.timeout
+                self.timeouts += 1
+            api_results.append(api_result)
+            latencies.append(latency)
+        round_seconds = time.perf_counter() - start
+
+        utilization = sum(latencies) / (round_seconds * self.max_workers) if round_seconds > 0 else 0.0
+        logger.debug(f'Tool round: {len(jobs)} calls, p50 {percentile(latencies, 50)*1000:.1f} ms, p99 {percentile(latencies, 99)*1000:.1f} ms, utilization {utilization:.2f}')
+        self.latencies += latencies
+        self.rounds += 1
+        self.busy_seconds += sum(latencies)
+        self.round_seconds += round_seconds
+        return api_results
+
+    async def run_async(self, api, api_args):
+        # Result of one api call awaited from the event loop, None if it timed out
+        future = asyncio.wrap_future(self.pool.submit(timed_call, api, api_args))
+        try:
+            api_result, latency = await asyncio.wait_for(future, self.timeout)
+        except asyncio.TimeoutError:
+            api_result, latency = None, self.timeout
+            self.timeouts += 1
+        self.latencies.append(latency)
+        self.busy_seconds += latency
+        return api_result
+
+    def pop_stats(self):
+        # Returns the stats since the last call and resets them
+        stats = {
+            'rounds': self.rounds,
+            'calls': len(self.latencies),
+            'timeouts': self.timeouts,
+            'latency_p50_ms': percentile(self.latencies, 50) * 1000,
+            'latency_p99_ms': percentile(self.latencies, 99) * 1000,
+            'utilization': self.busy_seconds / (self.round_seconds * self.max_workers) if self.round_seconds > 0 else 0.0,
+        }
+        self.latencies = []
+        self.timeouts = 0
+        self.rounds = 0
+        self.busy_seconds = 0.0
+        self.round_seconds = 0.0
+        return stats
+
+def run_tool_calls(tool_calls, cache=None, executor=None):
+    """
+    Runs all the tool calls of a generation round, given as (tool, api_args) pairs.
+    Cached results are reused, the remaining calls are grouped by tool so every tool receives a single batch,
+    and results are returned in the order of tool_calls. With an executor (ToolExecutor) the batches, and the
+    single calls of tools without 'batch_api', run concurrently.
+    """
+    api_results = [None] * len(tool_calls)
+    calls_by_tool = defaultdict(list)
+    tools_by_name = {}
+    for call_index, (tool, api_args) in enumerate(tool_calls):
+        if cache is not None:
+            api_results[call_index] = cache.get(tool, api_args)
+            if api_results[call_index] is not None:
+                continue
+        calls_by_tool[tool['name']].append((call_index, api_args))
+        tools_by_name[tool['name']] = tool
+
+    if executor is None:
+        for tool_name, calls in calls_by_tool.items():
+            tool = tools_by_name[tool_name]
+            batch_results = get_batch_api(tool)([api_args for _, api_args in calls])
+            for (call_index, api_args), api_result in zip(calls, batch_results):
+                api_results[call_index] = api_result
+                if cache is not None:
+                    cache.put(tool, api_args, api_result)
+        return api_results
+
+    # Every job is one api call and answers the calls in job_calls
+    jobs = []
+    job_calls = []
+    for tool_name, calls in calls_by_tool.items():
+        tool = tools_by_name[tool_name]
+        if 'batch_api' in tool:
+            jobs.append((tool['batch_api'], [api_args for _, api_args in calls]))
+            job_calls.append((tool, calls))
+        else:
+            for call in calls:
+                jobs.append((single_call_batch_api(tool['api']), [call[1]]))
+                job_calls.append((tool, [call]))
+    if len(jobs) == 0:
+        return api_results
+
+    for (tool, calls), batch_results in zip(job_calls, executor.run(jobs)):
+        if batch_results is None:
+            for call_index, _ in calls:
+                api_results[call_index] = tool.get('timeout_result', TOOL_TIMEOUT_RESULT)
+            continue
+        for (call_index, api_args), api_result in zip(calls, batch_results):
+            api_results[call_index] = api_result
+            if cache is not None:
+                cache.put(tool, api_args, api_result)
+
+    return api_results
+
+def encode_tool_result(tokenizer, tool, api_args, api_result, cache=None):
+    if cache is None:
+        return tokenizer.encode(api_result, return_tensors=None)
+    return cache.encode(tokenizer, tool, api_args, api_result)
@@ -0,0 +1,191 @@
+import asyncio
+import uuid
+from logging import getLogger
+
+from rollout_buffer import RolloutBuffer
+from tool_execution import TOOL_TIMEOUT_RESULT, run_tool_calls, encode_tool_result
+
+logger = getLogger(__name__)
+
+
+def new_rollout_buffer(tokenizer, inputs, sampling_params):
+    max_new_tokens = getattr(sampling_params, 'max_tokens', None) or 256
+    return RolloutBuffer(inputs, tokenizer.pad_token_id, max_new_tokens=max_new_tokens)
+
+def sampled_logprobs(completion):
+    # Log-probs of the sampled tokens when the request asked for them (SamplingParams logprobs=0)
+    if getattr(completion, 'logprobs', None) is None:
+        return None
+    return [step[token_id].logprob for token_id, step in zip(completion.token_ids, completion.logprobs)]
+
+def generate_with_tools(model, tokenizer, inputs, sampling_params, tools, stop_tokens, actions_num=1, lora_request=None, use_tqdm=None, tool_cache=None, tool_executor=None, num_samples=1):
+    """
+    Tool-calling generation loop over a vLLM engine.
+
+    Each round generates until a stop token. Sequences that stopped on a tool end token get the tool result
+    appended and continue in the next round; the rest are done. Only the sequences that are still active are sent
+    to the engine, and the loop ends as soon as all of them are done or after actions_num tool rounds.
+    The tool calls of a round run on tool_executor (ToolExecutor) when given. If sampling_params asks for logprobs,
+    the log-probs of the generated tokens are kept in the buffer too.
+    With num_samples > 1 every prompt is sent once in the first round with SamplingParams n=num_samples, so its
+    prefill is shared, and gets num_samples consecutive rows.
+
+    Returns a RolloutBuffer with the token ids, the mask (0 for tool result tokens) and the responses of inputs
+    (lists of prompt token ids), and a dict of stats with the tool calls per sequence, the number of unfinished
+    answers, the generated tokens and the generation rounds.
+    """
+    rows_num = len(inputs) * num_samples
+    buffer = new_rollout_buffer(tokenizer, [input_ids for input_ids in inputs for _ in range(num_samples)], sampling_params)
+    dones = [False] * rows_num
+    stats = {
+        'tool_calls': [0] * rows_num,
+        'unfinished_answers': 0,
+        'generated_tokens': 0,
+        'generation_rounds': 0,
+    }
+    for action_step in range(actions_num + 1 if len(tools) > 0 else 1):
+        active = [j for j in range(rows_num) if not dones[j]]
+        if len(active) == 0:
+            break
+        if action_step == 0 and num_samples > 1:
+            first_round_params = sampling_params.clone()
+            first_round_params.n = num_samples
+            prompt_outputs = model.generate(prompt_token_ids=inputs, sampling_params=first_round_params, lora_request=lora_request, use_tqdm=use_tqdm)
+            active_completions = [completion for output in prompt_outputs for completion in output.outputs]
+        else:
+            active_outputs = model.generate(prompt_token_ids=[buffer.token_ids(j) for j in active], sampling_params=sampling_params, lora_request=lora_request, use_tqdm=use_tqdm)
+            active_completions = [output.outputs[0] for output in active_outputs]
+        completions = dict(zip(active, active_completions))
+        stats['generation_rounds'] += 1
+        stats['generated_tokens'] += sum(len(completion.token_ids) for completion in active_completions)
+
+        # Collect the tool calls of the round so they are resolved together
+        tool_calls = []
+        for j, completion in completions.items():
+            for tool in tools:
+                if completion.stop_reason == tool['end_token'] and tool['start_token'] in completion.text:
+                    api_args = completion.text.split(tool['start_token'])[1].strip()
+                    tool_calls.append((j, tool, api_args))
+                    break # Only one tool can be used at a time
+        api_results = run_tool_calls([(tool, api_args) for _, tool, api_args in tool_calls], cache=tool_cache, executor=tool_executor)
+
+        for (j, tool, api_args), api_result in zip(tool_calls, api_results):
+            completion = completions[j]
+            buffer.append(j, completion.token_ids, text=completion.text + f"{tool['end_token']}", logprobs=sampled_logprobs(completion))
+            buffer.append(j, encode_tool_result(tokenizer, tool, api_args, api_result, cache=tool_cache), mask_value=0, text=api_result)
+            stats['tool_calls'][j] += 1
+
+        for j, completion in completions.items():
+            if completion.finish_reason == "stop" and completion.stop_reason is None:
+                buffer.append(j, completion.token_ids, text=completion.text, logprobs=sampled_logprobs(completion))
+                dones[j] = True
+            elif completion.stop_reason not in stop_tokens:
+                logger.warning(f"Unexpected finish reason: {completion.finish_reason} {completion.stop_reason}")
+                stats['unfinished_answers'] += 1
+                # Not sampled, so it has no old log-prob: masked out of the loss like the tool results
+                buffer.append(j, [tokenizer.eos_token_id], mask_value=0, text=tokenizer.eos_token)
+                dones[j] = True
+
+    return buffer, stats
+
+
+class VLLMAsyncEngine:
+    """
+    Rollout engine on top of vLLM's AsyncLLMEngine.
+
+    A rollout engine only needs a coroutine generate(prompt_token_ids, sampling_params, request_id, lora_request)
+    returning the finished request output, so tests and benchmarks can pass a scripted engine instead.
+    """
+    def __init__(self, engine):
+        self.engine = engine
+
+    @classmethod
+    def from_engine_args(cls, **kwargs):
+        from vllm import AsyncEngineArgs, AsyncLLMEngine
+        return cls(AsyncLLMEngine.from_engine_args(AsyncEngineArgs(**kwargs)))
+
+    async def generate(self, prompt_token_ids, sampling_params, request_id, lora_request=None):
+        final_output = None
+        async for output in self.engine.generate({'prompt_token_ids': prompt_token_ids}, sampling_params, request_id, lora_request=lora_request):
+            final_output = output
+        return final_output
+
+async def run_tool_call_async(tool, api_args, tool_executor=None, tool_cache=None):
+    # On tool_executor (ToolExecutor) with its timeout, or on the default thread pool of the loop without a timeout
+    if tool_cache is not None:
+        api_result = tool_cache.get(tool, api_args)
+        if api_result is not None:
+            return api_result
+    if tool_executor is None:
+        api_result = await asyncio.get_running_loop().run_in_executor(None, tool['api'], api_args)
+    else:
+        api_result = await tool_executor.run_async(tool['api'], api_args)
+        if api_result is None:
+            return tool.get('timeout_result', TOOL_TIMEOUT_RESULT)
+    if tool_cache is not None:
+        tool_cache.put(tool, api_args, api_result)
+    return api_result
+
+async def rollout_sequence(engine, tokenizer, buffer, j, sampling_params, tools, stop_tokens, actions_num, stats, lora_request=None, tool_executor=None, tool_cache=None):
+    # Same steps as one row of generate_with_tools, without waiting for the rest of the batch
+    request_prefix = uuid.uuid4().hex
+    for action_step in range(actions_num + 1 if len(tools) > 0 else 1):
+        output = await engine.generate(buffer.token_ids(j), sampling_params, f'{request_prefix}-{action_step}', lora_request=lora_request)
+        output = output.outputs[0]
+        stats['generated_tokens'] += len(output.token_ids)
+        stats['generation_rounds'] = max(stats['generation_rounds'], action_step + 1)
+
+        tool = next((tool for tool in tools if output.stop_reason == tool['end_token'] and tool['start_token'] in output.text), None)
+        if tool is not None:
+            api_args = output.text.split(tool['start_token'])[1].strip()
+            api_result = await run_tool_call_async(tool, api_args, tool_executor=tool_executor, tool_cache=tool_cache)
+            buffer.append(j, output.token_ids, text=output.text + f"{tool['end_token']}", logprobs=sampled_logprobs(output))
+            buffer.append(j, encode_tool_result(tokenizer, tool, api_args, api_result, cache=tool_cache), mask_value=0, text=api_result)
+            stats['tool_calls'][j] += 1
+        elif output.finish_reason == "stop" and output.stop_reason is None:
+            buffer.append(j, output.token_ids, text=output.text, logprobs=sampled_logprobs(output))
+            break
+        elif output.stop_reason not in stop_tokens:
+            logger.warning(f"Unexpected finish reason: {output.finish_reason} {output.stop_reason}")
+            stats['unfinished_answers'] += 1
+            # Not sampled, so it has no old log-prob: masked out of the loss like the tool results
+            buffer.append(j, [tokenizer.eos_token_id], mask_value=0, text=tokenizer.eos_token)
+            break
+
+async def generate_with_tools_async(engine, tokenizer, inputs, sampling_params, tools, stop_tokens, actions_num=1, lora_request=None, tool_executor=None, tool_cache=None):
+    """
+    Streaming version of generate_with_tools.
+
+    Every sequence runs as its own coroutine: it generates until a stop token, awaits its tool call (on
+    tool_executor with its timeout, the default thread pool if None) and resumes, while the engine keeps decoding
+    the rest of the batch.
+    Same arguments and return values as generate_with_tools, with a rollout engine (see VLLMAsyncEngine) instead
+    of an LLM; generation_rounds is the largest number of rounds of a single sequence.
+    """
+    buffer = new_rollout_buffer(tokenizer, inputs, sampling_params)
+    stats = {
+        'tool_calls': [0] * len(inputs),
+        'unfinished_answers': 0,
+        'generated_tokens': 0,
+        'generation_rounds': 0,
+    }
+    await asyncio.gather(*[
+        rollout_sequence(engine, tokenizer, buffer, j, sampling_params, tools, stop_tokens, actions_num, stats, lora_request=lora_request, tool_executor=tool_executor, tool_cache=tool_cache)
+        for j in range(len(inputs))
+    ])
+    return buffer, stats
+
+_event_loop = None
+
+def run_async(coroutine):
+    # AsyncLLMEngine binds its background loop to the first event loop it runs in, so every call shares one loop
+    global _event_loop
+    if _event_loop is None:
+        _event_loop = asyncio.new_event_loop()
+    return _event_loop.run_until_complete(coroutine)
+
+def rollout_ids_async(engine, tokenizer, inputs, sampling_params, tools, stop_tokens, **kwargs):
+    # Same return values as generate_batch_completion(..., return_ids=True) in grpo_trainer_with_tools.py
+    buffer, _ = run_async(generate_with_tools_async(engine, tokenizer, inputs, sampling_params, tools, stop_tokens, **kwargs))
+    generation_ids, mask = buffer.tensors()
+    return generation_ids, buffer.prompt_length, mask, buffer.log_probs()